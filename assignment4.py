@@ -1,41 +1,760 @@
 #imports
-import os, requests, sys, json, datetime, time, atexit
-from flask import Flask, jsonify, request, Response
+import os
+#async server mode: sockets, threads and locks have to be made cooperative before anything else imports them
+if os.getenv('SERVER_MODE') == "async":
+    from gevent import monkey
+    monkey.patch_all()
+import requests, sys, json, datetime, time, atexit, hashlib, bisect, threading, collections, math
+import concurrent.futures
+from flask import Flask, jsonify, request, Response, g
 from apscheduler.schedulers.background import BackgroundScheduler
+from gunicorn.app.base import BaseApplication
 
 #create app with flask
 app = Flask(__name__)
 
 
+#KeyRecord
+#everything this node knows about one key, in one compact object
+#value, time: the value we store and its timestamp (value is None if we don't hold the key)
+#shard, shardTime: the shard the key belongs to (directory mode), and when that was decided (None if we don't know)
+#latest: the newest timestamp a client has shown us for the key, to know if our value is stale
+class KeyRecord:
+    __slots__ = ('value', 'time', 'shard', 'shardTime', 'latest')
+
+    def __init__(self):
+        self.value = None
+        self.time = None
+        self.shard = None
+        self.shardTime = None
+        self.latest = None
+
+    def isEmpty(self):
+        return (self.value is None and self.time is None and self.shard is None and self.latest is None)
+
+
+#KeyStore
+#thread-safe storage engine for every KeyRecord this node has
+#keys are split into stripes by hash, each with its own dict and lock,
+#so request threads and the gossip job never see a dict change size under them,
+#and threads working on keys in different stripes don't wait on each other
+#listeners are called as listener(key, oldTime, hadValue, newTime, hasValue) every time a stored value changes,
+#and shard listeners as listener(key, shard, shardTime) every time a key's directory entry changes,
+#both with the key's stripe lock held
+class KeyStore:
+    def __init__(self, numStripes):
+        self.stripes = []
+        self.locks = []
+        for i in range(numStripes):
+            self.stripes.append({})
+            self.locks.append(threading.RLock())
+        self.listeners = []
+        self.shardListeners = []
+        self.countLock = threading.Lock()
+        self.valueCount = 0
+        self.shardCounts = {} #{shard : keys the directory puts on it}, kept up to date on every change
+        self.valueBytes = 0 #size of every value we hold, see valueSize()
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def addShardListener(self, listener):
+        self.shardListeners.append(listener)
+
+    #setRecordShard() changes a key's directory entry and tells the shard listeners
+    #should be called with the key's stripe lock held
+    def setRecordShard(self, key, record, shard, shardTime):
+        if(record.shard == shard and record.shardTime == shardTime):
+            return
+        self.moveShardCount(record.shard, shard)
+        record.shard = shard
+        record.shardTime = shardTime
+        for listener in self.shardListeners:
+            listener(key, shard, shardTime)
+
+    def stripeIndex(self, key):
+        return hash(key) % len(self.stripes)
+
+    def getRecord(self, key):
+        return self.stripes[self.stripeIndex(key)].get(key)
+
+    #getRecordForUpdate() should be called with the key's stripe lock held
+    def getRecordForUpdate(self, key):
+        stripe = self.stripes[self.stripeIndex(key)]
+        record = stripe.get(key)
+        if(record is None):
+            record = KeyRecord()
+            stripe[key] = record
+        return record
+
+    #moveShardCount() counts a key's directory entry moving from oldShard to newShard (either can be None)
+    #should be called with the key's stripe lock held
+    def moveShardCount(self, oldShard, newShard):
+        if(oldShard == newShard):
+            return
+        with self.countLock:
+            if(oldShard is not None):
+                self.shardCounts[oldShard] = self.shardCounts.get(oldShard, 0) - 1
+            if(newShard is not None):
+                self.shardCounts[newShard] = self.shardCounts.get(newShard, 0) + 1
+
+    #pruneRecord() should be called with the key's stripe lock held
+    def pruneRecord(self, key, record):
+        if(record.isEmpty()):
+            self.stripes[self.stripeIndex(key)].pop(key, None)
+
+    def getValue(self, key):
+        record = self.getRecord(key)
+        if(record is None):
+            return None
+        return record.value
+
+    def getTime(self, key):
+        record = self.getRecord(key)
+        if(record is None):
+            return None
+        return record.time
+
+    def getShard(self, key):
+        record = self.getRecord(key)
+        if(record is None):
+            return None
+        return record.shard
+
+    def getLatest(self, key):
+        record = self.getRecord(key)
+        if(record is None):
+            return None
+        return record.latest
+
+    def hasValue(self, key):
+        return (self.getValue(key) is not None)
+
+    #getVersion() returns [value, time] read together, so they always belong to the same write
+    def getVersion(self, key):
+        with self.locks[self.stripeIndex(key)]:
+            record = self.getRecord(key)
+            if(record is None):
+                return [None, None]
+            return [record.value, record.time]
+
+    #store() sets a key's value and time, no matter what we had
+    def store(self, key, value, keyTime):
+        with self.locks[self.stripeIndex(key)]:
+            record = self.getRecordForUpdate(key)
+            oldTime = record.time
+            hadValue = (record.value is not None)
+            sizeChange = valueSize(value)
+            if(hadValue):
+                sizeChange -= valueSize(record.value)
+            record.value = value
+            record.time = keyTime
+            with self.countLock:
+                self.valueBytes += sizeChange
+                if(hadValue == False):
+                    self.valueCount += 1
+            for listener in self.listeners:
+                listener(key, oldTime, hadValue, keyTime, True)
+
+    #applyIfNewer() is last-writer-wins: stores the value only if its time is newer than ours,
+    #or it is the same version and we lost the value
+    #returns True if the value was stored
+    def applyIfNewer(self, key, value, theirTime):
+        with self.locks[self.stripeIndex(key)]:
+            record = self.getRecord(key)
+            if(record is not None and record.time is not None):
+                if(record.time > theirTime):
+                    return False #ours is newer
+                if(record.time == theirTime and record.value is not None):
+                    return False #we already have this version
+            self.store(key, value, theirTime)
+            return True
+
+    #drop() deletes a value we no longer hold (e.g. it moved to another shard)
+    #the time stays, so an older copy can't come back later
+    def drop(self, key):
+        with self.locks[self.stripeIndex(key)]:
+            record = self.getRecord(key)
+            if(record is None or record.value is None):
+                return
+            with self.countLock:
+                self.valueBytes -= valueSize(record.value)
+                self.valueCount -= 1
+            record.value = None
+            for listener in self.listeners:
+                listener(key, record.time, True, record.time, False)
+
+    def setShard(self, key, shard, shardTime=None):
+        with self.locks[self.stripeIndex(key)]:
+            record = self.getRecordForUpdate(key)
+            self.setRecordShard(key, record, shard, shardTime)
+            self.pruneRecord(key, record)
+
+    #setShardIfNewer() only sets the shard if shardTime is newer than when the key's shard was decided
+    #(a key without a shard, or with one of unknown age, always takes it), returns True if it did
+    def setShardIfNewer(self, key, shard, shardTime):
+        with self.locks[self.stripeIndex(key)]:
+            record = self.getRecordForUpdate(key)
+            newer = (record.shard is None or (shardTime is not None and (record.shardTime is None or record.shardTime < shardTime)))
+            if(newer):
+                self.setRecordShard(key, record, shard, shardTime)
+            self.pruneRecord(key, record)
+            return newer
+
+    #replaceShards() makes {key : shard} the whole key directory, every entry decided at shardTime
+    def replaceShards(self, keyShardDict, shardTime):
+        stripeShardDicts = []
+        for i in range(len(self.stripes)):
+            stripeShardDicts.append({})
+        for key, shard in keyShardDict.items():
+            stripeShardDicts[self.stripeIndex(key)][key] = shard
+        for i in range(len(self.stripes)):
+            with self.locks[i]:
+                stripe = self.stripes[i]
+                newShards = stripeShardDicts[i]
+                for key, record in list(stripe.items()):
+                    if(key not in newShards):
+                        self.setRecordShard(key, record, None, None)
+                for key, shard in newShards.items():
+                    record = self.getRecordForUpdate(key)
+                    self.setRecordShard(key, record, shard, shardTime)
+                for key, record in list(stripe.items()):
+                    self.pruneRecord(key, record)
+
+    #noteLatest() remembers theirTime if it's newer than the latest time we've seen for the key
+    def noteLatest(self, key, theirTime):
+        with self.locks[self.stripeIndex(key)]:
+            record = self.getRecordForUpdate(key)
+            if(record.latest is None or record.latest < theirTime):
+                record.latest = theirTime
+
+    #pruneLatest() forgets every latest time that isCaughtUp(key, latest) says we don't need anymore
+    #returns how many were forgotten
+    def pruneLatest(self, isCaughtUp):
+        pruned = 0
+        for i in range(len(self.stripes)):
+            with self.locks[i]:
+                stripe = self.stripes[i]
+                for key, record in list(stripe.items()):
+                    if(record.latest is not None and isCaughtUp(key, record.latest)):
+                        record.latest = None
+                        self.pruneRecord(key, record)
+                        pruned += 1
+        return pruned
+
+    #the methods below return copies, safe to loop over while other threads write
+
+    #valueItems() returns [[key, value, time]] for every value we hold
+    def valueItems(self):
+        items = []
+        for i in range(len(self.stripes)):
+            with self.locks[i]:
+                for key, record in self.stripes[i].items():
+                    if(record.value is not None):
+                        items.append([key, record.value, record.time])
+        return items
+
+    #timeItems() returns [[key, time]] for every key we have a time for
+    def timeItems(self):
+        items = []
+        for i in range(len(self.stripes)):
+            with self.locks[i]:
+                for key, record in self.stripes[i].items():
+                    if(record.time is not None):
+                        items.append([key, record.time])
+        return items
+
+    #shardDict() returns the key directory as {key : shard}
+    def shardDict(self):
+        keyShardDict = {}
+        for i in range(len(self.stripes)):
+            with self.locks[i]:
+                for key, record in self.stripes[i].items():
+                    if(record.shard is not None):
+                        keyShardDict[key] = record.shard
+        return keyShardDict
+
+    #shardItems() returns the key directory with when every entry was decided, as {key : [shard, shardTime]}
+    def shardItems(self):
+        keyShardItems = {}
+        for i in range(len(self.stripes)):
+            with self.locks[i]:
+                for key, record in self.stripes[i].items():
+                    if(record.shard is not None):
+                        keyShardItems[key] = [record.shard, record.shardTime]
+        return keyShardItems
+
+    def countValues(self):
+        return self.valueCount
+
+    def countBytes(self):
+        return self.valueBytes
+
+    #countShard() returns how many keys the directory puts on shard, in O(1)
+    def countShard(self, shard):
+        return self.shardCounts.get(shard, 0)
+
+
+#getPeerSession()
+#gets the shared requests.Session for a peer, creating it the first time we talk to that peer
+#each session keeps up to peerPoolSize keep-alive connections, shared by every thread,
+#so inter-node calls reuse a TCP connection instead of opening a new one every time
+#the pool doesn't block, a request that finds all peerPoolSize connections busy opens an extra one
+#(closed once it's done) instead of waiting, requests passes no pool timeout so a blocking pool could
+#hold a request past its own timeout and keep it from ever failing over
+def getPeerSession(address):
+    session = peerSessions.get(address)
+    if(session is None):
+        with peerSessionsLock:
+            #check again, another thread could have made it while we waited for the lock
+            session = peerSessions.get(address)
+            if(session is None):
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=peerPoolSize, pool_block=False, max_retries=0)
+                session.mount('http://', adapter)
+                peerSessions.update({address : session})
+    return session
+
+#peerRequest()
+#sends a request to another node through its pooled session
+#baseUrl is a full url, e.g. http://<address>/kvs/key-count
+#uses peerTimeout if the caller doesn't give a timeout
+#every request carries our view epoch in X-View-Epoch (and our address in X-Node-Address), and every answer the peer's
+#(see addViewEpoch()), so a node that missed a view change finds out the next time it talks to anyone,
+#and a node on a newer view doesn't act on what we send (see checkViewEpoch())
+#a peer whose circuit breaker is open fails right away instead of waiting out its timeout,
+#only heartbeats (probe=True) still go to it, see sendHeartbeat()
+def peerRequest(method, baseUrl, **kwargs):
+    probe = kwargs.pop('probe', False)
+    if(kwargs.get('timeout') is None):
+        kwargs.update({'timeout' : peerTimeout})
+    headers = dict(kwargs.get('headers') or {})
+    headers.update({"X-View-Epoch" : str(viewEpoch), "X-Node-Address" : selfAddress})
+    kwargs.update({'headers' : headers})
+    address = baseUrl.split('/')[2]
+    if(probe == False and isPeerOpen(address)):
+        raise requests.exceptions.ConnectionError("circuit open for " + address)
+    try:
+        r = getPeerSession(address).request(method, baseUrl, **kwargs)
+    except:
+        #fire-and-forget requests (with a timeout of about 0) always time out, that says nothing about the peer
+        if(kwargs.get('timeout') >= 0.01):
+            recordPeerResult(address, False, probe)
+        raise
+    recordPeerResult(address, True, probe)
+    noteViewEpoch(r.headers.get('X-View-Epoch'), address)
+    return r
+
+#peerGet()
+#GET to another node, see peerRequest()
+def peerGet(baseUrl, **kwargs):
+    return peerRequest('GET', baseUrl, **kwargs)
+
+#peerPut()
+#PUT to another node, see peerRequest()
+def peerPut(baseUrl, **kwargs):
+    return peerRequest('PUT', baseUrl, **kwargs)
+
+#fanOutPut()
+#sends the same json PUT to every address at the same time, on the fanOutExecutor threads
+#returns as soon as quorum nodes answered, the rest keep going in the background
+#onFailure, if given, is called with the address of every node that couldn't be reached, even after we returned
+#returns a list of [address, response] for the nodes that answered, in the order they answered
+def fanOutPut(addresses, path, jsonDict, timeoutVal, quorum, onFailure=None):
+    futureAddressDict = {}
+    for address in addresses:
+        baseUrl = ('http://' + address + path)
+        future = fanOutExecutor.submit(peerPut, baseUrl, headers={"Content-Type": "application/json"}, json=jsonDict, timeout=timeoutVal)
+        futureAddressDict.update({future : address})
+        if(onFailure is not None):
+            future.add_done_callback(lambda done, address=address: reportFailure(done, address, onFailure))
+    answers = []
+    for future in concurrent.futures.as_completed(futureAddressDict):
+        try:
+            answers.append([futureAddressDict.get(future), future.result()])
+        except:
+            pass #node is down, nothing we can do
+        if(len(answers) >= quorum):
+            break
+    return answers
+
+#reportFailure()
+#fanOutPut() callback, runs when a request is done and calls onFailure(address) if it failed
+def reportFailure(future, address, onFailure):
+    if(future.exception() is not None):
+        onFailure(address)
+
+#failure detector
+#every heartbeatInterval seconds we ping every node (see heartbeat()), and keep a health entry per peer:
+#the times between its heartbeats, its heartbeat latency, its consecutive failures and its circuit breaker
+#a peer is suspected when its phi (how unlikely it is that a heartbeat is this late, see getPhi()) is over phiThreshold
+#circuit breaker: closed (requests go through) -> open after breakerFailures failures in a row, or when suspected
+#(requests fail right away) -> half-open when a heartbeat gets through -> closed after breakerProbes heartbeats in a row
+
+#getPeerHealth()
+#the health entry of a peer, creating it the first time
+def getPeerHealth(address):
+    health = peerHealth.get(address)
+    if(health is None):
+        with healthLock:
+            health = peerHealth.get(address)
+            if(health is None):
+                health = {"state" : "closed", "failures" : 0, "probes" : 0, "latency" : None,
+                          "last-heartbeat" : None, "intervals" : collections.deque(maxlen=100)}
+                peerHealth.update({address : health})
+    return health
+
+#recordPeerResult()
+#counts a request to a peer that got an answer (ok) or failed, and moves its circuit breaker
+def recordPeerResult(address, ok, probe):
+    if(failureDetector != "on"):
+        return
+    health = getPeerHealth(address)
+    with healthLock:
+        if(ok == False):
+            health["failures"] += 1
+            health["probes"] = 0
+            if(health["state"] == "half-open" or health["failures"] >= breakerFailures):
+                health["state"] = "open"
+            return
+        health["failures"] = 0
+        if(probe and health["state"] == "open"):
+            health["state"] = "half-open"
+        if(probe and health["state"] == "half-open"):
+            health["probes"] += 1
+            if(health["probes"] >= breakerProbes):
+                health["state"] = "closed"
+                health["probes"] = 0
+
+#isPeerOpen()
+#checks if requests to a peer should fail right away, because its circuit breaker isn't closed
+def isPeerOpen(address):
+    health = peerHealth.get(address)
+    return (health is not None and health["state"] != "closed")
+
+#getPhi()
+#phi accrual: how suspicious it is that we haven't had a heartbeat from a peer for this long,
+#assuming heartbeats arrive with exponentially distributed gaps of the average we've seen
+#phi of 1 means a 10% chance the peer is still up, 2 means 1%, and so on
+#returns 0 for peers we never heard from (their failures open the breaker instead)
+def getPhi(address):
+    health = peerHealth.get(address)
+    if(health is None or health["last-heartbeat"] is None):
+        return 0
+    intervals = list(health["intervals"])
+    meanInterval = heartbeatInterval
+    if(len(intervals) > 0):
+        meanInterval = max(sum(intervals) / len(intervals), 0.001)
+    return (time.time() - health["last-heartbeat"]) / (meanInterval * math.log(10))
+
+#isSuspected()
+#checks if the failure detector thinks a peer is down
+def isSuspected(address):
+    return (isPeerOpen(address) or getPhi(address) > phiThreshold)
+
+#orderReplicas()
+#orders addresses to ask: peers we think are up first, fastest heartbeat latency first, then suspected peers
+#(peers we never measured count as fast, so they get tried)
+def orderReplicas(addresses):
+    if(failureDetector != "on"):
+        return list(addresses)
+    healthy = []
+    suspected = []
+    for address in addresses:
+        if(isSuspected(address)):
+            suspected.append(address)
+        else:
+            healthy.append(address)
+    def getLatency(address):
+        health = peerHealth.get(address)
+        if(health is None or health["latency"] is None):
+            return 0
+        return health["latency"]
+    healthy.sort(key=getLatency)
+    return healthy + suspected
+
+#sendHeartbeat()
+#pings a peer, and notes when the heartbeat arrived and how long it took
+def sendHeartbeat(address):
+    start = time.time()
+    try:
+        peerGet('http://' + address + '/kvs/ping', timeout=heartbeatTimeout, probe=True)
+    except:
+        return #counted as a failure by peerRequest()
+    now = time.time()
+    health = getPeerHealth(address)
+    with healthLock:
+        if(health["last-heartbeat"] is not None):
+            health["intervals"].append(now - health["last-heartbeat"])
+        health["last-heartbeat"] = now
+        #moving average, recent heartbeats count most
+        if(health["latency"] is None):
+            health["latency"] = now - start
+        else:
+            health["latency"] = 0.8 * health["latency"] + 0.2 * (now - start)
+
+#heartbeat()
+#sends a heartbeat to every other node at once, and opens the breaker of every peer that is suspected
+def heartbeat():
+    addresses = set(nodeAddressDict.values())
+    addresses.discard(selfAddress)
+    for address in addresses:
+        if(getPhi(address) > phiThreshold):
+            with healthLock:
+                getPeerHealth(address)["state"] = "open"
+        fanOutExecutor.submit(sendHeartbeat, address)
+
+#getHealthTable()
+#health of every peer, for /kvs/health
+def getHealthTable():
+    tableDict = {}
+    for address, health in list(peerHealth.items()):
+        tableDict.update({address : {"state" : health["state"],
+                                     "suspected" : isSuspected(address),
+                                     "phi" : getPhi(address),
+                                     "latency" : health["latency"],
+                                     "failures" : health["failures"]}})
+    return tableDict
+
+#getHedgeDelay()
+#seconds to wait for a replica's answer before also asking the next replica
+#with hedgeDelay "p95", uses the 95th percentile of recent forwarded read latencies
+def getHedgeDelay():
+    if(hedgeDelay != "p95"):
+        return float(hedgeDelay)
+    samples = sorted(readLatencies)
+    if(len(samples) < 20):
+        return 0.05 #not enough samples yet, use a small default
+    return samples[int(len(samples) * 0.95) - 1]
+
+#hedgedGet()
+#reads path from the addresses, starting with the first quorum of them
+#if no answer comes back within the hedge delay, or a replica fails, also asks the next address
+#addresses are tried in orderReplicas() order
+#stops at the first quorum 200 answers, and cancels the requests it hasn't sent yet
+#jsonDict, if given, is sent as the body of every request
+#returns [answers, notFound]: a list of [address, response] with status 200,
+#and the number of replicas that said the key does not exist
+def hedgedGet(addresses, path, timeoutVal, quorum, jsonDict=None):
+    #healthy, fast replicas first, so hedging rarely has to wait for a dead one
+    addresses = orderReplicas(addresses)
+    futureAddressDict = {}
+    futureStartDict = {}
+    pending = set()
+    answers = []
+    notFound = 0
+    nextIndex = 0
+    #sendNext() starts the request to the next address, if there is one
+    def sendNext():
+        nonlocal nextIndex
+        if(nextIndex >= len(addresses)):
+            return
+        address = addresses[nextIndex]
+        nextIndex += 1
+        future = fanOutExecutor.submit(peerGet, 'http://' + address + path, json=jsonDict, timeout=timeoutVal)
+        futureAddressDict.update({future : address})
+        futureStartDict.update({future : time.time()})
+        pending.add(future)
+
+    for i in range(quorum):
+        sendNext()
+    while(len(answers) < quorum and len(pending) > 0):
+        waitTime = None #nobody left to hedge to, every request has its own timeout
+        if(nextIndex < len(addresses)):
+            waitTime = getHedgeDelay()
+        done, pending = concurrent.futures.wait(pending, timeout=waitTime, return_when=concurrent.futures.FIRST_COMPLETED)
+        #nobody answered in time, hedge with the next replica
+        if(len(done) == 0):
+            sendNext()
+        for future in done:
+            try:
+                r = future.result()
+                readLatencies.append(time.time() - futureStartDict.get(future))
+                if(r.status_code == 200):
+                    answers.append([futureAddressDict.get(future), r])
+                    continue
+                if(r.status_code == 404):
+                    notFound += 1 #the replica may just be behind, ask another one
+            except:
+                pass #node is down, ask another one
+            sendNext()
+    #cancel what we don't need, requests already in flight are ignored
+    for future in pending:
+        future.cancel()
+    return [answers, notFound]
+
+#getPoolStats()
+#counts new vs reused connections for every peer, from the urllib3 pools behind the sessions
+#returns {address : {"requests", "connections-created", "connections-reused"}}
+def getPoolStats():
+    statsDict = {}
+    for address, session in list(peerSessions.items()):
+        numRequests = 0
+        numConnections = 0
+        poolManager = session.get_adapter('http://' + address).poolmanager
+        for poolKey in list(poolManager.pools.keys()):
+            pool = poolManager.pools.get(poolKey)
+            if(pool is not None):
+                numRequests += pool.num_requests
+                numConnections += pool.num_connections
+        statsDict.update({address : {
+            "requests" : numRequests,
+            "connections-created" : numConnections,
+            "connections-reused" : numRequests - numConnections
+        }})
+    return statsDict
+
+
+#getShardKeyCount()
+#asks the replicas of a shard for its key-count, hedged like a forwarded GET
+#returns None if no replica answered
+def getShardKeyCount(shard):
+    addresses = shardAddressesDict.get(shard)
+    if(addresses is None or len(addresses) == 0):
+        return None
+    timeoutVal = peerTimeoutBudget / 2 #replicas run in parallel, so each one can have the whole cushion
+    answers, notFoundCount = hedgedGet(addresses, '/kvs/key-count', timeoutVal, 1)
+    for address, r in answers:
+        try:
+            count = r.json().get('key-count')
+        except:
+            continue
+        keyCountTable.update({shard : [count, time.time()]})
+        return count
+    return None
+
+#getCachedKeyCount()
+#key-count of a shard, without asking it if we can
+#directory mode counts the shard's keys in our own directory,
+#hash and range mode use what the shard's nodes reported through /kvs/shard-status, if it's at most keyCountMaxAge seconds old
+#falls back to asking the shard, returns None if that fails too
+def getCachedKeyCount(shard):
+    if(shard == selfShardID):
+        return getLocalKeyCount()
+    if(placementMode == "directory"):
+        return kvStore.countShard(shard)
+    entry = keyCountTable.get(shard)
+    if(entry is not None and time.time() - entry[1] <= keyCountMaxAge):
+        return entry[0]
+    return getShardKeyCount(shard)
+
+#getAllShardKeyCounts()
+#key-count of every shard, from the cache where it's fresh, asking the other shards at once
+#returns {shard : key-count} for the shards we have a count for
+def getAllShardKeyCounts():
+    shardCounts = {}
+    futureShardDict = {}
+    for shard in list(shardAddressesDict.keys()):
+        entry = keyCountTable.get(shard)
+        if(shard == selfShardID or placementMode == "directory" or (entry is not None and time.time() - entry[1] <= keyCountMaxAge)):
+            shardCounts.update({shard : getCachedKeyCount(shard)})
+            continue
+        futureShardDict.update({batchExecutor.submit(getShardKeyCount, shard) : shard})
+    for future in concurrent.futures.as_completed(futureShardDict):
+        try:
+            count = future.result()
+        except:
+            count = None
+        if(count is not None):
+            shardCounts.update({futureShardDict.get(future) : count})
+    return shardCounts
+
+#getShardLoads()
+#load of every shard, from what its nodes reported through /kvs/shard-status in the last keyCountMaxAge seconds
+#(our own from the last gossip round): ops/sec added up over the replicas, the largest bytes and p99 of any replica
+#returns {shard : {"bytes", "ops-per-sec", "p99"}} for the shards we heard from
+def getShardLoads():
+    addressShardDict = {}
+    for shard, addresses in shardAddressesDict.items():
+        for address in addresses:
+            addressShardDict.update({address : shard})
+    reports = dict(loadReports)
+    reports.update({selfAddress : [localLoad, time.time()]})
+    shardLoads = {}
+    for address, entry in reports.items():
+        shard = addressShardDict.get(address)
+        load, received = entry
+        if(shard is None or load is None or time.time() - received > keyCountMaxAge):
+            continue
+        shardLoad = shardLoads.get(shard)
+        if(shardLoad is None):
+            shardLoad = {"bytes" : 0, "ops-per-sec" : 0, "p99" : 0}
+            shardLoads.update({shard : shardLoad})
+        shardLoad["ops-per-sec"] += load["ops-per-sec"]
+        shardLoad["bytes"] = max(shardLoad["bytes"], load["bytes"])
+        shardLoad["p99"] = max(shardLoad["p99"], load["p99"])
+    return shardLoads
+
+#scoreShards()
+#how loaded every shard is according to placementPolicy, lower is better
+#"bytes": stored bytes, "load": stored bytes, ops/sec and p99, each as a fraction of the busiest shard's, added up
+#extraBytes {shard : bytes} counts values placed on a shard that it hasn't reported yet
+#returns {shard : score}
+def scoreShards(shardLoads, extraBytes):
+    shardBytes = {}
+    for shard, load in shardLoads.items():
+        shardBytes.update({shard : load["bytes"] + extraBytes.get(shard, 0)})
+    maxBytes = max(list(shardBytes.values()) + [1])
+    maxOps = max([load["ops-per-sec"] for load in shardLoads.values()] + [1])
+    maxP99 = max([load["p99"] for load in shardLoads.values()] + [0.001])
+    scores = {}
+    for shard, load in shardLoads.items():
+        score = shardBytes.get(shard) / maxBytes
+        if(placementPolicy == "load"):
+            score += load["ops-per-sec"] / maxOps + load["p99"] / maxP99
+        scores.update({shard : score})
+    return scores
+
 #decideShard()
 #decides which shard a new key should belong to
-#requests the key-count from every shard, assigns key to min key-count shard
+#with placementPolicy "keys", assigns key to min key-count shard (from the cached key-counts)
+#with "bytes" or "load", assigns it to the least loaded shard (see scoreShards())
 #returns the shard that the new key should belong to
 def decideShard():
+    if(placementPolicy != "keys"):
+        scores = scoreShards(getShardLoads(), {})
+        if(len(scores) > 0):
+            return min(scores, key=scores.get)
+        #no loads reported yet, fall back to key-counts
     minKeys = getLocalKeyCount() #min defaults to local
     whichShard = selfShardID #defaults to local shardID
-    #for each shard, see who has the least amount of keys
-    for shard, addresses in shardAddressesDict.items():
-        haveKeyCount = False
-        for address in addresses:
-            if (haveKeyCount == True):
-                break
-            baseUrl = ('http://' + address + '/kvs/key-count')
-            try:
-                timeoutVal = 4 / (len(shardAddressesDict) * replFactor) #4 seconds to have a nicer cushion
-                r = requests.get(baseUrl, timeout=timeoutVal)
-                requestedKeyCount = r.json().get('key-count')
-                if(requestedKeyCount is not None):
-                    haveKeyCount = True
-
-                if(requestedKeyCount < minKeys):
-                    minKeys = requestedKeyCount
-                    whichShard = shard
-            except:
-                pass #even if we fail it doesn't matter, but we want to fail in a timely manner
-            
+    #for each shard, see who has the least amount of keys (shards that didn't answer are skipped)
+    shardCounts = getAllShardKeyCounts()
+    for shard in shardAddressesDict.keys():
+        requestedKeyCount = shardCounts.get(shard)
+        if(requestedKeyCount is not None and requestedKeyCount < minKeys):
+            minKeys = requestedKeyCount
+            whichShard = shard
     return whichShard
 
+#decideShards()
+#decides the shards of many new keys {key : value} at once, with one round of key-count requests
+#every key goes to the shard with the least keys (or the least loaded, see decideShard()),
+#counting the keys placed before it
+#returns {key : shard}
+def decideShards(keyValueDict):
+    keyShardDict = {}
+    if(placementPolicy != "keys"):
+        shardLoads = getShardLoads()
+        extraBytes = {}
+        for key, value in keyValueDict.items():
+            if(len(shardLoads) == 0):
+                break #no loads reported yet, fall back to key-counts
+            scores = scoreShards(shardLoads, extraBytes)
+            whichShard = min(scores, key=scores.get)
+            keyShardDict.update({key : whichShard})
+            extraBytes.update({whichShard : extraBytes.get(whichShard, 0) + valueSize(value)})
+        if(len(keyShardDict) == len(keyValueDict)):
+            return keyShardDict
+    shardCounts = getAllShardKeyCounts()
+    if(len(shardCounts) == 0):
+        shardCounts.update({selfShardID : 0})
+    for key in keyValueDict:
+        whichShard = min(shardCounts, key=shardCounts.get)
+        keyShardDict.update({key : whichShard})
+        shardCounts[whichShard] += 1
+    return keyShardDict
+
 #decideNodeToShard()
 #decides which nodes go to which shards
 #takes the current list of nodes, and distributes them in <shard:[addresses]> dictionary according to replication factor
@@ -65,74 +784,754 @@ def decideNodeToShard():
 
 
 
+#planRebalance()
+#decides the new {key : shard} directory for a view change, moving as few keys as possible
+#a key stays on its shard if that shard still exists and isn't over its fair share of keys
+#every other key goes to the shard that currently has the fewest keys
+#adding R shards to N moves about R/(N+R) of the keys, instead of almost all of them
+#returns the new {key : shard} dictionary
+def planRebalance(oldKeyShardDict, shardList):
+    newKeyShardDict = {}
+    if(len(shardList) == 0):
+        return newKeyShardDict
+    #fair share is the ceiling of keys / shards
+    fairShare = (len(oldKeyShardDict) + len(shardList) - 1) // len(shardList)
+    shardKeyCounts = {}
+    for shard in shardList:
+        shardKeyCounts.update({shard : 0})
+
+    #first pass: keep every key we can where it is
+    movingKeys = []
+    for key, shard in oldKeyShardDict.items():
+        count = shardKeyCounts.get(shard)
+        if(count is not None and count < fairShare):
+            newKeyShardDict.update({key : shard})
+            shardKeyCounts.update({shard : count + 1})
+        else:
+            movingKeys.append(key)
+
+    #second pass: give the keys that have to move to the emptiest shards
+    for key in movingKeys:
+        minShard = shardList[0]
+        for shard in shardList:
+            if(shardKeyCounts.get(shard) < shardKeyCounts.get(minShard)):
+                minShard = shard
+        newKeyShardDict.update({key : minShard})
+        shardKeyCounts.update({minShard : shardKeyCounts.get(minShard) + 1})
+
+    return newKeyShardDict
+
+#valueSize()
+#approximate number of bytes a value takes on the wire
+def valueSize(value):
+    return len(json.dumps(value))
+
+#collectRebalanceStats()
+#gathers the data movement of a view change from the nodes that did it
+#planned numbers come from one node of every old shard (what it had to send away)
+#actual numbers come from one node of every new shard (what it really received)
+#returns a dictionary for the view-change response
+def collectRebalanceStats(oldShardAddressesDict):
+    statsDict = {
+        "planned-keys-moved" : 0,
+        "planned-bytes-moved" : 0,
+        "keys-moved" : 0,
+        "bytes-moved" : 0
+    }
+    for shard, addresses in oldShardAddressesDict.items():
+        for address in addresses:
+            baseUrl = ('http://' + address + '/kvs/rebalance-stats')
+            try:
+                r = peerGet(baseUrl, timeout=(peerTimeoutBudget / len(addresses)))
+                statsDict["planned-keys-moved"] += r.json().get('keys-planned')
+                statsDict["planned-bytes-moved"] += r.json().get('bytes-planned')
+                break
+            except:
+                pass #node is down, ask the next replica of this shard
+    for shard, addresses in shardAddressesDict.items():
+        for address in addresses:
+            baseUrl = ('http://' + address + '/kvs/rebalance-stats')
+            try:
+                r = peerGet(baseUrl, timeout=(peerTimeoutBudget / len(addresses)))
+                statsDict["keys-moved"] += r.json().get('keys-received')
+                statsDict["bytes-moved"] += r.json().get('bytes-received')
+                break
+            except:
+                pass #node is down, ask the next replica of this shard
+    return statsDict
+
+#hashKey()
+#hashes a string to a point on the consistent-hash ring
+#uses md5 instead of hash() because hash() is salted per process, and every node must agree
+def hashKey(keyString):
+    return int(hashlib.md5(str(keyString).encode('utf-8')).hexdigest()[:16], 16)
+
+#buildHashRing()
+#rebuilds the consistent-hash ring from the shards in shardAddressesDict
+#every shard gets virtualNodes points on the ring, keyed by shardID, so every node builds the same ring
+#should be called any time shardAddressesDict changes
+def buildHashRing():
+    global hashRing #global keyword so we rebind instead of mutating, readers never see a half-built ring
+    ringList = []
+    for shard in shardAddressesDict:
+        for i in range(virtualNodes):
+            ringList.append((hashKey(shard + "#" + str(i)), shard))
+    ringList.sort()
+    points = []
+    shards = []
+    for point, shard in ringList:
+        points.append(point)
+        shards.append(shard)
+    hashRing = (points, shards)
+
+#lookupHashRing()
+#finds the shard that owns a key on the consistent-hash ring, in O(log n)
+#the owner is the first virtual node clockwise from the key's point
+#returns None if there are no shards
+def lookupHashRing(key):
+    points, shards = hashRing
+    if(len(points) == 0):
+        return None
+    index = bisect.bisect_right(points, hashKey(key))
+    if(index == len(points)):
+        index = 0 #wrap around the ring
+    return shards[index]
+
+#getKeyShard()
+#finds the shard a key belongs to, according to the placement mode
+#"hash" mode computes it locally from the ring, "range" mode from the routing table,
+#"directory" mode looks it up in keyShardDict
+#returns None if the key does not belong to a shard yet (directory mode only)
+def getKeyShard(key):
+    if(placementMode == "hash"):
+        return lookupHashRing(key)
+    if(placementMode == "range"):
+        return lookupRoutingTable(key, routingTable)
+    return kvStore.getShard(key)
+
+#range placement
+#the hash space is cut into numPartitions equal partitions, and every partition belongs to one shard
+#the routing table merges neighbouring partitions of the same shard into ranges: ([sorted range starts], [shard of each range])
+#so it is a few KB however many keys there are, and a view change sends it instead of a {key : shard} directory
+
+#getPartitionStart()
+#the first point of the hash space in partition
+def getPartitionStart(partition):
+    return partition * ((1 << 64) // numPartitions)
+
+#getInitialPartitions()
+#the partitions of the starting view: every shard gets the same number of neighbouring partitions
+#returns {partition : shard}
+def getInitialPartitions():
+    shardList = list(shardAddressesDict.keys())
+    partitionShardDict = {}
+    if(len(shardList) == 0):
+        return partitionShardDict
+    for partition in range(numPartitions):
+        partitionShardDict.update({partition : shardList[partition * len(shardList) // numPartitions]})
+    return partitionShardDict
+
+#getPartitions()
+#the shard of every partition, according to a routing table
+#returns {partition : shard}
+def getPartitions(table):
+    partitionShardDict = {}
+    for partition in range(numPartitions):
+        shard = lookupRoutingPoint(getPartitionStart(partition), table)
+        if(shard is not None):
+            partitionShardDict.update({partition : shard})
+    return partitionShardDict
+
+#makeRoutingRanges()
+#turns {partition : shard} into [[range start, shard]], one range for every run of partitions on the same shard
+#this is what nodes send each other
+def makeRoutingRanges(partitionShardDict):
+    ranges = []
+    for partition in range(numPartitions):
+        shard = partitionShardDict.get(partition)
+        if(len(ranges) == 0 or ranges[-1][1] != shard):
+            ranges.append([getPartitionStart(partition), shard])
+    return ranges
+
+#makeRoutingTable()
+#turns [[range start, shard]] into a routing table
+def makeRoutingTable(ranges):
+    starts = []
+    shards = []
+    for start, shard in ranges:
+        starts.append(start)
+        shards.append(shard)
+    return (starts, shards)
+
+#lookupRoutingPoint()
+#finds the shard of the range a point of the hash space is in, in O(log ranges)
+#returns None if the table is empty
+def lookupRoutingPoint(point, table):
+    starts, shards = table
+    index = bisect.bisect_right(starts, point) - 1
+    if(index < 0):
+        return None
+    return shards[index]
+
+#lookupRoutingTable()
+#finds the shard a key belongs to in a routing table (range mode)
+def lookupRoutingTable(key, table):
+    return lookupRoutingPoint(hashKey(key), table)
+
+#getViewVersion()
+#identifies the current view, every node that has the same view gets the same version
+#clients that route by themselves send it back in the X-View-Version header
+def getViewVersion():
+    if(placementMode == "range"):
+        #the same view can have different routing tables, depending on the views before it
+        return str(hashKey(",".join(nodeAddressDict.values()) + "|" + str(replFactor) + "|" + str(routingTable)))
+    return str(hashKey(",".join(nodeAddressDict.values()) + "|" + str(replFactor)))
+
+#belongsHere()
+#checks if a key belongs to our shard, or at least not to another shard that we know of
+#gossip shouldn't bring back keys that moved to another shard
+def belongsHere(key):
+    shard = getKeyShard(key)
+    return (shard is None or shard == selfShardID)
+
+#merkleListener()
+#KeyStore listener that keeps the merkle tree up to date
+def merkleListener(key, oldTime, hadValue, newTime, hasValue):
+    with merkleLock:
+        if(hadValue):
+            updateMerkleLeaf(key, oldTime) #take the old version out of the tree
+        if(hasValue):
+            updateMerkleLeaf(key, newTime)
+
+#changeLogListener()
+#KeyStore listener that gives every write a sequence number in the change log
+def changeLogListener(key, oldTime, hadValue, newTime, hasValue):
+    if(hasValue):
+        logChange(key)
+
+#logChange()
+#gives a write the next sequence number, and moves its key to the end of changeLog
+#changeLog only keeps the latest sequence number of each key, and at most changeLogSize keys
+def logChange(key):
+    global changeSeq, changeLogFloor #global keyword so we know these aren't local variables
+    with changeLogLock:
+        changeSeq += 1
+        changeLog[key] = changeSeq
+        changeLog.move_to_end(key)
+        if(len(changeLog) > changeLogSize):
+            #peers that haven't seen this write yet can't catch up from the log anymore
+            evictedKey, changeLogFloor = changeLog.popitem(last=False)
+
+#getMerkleLeafIndex()
+#the merkle leaf a key belongs to, leaves split the hash space into 2^merkleDepth equal ranges
+def getMerkleLeafIndex(key):
+    return hashKey(key) >> (64 - merkleDepth)
+
+#updateMerkleLeaf()
+#adds or removes one (key, time) version from its merkle leaf
+#a leaf's hash is the xor of its versions' hashes, so adding and removing are the same operation
+#should be called with merkleLock held
+def updateMerkleLeaf(key, keyTime):
+    if(keyTime is None):
+        keyTime = 0 #easier to handle than (None) time
+    leafIndex = getMerkleLeafIndex(key)
+    merkleLeaves[leafIndex] ^= hashKey(key + "|" + json.dumps(keyTime))
+    leafKeys = merkleLeafKeys[leafIndex]
+    if(key in leafKeys):
+        leafKeys.discard(key)
+    else:
+        leafKeys.add(key)
+
+#buildMerkleLevels()
+#builds every level of the merkle tree from the leaves
+#level 0 is the root, level merkleDepth is the leaves, node i of a level has children 2i and 2i+1
+#returns a list of levels, each a list of hashes
+def buildMerkleLevels():
+    with merkleLock:
+        levels = [list(merkleLeaves)]
+    while(len(levels[0]) > 1):
+        below = levels[0]
+        above = []
+        for i in range(0, len(below), 2):
+            above.append(below[i] ^ below[i + 1])
+        levels.insert(0, above)
+    return levels
+
+#getMerkleEntries()
+#gets every key we hold in the given merkle leaves
+#returns {key : [time, value]}
+def getMerkleEntries(leafIndexes):
+    keys = []
+    with merkleLock:
+        for leafIndex in leafIndexes:
+            keys.extend(merkleLeafKeys[leafIndex])
+    entries = {}
+    for key in keys:
+        value, keyTime = kvStore.getVersion(key)
+        if(value is None):
+            continue #dropped since
+        if(keyTime is None):
+            keyTime = 0
+        entries.update({key : [keyTime, value]})
+    return entries
+
+#antiEntropy()
+#syncs our values with one replica using the merkle tree
+#compares root hashes first, then walks down (merkleStep levels per request) only where the hashes differ,
+#then swaps the keys of the leaves that differ, both ways
+#if nothing changed, this is one small request
+#returns the number of keys exchanged
+def antiEntropy(address):
+    levels = buildMerkleLevels()
+    level = 0
+    indexes = [0]
+    while True:
+        baseUrl = ('http://' + address + '/kvs/merkle')
+        r = peerPut(baseUrl, json={'level' : level, 'indexes' : indexes})
+        theirHashes = r.json().get('hashes')
+        differing = []
+        for index, theirHash in zip(indexes, theirHashes):
+            if(levels[level][index] != theirHash):
+                differing.append(index)
+        if(len(differing) == 0):
+            return 0 #in sync
+        if(level == merkleDepth):
+            break #differing is a list of leaves
+        #go down to the children of the nodes that differ
+        nextLevel = min(level + merkleStep, merkleDepth)
+        shift = nextLevel - level
+        indexes = []
+        for index in differing:
+            for child in range(index << shift, (index + 1) << shift):
+                indexes.append(child)
+        level = nextLevel
+
+    #send our versions of the differing leaves, get back theirs that are newer or that we don't have
+    entries = getMerkleEntries(differing)
+    baseUrl = ('http://' + address + '/kvs/merkle-sync')
+    r = peerPut(baseUrl, json={'leaves' : differing, 'entries' : entries})
+    theirEntries = r.json().get('entries')
+    for key, keyInfoArray in theirEntries.items():
+        if(belongsHere(key)):
+            kvStore.applyIfNewer(key, keyInfoArray[1], keyInfoArray[0])
+    return len(entries) + len(theirEntries)
+
+#syncReplica()
+#brings one replica up to date with our writes
+#normally only sends the keys written since the last change the replica acknowledged (its cursor)
+#falls back to merkle anti-entropy if the replica is new to us, fell out of the change log, or fullSync is set
+#the replica's cursor is also how far it has all our writes, see getLocalStable()
+def syncReplica(address, fullSync):
+    cursor = peerCursors.get(address)
+    if(fullSync or cursor is None or cursor < changeLogFloor):
+        with changeLogLock:
+            startSeq = changeSeq
+        gossipStats["keys-anti-entropy"] += antiEntropy(address)
+        gossipStats["full-syncs"] += 1
+        #everything up to startSeq is on the replica now, tell it so it can serve clients that saw those writes
+        peerPut('http://' + address + '/kvs/gossipCheck', json={'gossipDict' : {}, 'address' : selfAddress, 'seq' : startSeq})
+        peerCursors.update({address : startSeq})
+        return
+
+    #walk the change log backwards until we reach what the replica already has
+    changedKeys = []
+    with changeLogLock:
+        latestSeq = changeSeq
+        for key in reversed(changeLog):
+            if(changeLog[key] <= cursor):
+                break
+            changedKeys.append(key)
+    if(latestSeq == cursor):
+        return #nothing new
+    gossipDict = {}
+    for key in changedKeys:
+        value, keyTime = kvStore.getVersion(key)
+        if(value is None):
+            continue #moved to another shard since
+        if(keyTime is None):
+            keyTime = 0 #easier to handle than (None) time
+        gossipDict.update({key : [keyTime, value]})
+    baseUrl = ('http://' + address + '/kvs/gossipCheck')
+    r = peerPut(baseUrl, json={'gossipDict' : gossipDict, 'address' : selfAddress, 'seq' : latestSeq})
+    if(r.status_code == 200):
+        peerCursors.update({address : latestSeq})
+        gossipStats["keys-incremental"] += len(gossipDict)
+
+#getLocalStable()
+#the change log sequence number up to which every other replica of our shard has all our writes (their lowest cursor)
+#None if a replica hasn't acknowledged anything yet
+def getLocalStable():
+    stable = None
+    otherReplicas = 0
+    for address in shardAddressesDict.get(selfShardID, []):
+        if(address == selfAddress):
+            continue
+        otherReplicas += 1
+        cursor = peerCursors.get(address)
+        if(cursor is None):
+            return None
+        if(stable is None or cursor < stable):
+            stable = cursor
+    if(otherReplicas == 0):
+        return changeSeq #we are the only copy
+    return stable
+
+#getStableSeqs()
+#for every node, the sequence number up to which the other replicas of its shard have all of its change log
+#(what the node last reported, ours is computed), returns {address : sequence number}
+#timestamps can't be used for this: a write stamped by another shard's node can arrive after newer ones
+def getStableSeqs():
+    stableSeqs = {}
+    for address, reported in list(stableReports.items()):
+        if(isinstance(reported, int)):
+            stableSeqs.update({address : reported})
+    local = getLocalStable()
+    if(local is not None):
+        stableSeqs.update({selfAddress : local})
+    return stableSeqs
+
+#makeKeyInfo()
+#a context entry for the version of key we hold: [timestamp, shard, our address, sequence number]
+#the sequence number is where that version (or a newer one) is in our change log, see isKeyInfoStable()
+#keyTime must be read before calling this, so the sequence number can't be older than the version
+#seq can be given if the caller already read it, see getLogSeqs()
+def makeKeyInfo(key, keyTime, shard, seq=None):
+    if(seq is None):
+        with changeLogLock:
+            seq = changeLog.get(key, changeLogFloor) #keys evicted from the log were written at or before the floor
+    return [keyTime, shard, selfAddress, seq]
+
+#getLogSeqs()
+#the change log sequence number of every one of keys, as {key : seq}, read under one hold of changeLogLock
+def getLogSeqs(keys):
+    seqs = {}
+    with changeLogLock:
+        for key in keys:
+            seqs[key] = changeLog.get(key, changeLogFloor)
+    return seqs
+
+#isKeyInfoStable()
+#checks if every replica of the entry's shard has the version it names (or a newer one),
+#because they all have the change log of the node that made it past its sequence number
+#entries made before any replica stored the write (a node forwarding a PUT) never are
+def isKeyInfoStable(keyInfo, stableSeqs):
+    if(len(keyInfo) <= seqSlot):
+        return False
+    stable = stableSeqs.get(keyInfo[originSlot])
+    return (stable is not None and isinstance(keyInfo[seqSlot], int) and keyInfo[seqSlot] <= stable)
+
+#collectCausalContext()
+#drops the entries of a context that every replica of their shard already has,
+#then the oldest entries if the context is still longer than causalContextMax
+#should be called on every context we give back to a client
+def collectCausalContext(theirCausalContext):
+    stableSeqs = getStableSeqs()
+    entryTimes = []
+    for name, entry in list(theirCausalContext.items()):
+        entryTime = entry
+        if(isinstance(entry, list)):
+            entryTime = entry[timestampSlot]
+            if(isKeyInfoStable(entry, stableSeqs)):
+                theirCausalContext.pop(name)
+                contextStats["gc-dropped"] += 1
+                continue
+        #vector mode entries are <address: sequence number>, stable once the node's shard has its log that far
+        elif(isinstance(entry, int) and stableSeqs.get(name) is not None and entry <= stableSeqs.get(name)):
+            theirCausalContext.pop(name)
+            contextStats["gc-dropped"] += 1
+            continue
+        if(not isinstance(entryTime, int)):
+            continue
+        entryTimes.append([entryTime, name])
+    if(causalContextMax > 0 and len(theirCausalContext) > causalContextMax):
+        entryTimes.sort()
+        for entryTime, name in entryTimes[:len(theirCausalContext) - causalContextMax]:
+            theirCausalContext.pop(name)
+            contextStats["capped"] += 1
+    contextStats["responses"] += 1
+    contextStats["total-entries"] += len(theirCausalContext)
+
+#getDirectoryDigest()
+#hash of a whole {key : [shard, shardTime]} directory, so nodes can tell if their directories match without sending them
+def getDirectoryDigest(keyShardItems):
+    digest = 0
+    for key, entry in keyShardItems.items():
+        digest ^= hashKey(key + "|" + str(entry[0]) + "|" + str(entry[1]))
+    return digest
+
 #getLocalKeyCount()
-#gets the local keycount by getting the length of localKvsDict
-#returns the amount of keys in localKvsDict
+#gets the local keycount from kvStore
+#returns the amount of keys this shard holds
 def getLocalKeyCount():
-    count = 0
-    for key, shard in keyShardDict.items():
-        if shard == selfShardID:
-            count += 1
-    return count
+    #in hash and range mode there is no key directory, every key we store belongs to our shard
+    if(placementMode != "directory"):
+        return kvStore.countValues()
+    return kvStore.countShard(selfShardID)
+
+#hybrid logical clock
+#every write timestamp is one int: <physical ms (41 bits)><logical counter (12 bits)><node id (10 bits)>
+#so comparing two timestamps with < compares (physical, logical, node) in that order,
+#and timestamps stay plain ints everywhere they are stored or sent
+#hlcClock is the <physical><logical> part of the newest timestamp we've made or seen
+hlcLogicalBits = 12
+hlcNodeBits = 10
+
+#hlcNow()
+#returns a new timestamp, newer than every timestamp we've made or seen
+#if the wall clock hasn't moved past hlcClock, the logical counter goes up instead
+#(a full counter carries into the physical part)
+def hlcNow():
+    global hlcClock #global keyword so we know this isn't a local variable
+    wallClock = (time.time_ns() // 1000000) << hlcLogicalBits
+    with hlcLock:
+        hlcClock = max(wallClock, hlcClock + 1)
+        return (hlcClock << hlcNodeBits) | hlcNodeID
+
+#hlcUpdate()
+#moves our clock up to a timestamp from another node, so our next write is ordered after it
+#timestamps too far ahead of our wall clock are ignored, so one bad clock can't drag everyone along
+def hlcUpdate(theirTime):
+    global hlcClock #global keyword so we know this isn't a local variable
+    if(not isinstance(theirTime, int)):
+        return
+    theirClock = theirTime >> hlcNodeBits
+    maxClock = ((time.time_ns() // 1000000) + hlcMaxDrift) << hlcLogicalBits
+    if(theirClock > maxClock):
+        return
+    with hlcLock:
+        if(theirClock > hlcClock):
+            hlcClock = theirClock
+
+#hlcUnpack()
+#splits a timestamp into [physical ms, logical counter, node id]
+def hlcUnpack(keyTime):
+    node = keyTime & ((1 << hlcNodeBits) - 1)
+    logical = (keyTime >> hlcNodeBits) & ((1 << hlcLogicalBits) - 1)
+    physical = keyTime >> (hlcNodeBits + hlcLogicalBits)
+    return [physical, logical, node]
+
+#hlcListener()
+#KeyStore listener that moves our clock past every timestamp we store (gossip, pulls, bulk-ingest)
+def hlcListener(key, oldTime, hadValue, newTime, hasValue):
+    hlcUpdate(newTime)
+
+#observeCausalContext()
+#moves our clock past every timestamp in the client's context,
+#so a write after a read is ordered after what was read, whichever node takes it
+def observeCausalContext(theirCausalContext):
+    if(theirCausalContext is None):
+        return
+    newest = None
+    for name, entry in theirCausalContext.items():
+        if(isinstance(entry, list)):
+            entry = entry[timestampSlot]
+        elif(name != clockName):
+            continue #vector mode sequence numbers aren't timestamps
+        if(isinstance(entry, int) and (newest is None or newest < entry)):
+            newest = entry
+    if(newest is not None):
+        hlcUpdate(newest)
+
+#getVersionVector()
+#what we hold, as a vector mode context: how far we have the change log of every replica of our shard
+#(all of our own), and our clock, so a client's next write is ordered after what it read here
+def getVersionVector():
+    with changeLogLock:
+        vector = {selfAddress : changeSeq}
+    with vectorLock:
+        for address in shardAddressesDict.get(selfShardID, []):
+            if(address != selfAddress and receivedSeqs.get(address) is not None):
+                vector.update({address : receivedSeqs.get(address)})
+    with hlcLock:
+        vector.update({clockName : hlcClock << hlcNodeBits})
+    return vector
+
+#noteReceivedSeq()
+#remembers that we have every change in a replica's change log up to seq, see syncReplica()
+def noteReceivedSeq(address, seq):
+    with vectorLock:
+        if(receivedSeqs.get(address) is None or receivedSeqs.get(address) < seq):
+            receivedSeqs.update({address : seq})
+
+#foldCausalContext()
+#turns the per-key entries of a context (<key: [timestamp, shard, origin, sequence number]>)
+#into how far the client has seen each node's change log (<address: sequence number>) and the newest time it has seen,
+#so a context only grows with the number of nodes, not with the number of keys
+def foldCausalContext(theirCausalContext):
+    for name, entry in list(theirCausalContext.items()):
+        if(isinstance(entry, list)):
+            theirCausalContext.pop(name)
+            mergeVector(theirCausalContext, {clockName : entry[timestampSlot]})
+            #placeholders like "no shard", and entries of a node forwarding a PUT, aren't in any change log
+            if(len(entry) > seqSlot and isinstance(entry[originSlot], str)):
+                mergeVector(theirCausalContext, {entry[originSlot] : entry[seqSlot]})
+
+#mergeVector()
+#keeps the larger number of every entry, from both vectors, in theirVector
+def mergeVector(theirVector, ourVector):
+    for name, ourSeq in ourVector.items():
+        theirSeq = theirVector.get(name)
+        if(not isinstance(ourSeq, int)):
+            continue
+        if(theirSeq is None or not isinstance(theirSeq, int) or theirSeq < ourSeq):
+            theirVector.update({name : ourSeq})
+
+#isBehindContext()
+#checks if the client has seen a change in the log of one of our shard's replicas that hasn't reached us yet
+#if so, the key they want may be stale here
+#pulledVector is what the replicas that answered a pull of the key had (see pullKeyFrom()), a change they had is covered too
+def isBehindContext(theirCausalContext, pulledVector=None):
+    for address in shardAddressesDict.get(selfShardID, []):
+        theirSeq = theirCausalContext.get(address)
+        if(address == selfAddress or not isinstance(theirSeq, int)):
+            continue #our own log always has everything we've shown anyone
+        with vectorLock:
+            ourSeq = receivedSeqs.get(address)
+        if(pulledVector is not None):
+            pulledSeq = pulledVector.get(address)
+            if(isinstance(pulledSeq, int) and (ourSeq is None or ourSeq < pulledSeq)):
+                ourSeq = pulledSeq
+        if(ourSeq is None or ourSeq < theirSeq):
+            return True
+    return False
+
+#pullKey()
+#asks the other replicas of our shard for their version of key, and keeps the newest one
+#returns what pullKeyFrom() does, or {} if we are the only copy
+def pullKey(key):
+    addresses = []
+    for address in shardAddressesDict.get(selfShardID):
+        if(address != selfAddress):
+            addresses.append(address)
+    if(len(addresses) == 0):
+        return {} #we are the only copy, there is nobody to be behind
+    return pullKeyFrom(key, addresses)
+
+#pullKeyFrom()
+#asks every one of addresses for their version of key at once, and keeps the newest one
+#returns the version vectors of the nodes that answered merged together, so the caller can check
+#the version we kept covers what the client has seen (see isBehindContext()), or None if we couldn't reach any of them
+def pullKeyFrom(key, addresses):
+    timeoutVal = peerTimeoutBudget / 2 #replicas run in parallel, so each one can have the whole cushion
+    futures = []
+    for address in addresses:
+        futures.append(fanOutExecutor.submit(peerPut, 'http://' + address + '/kvs/getKeyWithContext/' + key, timeout=timeoutVal))
+    pulledVector = None
+    for future in futures:
+        try:
+            r = future.result()
+            answer = r.json()
+        except:
+            continue #node is down
+        if(r.status_code != 200):
+            continue
+        if(pulledVector is None):
+            pulledVector = {}
+        mergeVector(pulledVector, answer.get("vector", {}))
+        #a node that moved the key away, or never had it, only has its time left or nothing
+        if(answer.get("value") is not None):
+            kvStore.applyIfNewer(key, answer.get("value"), answer.get("time"))
+    return pulledVector
+
+#pullKeyOnce()
+#single-flight pullKey(): if a pull of key is already running, waits for it and shares its result
+#so a hot key going stale costs one round of replica calls, not one per reader
+#every reader checks the shared result against its own context
+def pullKeyOnce(key):
+    with inflightLock:
+        flight = inflightPulls.get(key)
+        leader = (flight is None)
+        if(leader):
+            flight = [threading.Event(), None] #[done, result]
+            inflightPulls.update({key : flight})
+    if(leader == False):
+        pullStats["coalesced"] += 1
+        flight[0].wait(peerTimeoutBudget)
+        return flight[1]
+    pullStats["pulls"] += 1
+    try:
+        flight[1] = pullKey(key)
+    finally:
+        with inflightLock:
+            inflightPulls.pop(key, None)
+        flight[0].set()
+    return flight[1]
 
 #updateCausalContext()
 #updates the client's context to have any updated times that we have
 #should be called before we return a causal context to the client
 #so we know they are up to date   
-def updateCausalContext(localKeyTimeDict, theirCausalContext):
+def updateCausalContext(localStore, theirCausalContext):
+    #vector mode: the context is one sequence number per node, merge ours in
+    if(causalContextMode == "vector"):
+        if(theirCausalContext is not None):
+            foldCausalContext(theirCausalContext)
+            mergeVector(theirCausalContext, getVersionVector())
+            collectCausalContext(theirCausalContext)
+        return
     if(theirCausalContext is not None):
-        for key, time in localKeyTimeDict.items():
+        stableSeqs = getStableSeqs()
+        timeItems = localStore.timeItems()
+        #every time is read before the sequence numbers, like makeKeyInfo() needs
+        logSeqs = getLogSeqs([key for key, ourTime in timeItems])
+        for key, ourTime in timeItems:
             theirKeyInfo = theirCausalContext.get(key)
             theirTime = None
             if(theirKeyInfo is not None):
                 theirTime = theirKeyInfo[timestampSlot]
-            ourTime = localKeyTimeDict.get(key)
-            thisKeysShard = keyShardDict.get(key)
+            keyInfo = makeKeyInfo(key, ourTime, getKeyShard(key), logSeqs.get(key))
+            #every replica has this version, the client doesn't need to carry it (or anything older)
+            if(isKeyInfoStable(keyInfo, stableSeqs)):
+                if(theirTime is not None and theirTime <= ourTime):
+                    theirCausalContext.pop(key)
+                    contextStats["gc-dropped"] += 1
+                continue
             #they have no time for this key
             if(theirTime is None):
-                keyInfo = [ourTime, thisKeysShard]
                 theirCausalContext.update({key : keyInfo})
             #they have a time, we don't have a time
             elif(ourTime is None):
                 pass
             #they have a time, we have a time, and ours is better
             elif(theirTime < ourTime):
-                keyInfo = [ourTime, thisKeysShard]
+                theirCausalContext.update({key : keyInfo})
+            #same version, but theirs was made by a node forwarding the PUT, so it can't become stable
+            elif(theirTime == ourTime and len(theirKeyInfo) <= seqSlot):
                 theirCausalContext.update({key : keyInfo})
             #they have a time, we have a time, and ours is worse
             else:
                 pass
+        collectCausalContext(theirCausalContext)
     #theirCausalContext is None
     else:
         #fill their causalContext with our values
         newDict = {}
-        for key, time in localKeyTimeDict.items():
-            keyInfo = [time, keyShardDict.get(time)]
+        for key, time in localStore.timeItems():
+            keyInfo = [time, getKeyShard(key)]
             newDict.update({key : keyInfo})
         theirCausalContext = newDict.copy()
             
 
 #updateLatestContext()
-#updates our latestTimeDict if the client's context knows there is newer value
-#should update our latestTimeDict every time we get a request
+#updates our latest times in kvStore if the client's context knows there is newer value
+#should update our latest times every time we get a request
 #(shouldn't matter for external PUT, but still updates our knowledge)
 #before we return a value in GET, we should check-
 #-if our stored value's time is as good as the latest one we know exists
 #note: this doesn't update our stored value, only lets us know if we're stale
-def updateLatestContext(localLatestTimeDict, theirCausalContext):
+def updateLatestContext(localStore, theirCausalContext):
+    #vector mode has no per-key times, staleness is checked against the shard's time instead
+    if(causalContextMode == "vector"):
+        return
     if(theirCausalContext is not None):
+        stableSeqs = getStableSeqs()
         for key, keyInfo in theirCausalContext.items():
             theirTime = keyInfo[timestampSlot]
-            ourLatestTime = localLatestTimeDict.get(key)
-            #we have no time
-            if(ourLatestTime is None):
-                localLatestTimeDict.update({key : theirTime})
-            #we have a time, and it is less than theirs
-            elif(ourLatestTime < theirTime):
-                localLatestTimeDict.update({key : theirTime})
-            #we have a time, and it is the same or better than theirs
-            else:
-                pass
+            #every replica has this version already, nothing to be stale about
+            if(isKeyInfoStable(keyInfo, stableSeqs)):
+                continue
+            #keeps theirs if we have no time, or it is newer than ours
+            localStore.noteLatest(key, theirTime)
 
 
 #isRequestValidToShard
@@ -165,15 +1564,15 @@ def isRequestValidToShard(key):
 #getKeyWithContext
 #used to get a key/value pair from a node, with a timestamp for context
 @app.route('/kvs/getKeyWithContext/<string:key>', methods = ['PUT'])
+#the version vector is read before the key, so the version we send has at least every change it lists
 def getKeyWithContext(key):
-    ourTime = keyTimeDict.get(key)
-    if(ourTime is None):
-        return "No context", 204
-    else:
-        return jsonify(
-            value=localKvsDict.get(key),
-            time=ourTime
-        ), 200
+    vector = getVersionVector()
+    value, ourTime = kvStore.getVersion(key)
+    return jsonify(
+        value=value,
+        time=ourTime,
+        vector=vector
+    ), 200
 
 
 #behavior for /kvs/keys
@@ -184,13 +1583,32 @@ def kvs(key):
     #if client has causal context, make sure we know
     try:
         clientCausalContext = request.get_json().get('causal-context')
-        updateLatestContext(latestTimeDict, clientCausalContext)
+        observeCausalContext(clientCausalContext)
+        updateLatestContext(kvStore, clientCausalContext)
     except:
         pass #no causal context, no update
 
     #decide whether we're working locally or remotely.
     #find out who the key belongs to
-    whichShard = keyShardDict.get(key)
+    whichShard = getKeyShard(key)
+
+    #clients that route by themselves send the view version they routed with (see kvsclient.py)
+    #instead of forwarding their request, tell them which shard has the key, so the next one goes straight there
+    if(request.headers.get('X-View-Version') is not None and whichShard is not None and whichShard != selfShardID):
+        causalContextDict = None
+        try:
+            causalContextDict = request.get_json().get('causal-context')
+        except:
+            pass
+        jsonDict = {
+            "error" : "Wrong shard",
+            "message" : "Error in " + request.method,
+            "shard-id" : whichShard,
+            "replicas" : shardAddressesDict.get(whichShard),
+            "view-version" : getViewVersion(),
+            "causal-context" : causalContextDict
+        }
+        return jsonDict, 421
     #if not on this shard
     if(whichShard != selfShardID):
 
@@ -208,7 +1626,7 @@ def kvs(key):
                     causalContextDict = {"first get" : retArray}
 
                 #update the causalContext before giving it back to the client
-                updateCausalContext(keyTimeDict, causalContextDict)
+                updateCausalContext(kvStore, causalContextDict)
 
                 jsonDict = {
                     "doesExist" : False,
@@ -220,48 +1638,77 @@ def kvs(key):
             #key/value pair DOES exist somewhere else:
             #get the list of addresses of the shard with the key-value pair
             correctKeyAddresses = shardAddressesDict.get(whichShard)
-            #until we get a response, try getting the value from each node on the shard
-            for address in correctKeyAddresses:
-                #get the url of the address and endpoint
-                baseUrl = ('http://' + address + '/kvs/keys/' + key)
-                #send GET to correct URL
-                timeoutVal = 4 / len(correctKeyAddresses)
-                r = None
-                value = None
+            #ask the replicas with hedging: if one is slow or down, another one is asked after the hedge delay
+            quorum = min(readQuorum, len(correctKeyAddresses))
+            timeoutVal = peerTimeoutBudget / 2 #replicas run in parallel, so each one can have the whole cushion
+            #in vector mode the replicas check the client's context themselves, so they need to see it
+            forwardDict = None
+            if(causalContextMode == "vector"):
                 try:
-                    r = requests.get(baseUrl, timeout=timeoutVal) #timeout is generous because we want a response
-                    #retrieve value, if r exists
-                    value = r.json().get('value')              
+                    forwardDict = {"causal-context" : request.get_json().get("causal-context")}
                 except:
-                    #except means node is down, but there's nothing we can do
-                    #besides try another node, so we pass
                     pass
+            answers, notFoundCount = hedgedGet(correctKeyAddresses, '/kvs/keys/' + key, timeoutVal, quorum, forwardDict)
+            #stays True if every node we reached says the key does not exist
+            notFound = None
+            if(notFoundCount > 0 and len(answers) == 0):
+                notFound = True
+            #pick the answer with the highest timestamp, replicas send the time of the version they have in "time"
+            value = None
+            address = None
+            bestTime = None
+            bestContext = None
+            for answerAddress, r in answers:
+                try:
+                    answerValue = r.json().get('value')
+                    answerTime = r.json().get('time')
+                    answerContext = r.json().get('causal-context')
+                except:
+                    continue #not a valid answer
+                if(answerValue is None):
+                    continue
+                if(value is None or (isinstance(answerTime, int) and (bestTime is None or bestTime < answerTime))):
+                    value = answerValue
+                    address = answerAddress
+                    bestTime = answerTime
+                    bestContext = answerContext
+
+            #if we got back a value
+            if value is not None:
+                #no error-- must return valid response
+                causalContextDict = None
+                if(request.get_json() is not None):
+                    causalContextDict = request.get_json().get("causal-context")
+                if(causalContextDict is None):
+                    #No causal context, put something in here so we have no errors
+                    now = time.time_ns()
+                    retArray = [now, "no shard"]
+                    causalContextDict = {"first get" : retArray}
 
-                #if r is not None and we got back a value
-                if value is not None:
-                    #no error-- must return valid response
-                    causalContextDict = None
-                    if(request.get_json() is not None):
-                        causalContextDict = request.get_json().get("causal-context")
-                    if(causalContextDict is None):
-                        #No causal context, put something in here so we have no errors
-                        now = time.time_ns()
-                        retArray = [now, "no shard"]
-                        causalContextDict = {"first get" : retArray}
+                if(not isinstance(bestContext, dict)):
+                    bestContext = {}
+                #in vector mode, what the replica had seen when it answered
+                if(causalContextMode == "vector"):
+                    foldCausalContext(causalContextDict)
+                    mergeVector(causalContextDict, bestContext)
+                #the client now knows the version it read
+                elif(isinstance(bestContext.get(key), list)):
+                    causalContextDict.update({key : bestContext.get(key)})
 
-                    #update the causalContext before giving it back to the client
-                    updateCausalContext(keyTimeDict, causalContextDict)
+                #update the causalContext before giving it back to the client
+                updateCausalContext(kvStore, causalContextDict)
 
-                    jsonDict = {
-                        "doesExist" : True,
-                        "message" : "Retrieved successfully",
-                        "value" : value,
-                        "address" : address,
-                        "causal-context" : causalContextDict
-                    }
-                    return jsonDict, 200
-                    #should end execution
+                jsonDict = {
+                    "doesExist" : True,
+                    "message" : "Retrieved successfully",
+                    "value" : value,
+                    "address" : address,
+                    "causal-context" : causalContextDict
+                }
+                return jsonDict, 200
+                #should end execution
             #if no node is reachable, send a fail message
+            causalContextDict = None
             if(request.get_json() is not None):
                 causalContextDict = request.get_json().get("causal-context")
             if(causalContextDict is None):
@@ -271,7 +1718,17 @@ def kvs(key):
                 causalContextDict = {"first get" : retArray}
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
+
+            #every node that answered said the key does not exist (hash mode always knows the shard)
+            if(notFound == True):
+                jsonDict = {
+                    "doesExist" : False,
+                    "error" : "Key does not exist",
+                    "message" : "Error in GET",
+                    "causal-context" : causalContextDict
+                }
+                return jsonDict, 404
 
             jsonDict = {
                 "error" : "Unable to satisfy request",
@@ -287,8 +1744,8 @@ def kvs(key):
             if(whichShard is None):
                 #decide which shard to put this new key
                 whichShard = decideShard()
-                #get the list of addresses for the shard we will put it in
-                correctKeyAddresses = shardAddressesDict.get(whichShard)
+                #get the list of addresses for the shard we will put it in, the ones that are up first
+                correctKeyAddresses = orderReplicas(shardAddressesDict.get(whichShard))
 
                 isRequestGood = None
                 #forward the request, and ask nodes on shard to check if its valid or not before modifying keyShard
@@ -296,7 +1753,7 @@ def kvs(key):
                     if isRequestGood == True:
                         break
                     else:
-                        timeoutVal = 4 / (len(correctKeyAddresses) * 2)
+                        timeoutVal = peerTimeoutBudget / (len(correctKeyAddresses) * 2)
                         #print(timeoutVal, file=sys.stderr)
                         baseUrl = ('http://' + address + '/kvs/isRequestValidToShard/' + key)
                         try:
@@ -306,9 +1763,9 @@ def kvs(key):
                                 if(request.get_json() is not None):
                                     value = request.get_json().get('value')
                                 if(value is None):
-                                    r = requests.put(baseUrl, timeout=timeoutVal)
+                                    r = peerPut(baseUrl, timeout=timeoutVal)
                                 else:
-                                    r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'value' : request.get_json().get('value')}, timeout=timeoutVal)
+                                    r = peerPut(baseUrl, headers={"Content-Type": "application/json"}, json={'value' : request.get_json().get('value')}, timeout=timeoutVal)
                                 #timeout is generous because we want a response
                                 isRequestGood = r.json().get('isRequestGood')
                             except:
@@ -328,7 +1785,7 @@ def kvs(key):
                                     causalContextDict = {"first put" : retArray}
 
                                 #update the causalContext before giving it back to the client
-                                updateCausalContext(keyTimeDict, causalContextDict)
+                                updateCausalContext(kvStore, causalContextDict)
 
                                 jsonDict ={
                                     "message": r.json().get("message"),
@@ -352,7 +1809,7 @@ def kvs(key):
                         causalContextDict = {"first get" : retArray}
 
                     #update the causalContext before giving it back to the client
-                    updateCausalContext(keyTimeDict, causalContextDict)
+                    updateCausalContext(kvStore, causalContextDict)
 
                     jsonDict = {
                         "error" : "Unable to satisfy request",
@@ -362,8 +1819,9 @@ def kvs(key):
                     return jsonDict, 503
 
                 #if it hits here, the request is confirmed valid and we can continue as normal
-                #tell ourselves where this key belongs
-                keyShardDict.update({key:whichShard})
+                #tell ourselves where this key belongs, the time lets a later move (hot-key migration) win over this
+                placedTime = hlcNow()
+                kvStore.setShard(key, whichShard, placedTime)
                 #broadcast that the chosen node now contains this key
                 for shard, addresses in shardAddressesDict.items():
                     for address in addresses:
@@ -371,7 +1829,7 @@ def kvs(key):
                         baseUrl = ('http://' + address + '/kvs/updateKey')
                         #tell everyone <shard> contains <key>
                         try:
-                            r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'shard' : whichShard, 'key' : key}, timeout=0.000001)
+                            r = peerPut(baseUrl, headers={"Content-Type": "application/json"}, json={'shard' : whichShard, 'key' : key, 'time' : placedTime}, timeout=0.000001)
                             #set timeout to effective 0, because we don't care about response
                         except:
                             pass
@@ -387,6 +1845,7 @@ def kvs(key):
             correctKeyAddresses = shardAddressesDict.get(whichShard)
             #send to all the nodes on the shard
             statusCode = None
+            statusBody = None
             successAddress = None
             causalContextDict = None
             now = None
@@ -395,47 +1854,53 @@ def kvs(key):
             except:
                 pass
             if(now is None):
-                now = time.time_ns()
+                now = hlcNow()
 
-            for address in correctKeyAddresses:
-                baseUrl = ('http://' + address + '/kvs/keys/' + key)
-                timeoutVal = 4 / (len(correctKeyAddresses) * 2)
+            #build the request once, every replica gets the same time and context
+            myjsonDict = None
+            try:
+                if(request.get_json() is not None):
+                    myjsonDict = request.get_json()
+                    causalContextDict = request.get_json().get("causal-context")
+            except:
+                pass
+            if(myjsonDict is None):
+                myjsonDict = {}
+            if(causalContextDict is None):
+                causalContextDict = {}
+            myjsonDict.update({'time' : now})
+
+            keyInfo = [now, whichShard]
+            causalContextDict.update({key : keyInfo})
+
+            #update the causalContext before sending requests
+            updateCausalContext(kvStore, causalContextDict)
+
+            myjsonDict.update({"causal-context": causalContextDict})
+
+            #send to every replica at once, answer the client once writeQuorum of them acknowledged
+            #the slower replicas finish in the background, so they don't add to our latency
+            quorum = min(writeQuorum, len(correctKeyAddresses))
+            timeoutVal = peerTimeoutBudget / 2 #replicas run in parallel, so each one can have the whole cushion
+            #replicas we can't reach get the write later, see queueHint()
+            value = myjsonDict.get('value')
+            answers = fanOutPut(correctKeyAddresses, '/kvs/keys/' + key, myjsonDict, timeoutVal, quorum, lambda address: queueHint(address, key, value, now))
+            #a replica on a newer view than ours didn't take the write (see checkViewEpoch()), we catch up meanwhile
+            answers = [[address, r] for address, r in answers if r.status_code != 409]
+            for address, r in answers:
                 try:
-                    myjsonDict = None
-                    try:
-                        if(request.get_json() is not None):
-                            myjsonDict = request.get_json()
-                            causalContextDict = request.get_json().get("causal-context")
-                            myjsonDict.update({'time' : now})
-                    except:
-                        pass
-                    if(causalContextDict is None):
-                        causalContextDict = {}
-
-                    keyInfo = [now, whichShard]
-                    causalContextDict.update({key : keyInfo})
-                    if(myjsonDict is None):
-                        myjsonDict = {}
-                        myjsonDict.update({'time' : now})
-                    
-                    #update the causalContext before sending requests
-                    updateCausalContext(keyTimeDict, causalContextDict)
-
-                    myjsonDict.update({"causal-context": causalContextDict})
-                    #print("myjsonDict: %s"%(str(myjsonDict)), file=sys.stderr)
-                    r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json=myjsonDict, timeout=timeoutVal)
-
-                    causalContextDict = r.json().get("causal-context")
-                    #timeout is generous because we want a response
                     if statusCode is None:
+                        statusBody = r.json()
                         statusCode = r.status_code
                         successAddress = address
+                        causalContextDict = statusBody.get("causal-context")
                 except:
                     print("Error:", file=sys.stderr)
                     print(str(sys.exc_info()[0]), file=sys.stderr)
                     pass
 
-            if causalContextDict is None:
+            #not enough replicas acknowledged the write
+            if(statusCode is None or len(answers) < quorum):
                 try:
                     if(request.get_json() is not None):
                         causalContextDict = request.get_json().get("causal-context")
@@ -454,7 +1919,7 @@ def kvs(key):
                     causalContextDict = {"first get" : retArray} 
 
                 #update the causalContext before giving it back to the client
-                updateCausalContext(keyTimeDict, causalContextDict)
+                updateCausalContext(kvStore, causalContextDict)
 
                 jsonDict = {
                     "error" : "Unable to satisfy request",
@@ -471,7 +1936,7 @@ def kvs(key):
                     #and contained in causalContextString
 
                     #update the causalContext before giving it back to the client
-                    updateCausalContext(keyTimeDict, causalContextDict)
+                    updateCausalContext(kvStore, causalContextDict)
 
                     jsonDict = {
                         "message" : "Added successfully",
@@ -482,7 +1947,7 @@ def kvs(key):
                 if(statusCode == 200):
 
                     #update the causalContext before giving it back to the client
-                    updateCausalContext(keyTimeDict, causalContextDict)
+                    updateCausalContext(kvStore, causalContextDict)
 
                     jsonDict = {
                         "message" : "Updated successfully",
@@ -490,13 +1955,23 @@ def kvs(key):
                         "causal-context" : causalContextDict
                     }
                     return jsonDict, 200
+            #the shard rejected the request (no value, or key too long)
+            #only reachable in hash mode, directory mode validates before choosing a shard
+            if(statusCode == 400):
+                jsonDict = {
+                        "message" : statusBody.get("message"),
+                        "error" : statusBody.get("error"),
+                        "address" : successAddress,
+                        "causal-context" : causalContextDict
+                    }
+                return jsonDict, 400
             #if PUT is non-local
             #if created
-            if(r.status_code == 201):
+            if(statusCode == 201):
                 #return response with added address
 
                 #update the causalContext before giving it back to the client
-                updateCausalContext(keyTimeDict, causalContextDict)
+                updateCausalContext(kvStore, causalContextDict)
 
                 jsonDict = {
                         "message" : "Added successfully",
@@ -506,12 +1981,12 @@ def kvs(key):
                     }
                 return jsonDict, 201
             #if updated
-            if(r.status_code == 200):
+            if(statusCode == 200):
                 #Even though it's not on spec, IP is added because Aleck told us to here:
                 # https://cse138-fall20.slack.com/archives/C01C01HF58S/p1605068093044400?thread_ts=1605067981.043200&cid=C01C01HF58S
 
                 #update the causalContext before giving it back to the client
-                updateCausalContext(keyTimeDict, causalContextDict)
+                updateCausalContext(kvStore, causalContextDict)
 
                 jsonDict = {
                         "message" : "Updated successfully",
@@ -524,11 +1999,59 @@ def kvs(key):
         #if(request.method == 'DELETE'):
 
     #else: work locally
+    #counted towards our load when the request is done (see recordLoad())
+    g.localKey = key
 
     #local handling of GET
     if(request.method == 'GET'):
+        #a key that is still on its way here from its old shard is read from there
+        pullFromOldOwner(key)
+        #vector mode: the client's context has one time per shard, so the check is O(shards)
+        if(causalContextMode == "vector"):
+            causalContextDict = None
+            try:
+                causalContextDict = request.get_json().get("causal-context")
+            except:
+                pass
+            if(causalContextDict is None):
+                causalContextDict = {}
+            foldCausalContext(causalContextDict)
+
+            #the client has seen a write to our shard that we don't have, get the key from the other replicas
+            if(isBehindContext(causalContextDict)):
+                pulledVector = pullKeyOnce(key)
+                if(pulledVector is None or isBehindContext(causalContextDict, pulledVector)):
+                    #nobody that answered had the write the client has seen, we can't tell if our value is stale
+                    updateCausalContext(kvStore, causalContextDict)
+                    jsonDict = {
+                        "error" : "Unable to satisfy request",
+                        "message" : "Error in GET",
+                        "causal-context" : causalContextDict
+                    }
+                    return jsonDict, 503
+
+            value, ourTime = kvStore.getVersion(key)
+            #update the causalContext before giving it back to the client
+            updateCausalContext(kvStore, causalContextDict)
+            if(value is None):
+                jsonDict = {
+                    "doesExist" : False,
+                    "error" : "Key does not exist",
+                    "message" : "Error in GET",
+                    "causal-context" : causalContextDict
+                }
+                return jsonDict, 404
+            jsonDict = {
+                "doesExist" : True,
+                "message" : "Retrieved successfully",
+                "value" : value,
+                "time" : ourTime,
+                "causal-context" : causalContextDict
+            }
+            return jsonDict, 200
+
         #check if value exists
-        if(localKvsDict.get(key) is None):
+        if(kvStore.getValue(key) is None):
             #causal context does not need updated
             causalContextDict = None
             if(request.get_json() is not None):
@@ -540,7 +2063,7 @@ def kvs(key):
                 causalContextDict = {"first get" : retArray}
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "doesExist" : False,
@@ -553,7 +2076,7 @@ def kvs(key):
         #value exists
         #check if our version is outdated, by comparing against the causal-context from client
         #get local timestamp
-        ourTime = keyTimeDict.get(key)
+        ourTime = kvStore.getTime(key)
         data = None
         #get causal context's timestamp
         if(request.get_json() is not None):
@@ -576,8 +2099,8 @@ def kvs(key):
         #if they have context, and ours is the same or better
         if((theirTime is not None and ourTime is not None) and (ourTime >= theirTime)):
             #check if our value is outdated from the latest context we've seen
-            if(latestTimeDict.get(key) is not None):
-                if(latestTimeDict.get(key) > ourTime):
+            if(kvStore.getLatest(key) is not None):
+                if(kvStore.getLatest(key) > ourTime):
                     #if they have causal context:
                     causalContextDict = None
                     try:
@@ -586,7 +2109,7 @@ def kvs(key):
                         pass
 
                     #update the causalContext before giving it back to the client
-                    updateCausalContext(keyTimeDict, causalContextDict)
+                    updateCausalContext(kvStore, causalContextDict)
 
                     jsonDict = {
                         "error" : "Unable to satisfy request",
@@ -597,26 +2120,27 @@ def kvs(key):
 
 
             #give the client our value
-            value = localKvsDict.get(key)
+            value = kvStore.getValue(key)
             #update the causal context to have our time
-            keyInfo = [ourTime, selfShardID]
+            keyInfo = makeKeyInfo(key, ourTime, selfShardID)
             causalContextDict.update({key: keyInfo})
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "doesExist" : True,
                 "message" : "Retrieved successfully",
                 "value" : value,
+                "time" : ourTime,
                 "causal-context" : causalContextDict
             }
             return jsonDict, 200
         #else if client context is None
         elif(theirTime is None):
             #check if our value is outdated from the latest context we've seen
-            if(latestTimeDict.get(key) is not None):
-                if(latestTimeDict.get(key) > ourTime):
+            if(kvStore.getLatest(key) is not None):
+                if(kvStore.getLatest(key) > ourTime):
                     #if they have causal context:
                     causalContextDict = None
                     try:
@@ -625,7 +2149,7 @@ def kvs(key):
                         pass
 
                     #update the causalContext before giving it back to the client
-                    updateCausalContext(keyTimeDict, causalContextDict)
+                    updateCausalContext(kvStore, causalContextDict)
 
                     jsonDict = {
                         "error" : "Unable to satisfy request",
@@ -635,62 +2159,45 @@ def kvs(key):
                     return jsonDict, 400
 
             #give the client our local value
-            value = localKvsDict.get(key)
-            keyInfo = [ourTime, selfShardID]
+            value = kvStore.getValue(key)
+            keyInfo = makeKeyInfo(key, ourTime, selfShardID)
             causalContextDict = {}
             causalContextDict.update({key: keyInfo})
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "doesExist" : True,
                 "message" : "Retrieved successfully",
                 "value" : value,
+                "time" : ourTime,
                 "causal-context" : causalContextDict
             }
             return jsonDict, 200
         #else: client has a context and it's more up-to-date than ours, or we are None and they are not
         else:
             #try to retrieve the updated value from the other members of our shard
-            addresses = shardAddressesDict.get(selfShardID)
-            updatedVal = None
-            for address in addresses:
-                baseUrl = ('http://' + address + '/kvs/getKeyWithContext/' + key)
-                timeoutVal = 4 / len(addresses)
-                try:
-                    r = requests.put(baseUrl, timeout=timeoutVal)
-                    theirTime = r.json().get("time")
-                    if(theirTime > ourTime):
-                        ourTime = theirTime
-                        updatedVal = r.json().get("value")
-                except:
-                    pass
-            #update our local values
-            #overwrite the local time with the correct time (even if it's the same time)
-            #keyTimeDict.update({key : ourTime})
-
-            #if the updated time (ourTime) is still worse than the best time we've seen, set-
-            #-updatedVal to None so it passes through to the NACK branch
-            if(latestTimeDict.get(key) is not None):
-                #print("latestTimeDict.get(%s): %s"%(str(key), str(latestTimeDict.get(key))), file=sys.stderr)
-                if(latestTimeDict.get(key) > ourTime):
-                    updatedVal = None
-                    #print("updatedVal reset to None", file=sys.stderr)
+            #concurrent stale GETs of the same key share one pull, which asks every replica at once
+            #the newest version any of them has is stored locally
+            pullKeyOnce(key)
+            ourTime = kvStore.getTime(key)
+
+            #still worse than the version the client has seen, or the best time we've seen
+            updated = (ourTime is not None and ourTime >= theirTime)
+            if(kvStore.getLatest(key) is not None and ourTime is not None):
+                #print("latestTimeDict.get(%s): %s"%(str(key), str(kvStore.getLatest(key))), file=sys.stderr)
+                if(kvStore.getLatest(key) > ourTime):
+                    updated = False
             #else: the updated value is the most up-to-date value we know exists
 
-            #update our value, if their value is newer
-            if(updatedVal is not None):
-                #print("updating localKvsDict for key (GET): %s value: %s"%(str(key), str(updatedVal)), file=sys.stderr)
-                localKvsDict.update({key : updatedVal})
-                keyTimeDict.update({key : ourTime})
-            #no updatedVal, we couldn't contact anyone; NACK
-            else:
+            #nobody had the version the client has seen; NACK
+            if(updated == False):
                 #no error checking, they are confirmed to have had causal context at this point
                 causalContextDict = request.get_json().get("causal-context")
 
                 #update the causalContext before giving it back to the client
-                updateCausalContext(keyTimeDict, causalContextDict)
+                updateCausalContext(kvStore, causalContextDict)
 
                 jsonDict = {
                     "error" : "Unable to satisfy request",
@@ -700,18 +2207,19 @@ def kvs(key):
                 return jsonDict, 400
             #return the correct value, with an updated causal-context
             #print("we think we got an updatedValue: %s"%str(updatedValue), file=sys.stderr)
-            keyInfo = [ourTime, selfShardID]
+            keyInfo = makeKeyInfo(key, ourTime, selfShardID)
             #update our causal-context obj
             causalContextDict = request.get_json().get("causal-context")
             causalContextDict.update({key: keyInfo})
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "message" : "Retrieved successfully",
                 "doesExist" : True,
-                "value" : localKvsDict.get(key),
+                "value" : kvStore.getValue(key),
+                "time" : ourTime,
                 "causal-context" : causalContextDict
             }
             return jsonDict, 200
@@ -746,7 +2254,7 @@ def kvs(key):
                 causalContextDict = {"first get" : retArray}
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "error" : "Value is missing",
@@ -767,7 +2275,7 @@ def kvs(key):
                 causalContextDict = {"first get" : retArray}
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "error" : "Key is too long",
@@ -781,44 +2289,28 @@ def kvs(key):
         created = False
 
         #does value already exist?
-        val = localKvsDict.get(key)
+        val = kvStore.getValue(key)
         if(val is not None):
             updated = True
         else:
             created = True
 
-        if(updated == True):
-            #if client attaches 'time' (internal requests)
-            theirTime = None
-            ourTime = None
-            try:
-                theirTime = request.get_json().get('time')
-                ourTime = keyTimeDict.get(key)
-            except:
-                pass
-            if(theirTime is not None):
-                #this is an internal request
-                if(ourTime is None):
-                    pass #they have time, we don't. Should never happen
-                else: #we both have time
-                    if(theirTime < ourTime): #our time is better
-                        #failed internal request, update nothing
-                        return jsonify(message="**internal request with outdated value, doing nothing**"), 200
-                    #else: #their time is better, listen to them
-
-
-        
         #passes the no value check
         value = request.get_json().get('value')
-        #print("updating localKvsDict for key (PUT): %s value: %s"%(str(key), str(value)), file=sys.stderr)
-        localKvsDict.update({key : value})
         #update our local time for that variable
         #now = datetime.datetime.now()
         now = None
+        #if client attaches 'time' (internal requests)
         now = request.get_json().get('time')
         if(now is None):
-            now = time.time_ns()
-        keyTimeDict.update({key : now})
+            now = hlcNow()
+            kvStore.store(key, value, now)
+        #this is an internal request, only listen to them if their time is better (checked and stored atomically)
+        elif(kvStore.applyIfNewer(key, value, now) == False):
+            if(kvStore.getTime(key) != now): #our time is better
+                #failed internal request, update nothing
+                return jsonify(message="**internal request with outdated value, doing nothing**"), 200
+            #else: we already have this exact write
         #passes the no json body check
         #update the context
         causalContextDict = request.get_json().get('causal-context')
@@ -827,12 +2319,12 @@ def kvs(key):
             retArray = [now, "no shard"]
             causalContextDict = {"first put" : retArray}
 
-        keyInfo = [now, selfShardID]
+        keyInfo = makeKeyInfo(key, now, selfShardID)
         causalContextDict.update({key : keyInfo})
         if(created == True):
 
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "message" : "Added successfully",
@@ -842,7 +2334,7 @@ def kvs(key):
             return jsonDict, 201
         else:
             #update the causalContext before giving it back to the client
-            updateCausalContext(keyTimeDict, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
 
             jsonDict = {
                 "message" : "Updated successfully",
@@ -860,14 +2352,383 @@ def kvs(key):
     #----------------------------------
 
 
+#mergeCausalContext()
+#adds the entries of otherCausalContext to theirCausalContext, keeping the newer time of entries both have
+#(for the same time, the entry that says where the version is in a change log, see makeKeyInfo())
+def mergeCausalContext(theirCausalContext, otherCausalContext):
+    for name, entry in otherCausalContext.items():
+        ours = theirCausalContext.get(name)
+        if(isinstance(entry, list)):
+            if(not isinstance(ours, list) or ours[timestampSlot] < entry[timestampSlot] or (ours[timestampSlot] == entry[timestampSlot] and len(ours) < len(entry))):
+                theirCausalContext.update({name : entry})
+        elif(isinstance(entry, int)):
+            if(not isinstance(ours, int) or ours < entry):
+                theirCausalContext.update({name : entry})
+
+#checkBatchValue()
+#returns the error for a key/value pair that can't be stored, or None if it's valid
+def checkBatchValue(key, value):
+    if(value is None):
+        return "Value is missing"
+    if(len(key) > 50):
+        return "Key is too long"
+    return None
+
+#writeBatchLocally()
+#stores a sub-batch of a /kvs/batch PUT, every key with the coordinator's time
+#returns {key : {"status"}} and adds the written versions to causalContextDict
+def writeBatchLocally(keyValueDict, now, causalContextDict):
+    results = {}
+    for key, value in keyValueDict.items():
+        error = checkBatchValue(key, value)
+        if(error is not None):
+            results.update({key : {"status" : 400, "error" : error}})
+            continue
+        created = (kvStore.hasValue(key) == False)
+        kvStore.applyIfNewer(key, value, now)
+        loadCounters["ops"] += 1
+        causalContextDict.update({key : makeKeyInfo(key, now, selfShardID)})
+        if(created):
+            results.update({key : {"status" : 201}})
+        else:
+            results.update({key : {"status" : 200}})
+    return results
+
+#readBatchLocally()
+#reads a sub-batch of a /kvs/batch GET, from keys of our shard
+#stale keys are pulled from the other replicas first, all at once
+#returns {key : {"status", "value"}} and adds the read versions to causalContextDict
+def readBatchLocally(keys, causalContextDict):
+    staleKeys = []
+    if(causalContextMode == "vector"):
+        foldCausalContext(causalContextDict)
+        if(isBehindContext(causalContextDict)):
+            staleKeys = list(keys)
+    else:
+        for key in keys:
+            ourTime = kvStore.getTime(key)
+            theirTime = None
+            keyInfo = causalContextDict.get(key)
+            if(isinstance(keyInfo, list)):
+                theirTime = keyInfo[timestampSlot]
+            latest = kvStore.getLatest(key)
+            if(theirTime is not None and (ourTime is None or ourTime < theirTime)):
+                staleKeys.append(key)
+            elif(latest is not None and ourTime is not None and ourTime < latest):
+                staleKeys.append(key)
+
+    #pull every stale key at once, each one is a single-flight pull
+    pulledDict = {}
+    futureKeyDict = {}
+    for key in staleKeys:
+        futureKeyDict.update({batchExecutor.submit(pullKeyOnce, key) : key})
+    for future in concurrent.futures.as_completed(futureKeyDict):
+        try:
+            pulledDict.update({futureKeyDict.get(future) : future.result()})
+        except:
+            pulledDict.update({futureKeyDict.get(future) : None})
+
+    results = {}
+    loadCounters["ops"] += len(keys)
+    for key in keys:
+        value, ourTime = kvStore.getVersion(key)
+        stillStale = False
+        staleStatus = 400
+        if(causalContextMode == "vector" and key in pulledDict):
+            #like a vector mode GET, no replica that answered had what the client has seen
+            pulledVector = pulledDict.get(key)
+            stillStale = (pulledVector is None or isBehindContext(causalContextDict, pulledVector))
+            staleStatus = 503
+        elif(key in pulledDict):
+            keyInfo = causalContextDict.get(key)
+            if(isinstance(keyInfo, list) and (ourTime is None or ourTime < keyInfo[timestampSlot])):
+                stillStale = True
+            latest = kvStore.getLatest(key)
+            if(latest is not None and ourTime is not None and ourTime < latest):
+                stillStale = True
+        if(stillStale):
+            results.update({key : {"status" : staleStatus, "error" : "Unable to satisfy request"}})
+        elif(value is None):
+            results.update({key : {"status" : 404, "error" : "Key does not exist"}})
+        else:
+            results.update({key : {"status" : 200, "value" : value}})
+            causalContextDict.update({key : makeKeyInfo(key, ourTime, selfShardID)})
+    return results
+
+#sendBatchPut()
+#writes a sub-batch to every replica of a shard, like a non-local PUT does for one key
+#returns [results, causal context] from the first replica that answered, or [None, None] without a write quorum
+def sendBatchPut(shard, keyValueDict, newKeyShardDict, now, causalContextDict):
+    addresses = shardAddressesDict.get(shard)
+    quorum = min(writeQuorum, len(addresses))
+    timeoutVal = peerTimeoutBudget / 2 #replicas run in parallel, so each one can have the whole cushion
+    jsonDict = {"keys" : keyValueDict, "keyShardDict" : newKeyShardDict, "time" : now, "causal-context" : causalContextDict}
+    #replicas we can't reach get the writes later, see queueHint()
+    def queueHints(address):
+        for key, value in keyValueDict.items():
+            queueHint(address, key, value, now)
+    answers = fanOutPut(addresses, '/kvs/batch', jsonDict, timeoutVal, quorum, queueHints)
+    for address, r in answers:
+        try:
+            if(r.status_code == 200 and len(answers) >= quorum):
+                return [r.json().get("results"), r.json().get("causal-context")]
+        except:
+            pass
+    return [None, None]
+
+#sendBatchGet()
+#reads a sub-batch from the replicas of a shard, hedged like a non-local GET
+#returns [results, causal context] from the first replica that answered, or [None, None] if none did
+def sendBatchGet(shard, keys, causalContextDict):
+    addresses = shardAddressesDict.get(shard)
+    quorum = min(readQuorum, len(addresses))
+    timeoutVal = peerTimeoutBudget / 2 #replicas run in parallel, so each one can have the whole cushion
+    jsonDict = {"keys" : keys, "forwarded" : True, "causal-context" : causalContextDict}
+    answers, notFoundCount = hedgedGet(addresses, '/kvs/batch', timeoutVal, quorum, jsonDict)
+    for address, r in answers:
+        try:
+            return [r.json().get("results"), r.json().get("causal-context")]
+        except:
+            pass
+    return [None, None]
+
+
+#behavior for /kvs/batch
+#GET expects {"keys": [key], "causal-context"}, PUT expects {"keys": {key: value}, "causal-context"}
+#keys are grouped by shard, and every shard gets one sub-batch, all sent at once
+#answers with {"results": {key: {"status", "value" or "error"}}} and one merged causal context
+@app.route('/kvs/batch', methods = ['GET', 'PUT'])
+def batch():
+    data = request.get_json()
+    if(data is None or data.get('keys') is None):
+        return jsonify(
+            error="Keys are missing",
+            message="Error in batch"
+        ), 400
+    #PUT needs {key: value}, GET a list of keys
+    keys = data.get('keys')
+    if(request.method == 'PUT'):
+        validKeys = isinstance(keys, dict)
+    else:
+        validKeys = (isinstance(keys, list) and all(isinstance(key, str) for key in keys))
+    if(validKeys == False):
+        return jsonify(
+            error="Keys are malformed",
+            message="Error in batch"
+        ), 400
+    causalContextDict = data.get('causal-context')
+    if(causalContextDict is None):
+        causalContextDict = {}
+    try:
+        observeCausalContext(causalContextDict)
+        updateLatestContext(kvStore, causalContextDict)
+    except:
+        pass #context we can't read, no update
+
+    results = {}
+    shardKeysDict = {}
+    futureShardDict = {}
+
+    if(request.method == 'PUT'):
+        keyValueDict = data.get('keys')
+        now = data.get('time')
+        #sub-batch from a coordinator, every key belongs to our shard
+        if(now is not None):
+            newKeyShardDict = data.get('keyShardDict')
+            if(newKeyShardDict is not None):
+                for key, shard in newKeyShardDict.items():
+                    kvStore.setShardIfNewer(key, shard, now)
+            results = writeBatchLocally(keyValueDict, now, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
+            jsonDict = {
+                "message" : "Batch processed",
+                "results" : results,
+                "causal-context" : causalContextDict
+            }
+            return jsonDict, 200
+
+        #every key of the batch gets the same time
+        now = hlcNow()
+        newKeys = []
+        for key, value in keyValueDict.items():
+            error = checkBatchValue(key, value)
+            if(error is not None):
+                results.update({key : {"status" : 400, "error" : error}})
+                continue
+            whichShard = getKeyShard(key)
+            if(whichShard is None):
+                newKeys.append(key)
+                continue
+            shardKeysDict.setdefault(whichShard, {}).update({key : value})
+        #place all new keys with one round of key-counts, and tell everyone where they went
+        newKeyShardDict = {}
+        if(len(newKeys) > 0):
+            newKeyValueDict = {}
+            for key in newKeys:
+                newKeyValueDict.update({key : keyValueDict.get(key)})
+            newKeyShardDict = decideShards(newKeyValueDict)
+            newKeyShardItems = {}
+            for key, whichShard in newKeyShardDict.items():
+                kvStore.setShard(key, whichShard, now)
+                newKeyShardItems.update({key : [whichShard, now]})
+                shardKeysDict.setdefault(whichShard, {}).update({key : keyValueDict.get(key)})
+            for node, address in nodeAddressDict.items():
+                if(address != selfAddress):
+                    fanOutExecutor.submit(peerPut, 'http://' + address + '/kvs/gossipCheck', json={'keyShardDict' : newKeyShardItems})
+        for whichShard, shardKeyValueDict in shardKeysDict.items():
+            shardNewKeyShardDict = {}
+            for key in shardKeyValueDict:
+                if(key in newKeyShardDict):
+                    shardNewKeyShardDict.update({key : whichShard})
+            future = batchExecutor.submit(sendBatchPut, whichShard, shardKeyValueDict, shardNewKeyShardDict, now, dict(causalContextDict))
+            futureShardDict.update({future : whichShard})
+
+    if(request.method == 'GET'):
+        keys = data.get('keys')
+        #sub-batch from a coordinator, read everything here
+        if(data.get('forwarded') == True):
+            results = readBatchLocally(keys, causalContextDict)
+            updateCausalContext(kvStore, causalContextDict)
+            jsonDict = {
+                "message" : "Batch processed",
+                "results" : results,
+                "causal-context" : causalContextDict
+            }
+            return jsonDict, 200
+
+        for key in keys:
+            whichShard = getKeyShard(key)
+            if(whichShard is None):
+                results.update({key : {"status" : 404, "error" : "Key does not exist"}})
+                continue
+            shardKeysDict.setdefault(whichShard, []).append(key)
+        for whichShard, shardKeys in shardKeysDict.items():
+            if(whichShard == selfShardID):
+                continue #read below, while the other shards answer
+            future = batchExecutor.submit(sendBatchGet, whichShard, shardKeys, dict(causalContextDict))
+            futureShardDict.update({future : whichShard})
+        if(shardKeysDict.get(selfShardID) is not None):
+            localContext = dict(causalContextDict)
+            results.update(readBatchLocally(shardKeysDict.get(selfShardID), localContext))
+            mergeCausalContext(causalContextDict, localContext)
+
+    #merge what every shard answered
+    for future in concurrent.futures.as_completed(futureShardDict):
+        whichShard = futureShardDict.get(future)
+        shardResults = None
+        shardContext = None
+        try:
+            shardResults, shardContext = future.result()
+        except:
+            pass
+        if(shardResults is None):
+            for key in shardKeysDict.get(whichShard):
+                results.update({key : {"status" : 503, "error" : "Unable to satisfy request"}})
+            continue
+        results.update(shardResults)
+        if(shardContext is not None):
+            mergeCausalContext(causalContextDict, shardContext)
+
+    #update the causalContext before giving it back to the client
+    updateCausalContext(kvStore, causalContextDict)
+    jsonDict = {
+        "message" : "Batch processed",
+        "results" : results,
+        "causal-context" : causalContextDict
+    }
+    return jsonDict, 200
+
+
+#handOffKey()
+#sends our copy of a key that moved to another shard to that shard's replicas, then drops it
+#the copy is kept if none of them confirm it
+#reason is passed to /kvs/bulk-ingest ("migration" for hot keys, "rebalance" for view changes)
+def handOffKey(key, value, keyTime, shard, reason):
+    confirmed = False
+    for address in shardAddressesDict.get(shard, []):
+        if(sendBulk(address, [[key, value, keyTime]], reason)):
+            confirmed = True
+    if(confirmed and getKeyShard(key) != selfShardID):
+        kvStore.drop(key)
+
+#migrateHotKeys()
+#moves the hottest keys off our shard when it serves more than hotKeyRatio times the average shard's ops/sec
+#only the first replica of a shard does this, so the replicas don't move the same keys at once,
+#and it only knows the hits it served itself, which stand in for the whole shard's
+#(directory mode only, the other modes compute a key's shard)
+def migrateHotKeys():
+    global keyHits #global keyword so we rebind instead of copying
+    hits = keyHits
+    keyHits = collections.Counter()
+    if(placementMode != "directory"):
+        return
+    addresses = shardAddressesDict.get(selfShardID)
+    if(addresses is None or len(addresses) == 0 or addresses[0] != selfAddress):
+        return
+    shardLoads = getShardLoads()
+    if(len(shardLoads) < 2 or shardLoads.get(selfShardID) is None):
+        return
+    averageOps = sum([load["ops-per-sec"] for load in shardLoads.values()]) / len(shardLoads)
+    if(shardLoads.get(selfShardID)["ops-per-sec"] <= hotKeyRatio * averageOps):
+        return
+    #the shard serving the fewest ops/sec takes the keys
+    targetShard = None
+    for shard, load in shardLoads.items():
+        if(shard != selfShardID and (targetShard is None or load["ops-per-sec"] < shardLoads.get(targetShard)["ops-per-sec"])):
+            targetShard = shard
+    #move just enough of the hottest keys to bring us down to the average
+    excessHits = sum(hits.values()) * (1 - averageOps / shardLoads.get(selfShardID)["ops-per-sec"])
+    movedHits = 0
+    records = []
+    for key, count in hits.most_common(hotKeyBatch):
+        if(movedHits >= excessHits):
+            break
+        value, keyTime = kvStore.getVersion(key)
+        if(value is not None and getKeyShard(key) == selfShardID):
+            records.append([key, value, keyTime])
+            movedHits += count
+    if(len(records) == 0):
+        return
+    #copy the keys to the new shard first, so they are never only in flight
+    confirmed = False
+    for address in shardAddressesDict.get(targetShard):
+        if(sendBulk(address, records, "migration")):
+            confirmed = True
+    if(confirmed == False):
+        return
+    #then point everyone's directory at the new shard, our replicas hand over their own copies (see moveKeyShard())
+    #the move is newer than the key's old placement, so nodes that miss this still learn it from directory gossip
+    movedTime = hlcNow()
+    for key, value, keyTime in records:
+        allAddresses = list(nodeAddressDict.values())
+        fanOutPut(allAddresses, '/kvs/updateKey', {'key' : key, 'shard' : targetShard, 'time' : movedTime}, peerTimeout, len(allAddresses))
+    migrationStats["keys-moved"] += len(records)
+    migrationStats["bytes-moved"] += sum([valueSize(value) for key, value, keyTime in records])
+
+
+#moveKeyShard()
+#points key at shard, if shardTime is newer than when its current shard was decided (see KeyStore.setShardIfNewer())
+#if that moves a key we hold off our shard (hot-key migration), our copy is handed to its new shard before it is dropped,
+#so a write only we have isn't lost
+def moveKeyShard(key, shard, shardTime):
+    wasOurs = (kvStore.getShard(key) == selfShardID and kvStore.hasValue(key))
+    if(kvStore.setShardIfNewer(key, shard, shardTime) == False):
+        return
+    if(wasOurs and shard != selfShardID):
+        value, keyTime = kvStore.getVersion(key)
+        if(value is not None):
+            fanOutExecutor.submit(handOffKey, key, value, keyTime, shard, "migration")
+
+
 #behavior for /kvs/updateKey
+#expects {key, shard, time}, time is when the key was placed on (or moved to) shard
 @app.route('/kvs/updateKey', methods = ['PUT'])
 def updateKey():
     #update/add key
     if(request.method == 'PUT'):
         key = request.get_json().get('key')
         shard = request.get_json().get('shard')
-        keyShardDict.update({ key : shard })
+        moveKeyShard(key, shard, request.get_json().get('time'))
         return jsonify(
             message="OK"
         ), 200
@@ -897,8 +2758,15 @@ def getShards():
         for shard, address in shardAddressesDict.items():
            shardList.append(shard)
 
-        return jsonify(message="Shard membership retrieved successfully",
-                        shards=shardList), 200
+        #placement, virtual-nodes (or routing-table) and view-version are what a client needs to route requests by itself (see kvsclient.py)
+        jsonDict = {"message": "Shard membership retrieved successfully",
+                    "shards": shardList,
+                    "placement": placementMode,
+                    "virtual-nodes": virtualNodes,
+                    "view-version": getViewVersion()}
+        if(placementMode == "range"):
+            jsonDict.update({"routing-table" : [[start, shard] for start, shard in zip(*routingTable)]})
+        return jsonDict, 200
 
 
 #behavior for /kvs/shards/<id>
@@ -906,18 +2774,8 @@ def getShards():
 def getShardInfo(id):
     if(request.method == 'GET'):
         replicas = shardAddressesDict[id]
-        count = None
-        for address in replicas:
-            if count is None:
-                timeoutVal = 4 / len(replicas) # (4 / num requests) seconds
-                baseUrl = ('http://' + address + '/kvs/key-count')
-                try:
-                    r = requests.get(baseUrl, timeout=timeoutVal)
-                    count = r.json().get('key-count')
-                except:
-                    pass
-            else:
-                break
+        #answered from the cache if it's fresh, otherwise the first replica to answer gives the count
+        count = getCachedKeyCount(id)
 
         jsonDict = {"message": "Shard information retrieved successfully",
                     "shard-id": id,
@@ -926,127 +2784,589 @@ def getShardInfo(id):
         return jsonDict, 200
 
 
-#behavior for /kvs/updateView
-#expects to receive a view string
-@app.route('/kvs/updateView', methods=['PUT'])
-def updateView():
-    if(request.method == 'PUT'):
-        #read in and parse viewString
-        viewString = request.get_json().get('view')
+#installView()
+#makes a view ours: rebuilds nodeAddressDict, shardAddressesDict, the ring and selfShardID from viewString,
+#and replaces the key directory with keyShardDict, decided at directoryTime (directory mode), or the routing table with routingRanges (range mode)
+#views only move forward, returns False if we already have epoch or a newer one
+def installView(viewString, newReplFactor, keyShardDict, directoryTime, routingRanges, epoch):
+    global replFactor, selfShardID, viewEpoch, routingTable, viewDirectoryTime #global keyword so we know these aren't local variables
+    with viewLock:
+        if(epoch <= viewEpoch):
+            return False
         viewArray = str(viewString).split(',')
+        #keys are on their old shards until they are moved, keep the old layout to find them there
+        if(onlineMigration == "on"):
+            startMigration(epoch)
+        nodeAddressDict.clear()
         shardAddressesDict.clear()
 
+        #a new view means a new rebalance, start counting data movement from zero
+        for stat in rebalanceStats:
+            rebalanceStats[stat] = 0
+        #shard ids can mean different nodes now
+        keyCountTable.clear()
+
         i = 1
         #update nodeAddressDict
         for address in viewArray:
             nodeAddressDict.update({"node" + str(i) : address})
             i += 1
 
-        global replFactor
-        replFactor = request.get_json().get('repl-factor')
+        replFactor = newReplFactor
 
         #reset shardAddressesDict
         numShards = len(nodeAddressDict) // replFactor
         for i in range(numShards):
             shardID = "shard" + str(i + 1)
-            #emptyTempList = []
-            #shardAddressesDict.update({ shardID : emptyTempList})
             shardAddressesDict[shardID] = []
 
         #deterministically allocate nodes to shards in shardAddressesDict
         decideNodeToShard()
+        #shards may have been added or removed, so the ring changes too
+        buildHashRing()
 
-        global selfShardID #global keyword so we know this isn't a local variable
         #update selfShardID
         for shard, addresses in shardAddressesDict.items():
             for address in addresses:
                 if(selfAddress == address):
                     selfShardID = shard
 
-        return "OK", 200
+        #hash mode has no key directory, the ring already decides every key's shard
+        if(placementMode == "directory" and keyShardDict is not None):
+            kvStore.replaceShards(keyShardDict, directoryTime)
+            viewDirectoryTime = directoryTime
+        if(placementMode == "range" and routingRanges is not None):
+            routingTable = makeRoutingTable(routingRanges)
+        viewEpoch = epoch
+    return True
+
+#startMigration()
+#starts tracking the migration to view epoch, called before the view is installed
+#keeps a copy of the layout we are leaving, so keys that haven't moved yet can still be found (see pullFromOldOwner())
+def startMigration(epoch):
+    global oldLayout #global keyword so we rebind instead of mutating, readers never see a half-copied layout
+    oldShardAddressesDict = {}
+    for shard, addresses in shardAddressesDict.items():
+        oldShardAddressesDict.update({shard : list(addresses)})
+    oldKeyShardDict = None
+    if(placementMode == "directory"):
+        oldKeyShardDict = kvStore.shardDict()
+    oldLayout = {"shardAddressesDict" : oldShardAddressesDict, "keyShardDict" : oldKeyShardDict, "hashRing" : hashRing,
+                 "routingTable" : routingTable, "movedKeys" : []}
+    migrationHistory.append({"epoch" : epoch, "started" : time.time(), "finished" : None,
+                             "keys-to-move" : 0, "keys-sent" : 0, "keys-received" : 0,
+                             "fallback-reads" : 0, "fallback-hits" : 0, "forwarded-writes" : 0})
+
+#getMigration()
+#progress of the migration to our current view, or None if it is over
+#a migration is over when the view change says every node moved its keys (/kvs/migration-done),
+#or migrationGrace seconds after it started, in case the node running the view change died
+#only reads, so it is safe to call with a stripe lock held (see migrationListener()), finishMigrations() ends expired ones
+def getMigration():
+    if(len(migrationHistory) == 0):
+        return None
+    migration = migrationHistory[-1]
+    if(migration["epoch"] != viewEpoch or migration["finished"] is not None):
+        return None
+    if(time.time() - migration["started"] > migrationGrace):
+        return None
+    return migration
+
+#finishMigrations()
+#ends the migration to our current view once migrationGrace is over and drops our old copies of the keys that moved,
+#and sends any forwarded writes that are still waiting, runs every second
+def finishMigrations():
+    if(len(migrationHistory) > 0):
+        migration = migrationHistory[-1]
+        if(migration["epoch"] == viewEpoch and migration["finished"] is None and time.time() - migration["started"] > migrationGrace):
+            migration["finished"] = time.time()
+            dropMovedKeys()
+    forwardMovedWrites()
+
+#dropMovedKeys()
+#drops our old copies of the keys we moved to other shards, once the migration is over
+def dropMovedKeys():
+    movedKeys = oldLayout["movedKeys"]
+    oldLayout["movedKeys"] = []
+    for key in movedKeys:
+        if(getKeyShard(key) != selfShardID):
+            kvStore.drop(key)
+
+#getOldKeyShard()
+#the shard a key belonged to before the current migration, or None if we don't know
+def getOldKeyShard(key):
+    if(placementMode == "hash"):
+        points, shards = oldLayout.get("hashRing")
+        if(len(points) == 0):
+            return None
+        index = bisect.bisect_right(points, hashKey(key))
+        if(index == len(points)):
+            index = 0 #wrap around the ring
+        return shards[index]
+    if(placementMode == "range"):
+        return lookupRoutingTable(key, oldLayout.get("routingTable"))
+    return oldLayout.get("keyShardDict").get(key)
+
+#pullFromOldOwner()
+#dual read: while a migration is going on, a key of ours we don't have yet may still be on its old shard,
+#so we ask the old shard's nodes for it and keep it
+def pullFromOldOwner(key):
+    migration = getMigration()
+    if(migration is None or kvStore.hasValue(key)):
+        return
+    oldShard = getOldKeyShard(key)
+    #a node that wasn't in the old view doesn't know the old directory, then any old node may have it
+    oldShards = [oldShard]
+    if(oldShard is None):
+        oldShards = list(oldLayout.get("shardAddressesDict").keys())
+    addresses = []
+    for shard in oldShards:
+        for address in oldLayout.get("shardAddressesDict").get(shard, []):
+            if(address != selfAddress):
+                addresses.append(address)
+    if(len(addresses) == 0):
+        return
+    migration["fallback-reads"] += 1
+    pullKeyFrom(key, addresses)
+    if(kvStore.hasValue(key)):
+        migration["fallback-hits"] += 1
+
+#migrationListener()
+#KeyStore listener for write forwarding: while a migration is going on, a write that lands here
+#for a key that moved to another shard (it raced the view change) is handed to the key's new shard
+def migrationListener(key, oldTime, hadValue, newTime, hasValue):
+    if(hasValue == False):
+        return
+    migration = getMigration()
+    if(migration is None):
+        return
+    shard = getKeyShard(key)
+    if(shard is None or shard == selfShardID):
+        return
+    migration["forwarded-writes"] += 1
+    #we hold the key's stripe lock, so the copy is sent once it is released, see forwardMovedWrites()
+    movedWrites.append([key, shard])
+
+#forwardMovedWrites()
+#hands the keys migrationListener() saw written to their new shards, with the version we have now
+#runs after every request and in finishMigrations(), never with a stripe lock held
+def forwardMovedWrites():
+    while(True):
+        try:
+            key, shard = movedWrites.popleft()
+        except IndexError:
+            return
+        value, keyTime = kvStore.getVersion(key)
+        if(value is not None):
+            fanOutExecutor.submit(handOffKey, key, value, keyTime, shard, "rebalance")
+
+#sendMovedWrites()
+#forwards the writes this request made to keys that moved to another shard, see migrationListener()
+@app.after_request
+def sendMovedWrites(response):
+    if(len(movedWrites) > 0):
+        forwardMovedWrites()
+    return response
+
+#behavior for /kvs/migration-done
+#the view change tells every node that all nodes moved their keys for epoch, expects {epoch}
+@app.route('/kvs/migration-done', methods=['PUT'])
+def finishMigration():
+    if(request.method == 'PUT'):
+        epoch = request.get_json().get('epoch')
+        for migration in migrationHistory:
+            if(migration["epoch"] == epoch and migration["finished"] is None):
+                migration["finished"] = time.time()
+                dropMovedKeys()
+        return jsonify(
+            message="OK"
+        ), 200
+
+#noteViewEpoch()
+#looks at the view epoch a peer answered with, and catches up if the peer has a newer view than ours
+def noteViewEpoch(epochString, address):
+    global highestEpochSeen #global keyword so we know this isn't a local variable
+    try:
+        epoch = int(epochString)
+    except:
+        return #not a node, or an old one
+    if(epoch > highestEpochSeen):
+        highestEpochSeen = epoch
+    if(epoch > viewEpoch and address is not None):
+        fanOutExecutor.submit(catchUpView, address)
+
+#catchUpView()
+#fetches the committed view of a node that is ahead of us, installs it and moves our keys to their new shards
+#one catch-up at a time, the others are dropped (the next message from an up to date node starts another)
+def catchUpView(address):
+    if(catchUpLock.acquire(blocking=False) == False):
+        return
+    try:
+        r = peerGet('http://' + address + '/kvs/view')
+        viewJson = r.json()
+        if(installView(viewJson.get('view'), viewJson.get('repl-factor'), viewJson.get('keyShardDict'), viewJson.get('directory-time'), viewJson.get('routing-table'), viewJson.get('epoch'))):
+            viewStats["catch-ups"] += 1
+            rearrangeKeys()
+    except:
+        pass #node is down, someone else will tell us
+    finally:
+        catchUpLock.release()
+
+#behavior for /kvs/view
+#reports our committed view, for nodes that are catching up
+@app.route('/kvs/view', methods=['GET'])
+def getView():
+    if(request.method == 'GET'):
+        jsonDict = {"message": "View retrieved successfully",
+                    "epoch": viewEpoch,
+                    "view": ",".join(nodeAddressDict.values()),
+                    "repl-factor": replFactor}
+        #entries moved since the view was installed get older times here, directory gossip brings their newer ones
+        if(placementMode == "directory"):
+            jsonDict.update({"keyShardDict" : kvStore.shardDict(), "directory-time" : viewDirectoryTime})
+        if(placementMode == "range"):
+            jsonDict.update({"routing-table" : [[start, shard] for start, shard in zip(*routingTable)]})
+        return jsonDict, 200
+
+#behavior for /kvs/view-prepare
+#first phase of a view change, expects {epoch, coordinator, view, repl-factor, keyShardDict and directory-time, or routing-table}
+#keeps the view until /kvs/view-commit installs it, or /kvs/view-abort drops it
+#answers 409 if we already have, or were asked to prepare, a newer view,
+#or another coordinator's view for the same epoch (two view changes at once: only one can get every node)
+@app.route('/kvs/view-prepare', methods=['PUT'])
+def prepareView():
+    if(request.method == 'PUT'):
+        epoch = request.get_json().get('epoch')
+        coordinator = request.get_json().get('coordinator')
+        with viewLock:
+            prepared = preparedViews.get(epoch)
+            epochTaken = (prepared is not None and prepared.get('coordinator') != coordinator)
+            if(epoch <= viewEpoch or epoch < max(list(preparedViews.keys()) + [0]) or epochTaken):
+                viewStats["stale-rejected"] += 1
+                jsonDict = {"error" : "Stale view epoch",
+                            "message" : "Error in PUT",
+                            "epoch" : max([viewEpoch] + list(preparedViews.keys()))}
+                return jsonDict, 409
+            preparedViews.update({epoch : request.get_json()})
+        return jsonify(
+            message="OK"
+        ), 200
 
+#behavior for /kvs/view-commit
+#second phase of a view change, expects {epoch, coordinator}
+#installs the prepared view, then moves our keys to their new shards before answering,
+#so the coordinator knows the data movement is done when every node has answered
+@app.route('/kvs/view-commit', methods=['PUT'])
+def commitView():
+    if(request.method == 'PUT'):
+        epoch = request.get_json().get('epoch')
+        coordinator = request.get_json().get('coordinator')
+        with viewLock:
+            prepared = preparedViews.get(epoch)
+            if(prepared is not None and prepared.get('coordinator') != coordinator):
+                prepared = None #another coordinator's view, it isn't ours to commit
+            else:
+                preparedViews.pop(epoch, None)
+            #older prepared views can never be committed now
+            for oldEpoch in list(preparedViews.keys()):
+                if(oldEpoch < epoch):
+                    preparedViews.pop(oldEpoch)
+        if(prepared is None and viewEpoch < epoch):
+            jsonDict = {"error" : "Unknown view epoch",
+                        "message" : "Error in PUT"}
+            return jsonDict, 409
+        unconfirmed = 0
+        #we may have caught up to this view already, then the keys moved already too
+        if(prepared is not None and installView(prepared.get('view'), prepared.get('repl-factor'), prepared.get('keyShardDict'), prepared.get('directory-time'), prepared.get('routing-table'), epoch)):
+            unconfirmed = rearrangeKeys()
+        jsonDict = {"message" : "View committed",
+                    "epoch" : epoch,
+                    "keys-unconfirmed" : unconfirmed}
+        return jsonDict, 200
 
-#behavior for /kvs/updateKeyShard
-#expects to receive a json dump of a dictionary
-@app.route('/kvs/updateKeyShard', methods=['PUT'])
-def updateKeyShard():
+#behavior for /kvs/view-abort
+#drops a prepared view that won't be committed, expects {epoch, coordinator}
+#only the coordinator that prepared it can drop it
+@app.route('/kvs/view-abort', methods=['PUT'])
+def abortView():
     if(request.method == 'PUT'):
-        loadedKeyShardDict = request.get_json().get('keyShardDict')
-        global keyShardDict
-        keyShardDict.clear()
-        keyShardDict = loadedKeyShardDict.copy()
-        return "OK", 200
+        epoch = request.get_json().get('epoch')
+        coordinator = request.get_json().get('coordinator')
+        with viewLock:
+            prepared = preparedViews.get(epoch)
+            if(prepared is not None and prepared.get('coordinator') == coordinator):
+                preparedViews.pop(epoch)
+        return jsonify(
+            message="OK"
+        ), 200
+
+#streamRecords()
+#generator that turns a batch of [key, value, time] records into newline-delimited json
+#requests sends a generator body with chunked transfer encoding, so the batch is streamed, not built in memory
+def streamRecords(records):
+    for record in records:
+        yield (json.dumps(record) + "\n").encode('utf-8')
+
+#sendBulk()
+#streams records to one node's /kvs/bulk-ingest, bulkBatchSize records per request, over one connection
+#reason is passed along so the receiver knows why the keys arrived (e.g. "rebalance")
+#returns True if the node confirmed it received every record
+def sendBulk(address, records, reason):
+    baseUrl = ('http://' + address + '/kvs/bulk-ingest?reason=' + reason)
+    #every batch goes over the peer's pooled keep-alive connection
+    for i in range(0, len(records), bulkBatchSize):
+        batch = records[i : i + bulkBatchSize]
+        try:
+            r = peerPut(baseUrl, data=streamRecords(batch), headers={"Content-Type": "application/x-ndjson"}, timeout=bulkTimeout)
+            if(r.json().get('received') != len(batch)):
+                return False
+        except:
+            return False #node is down, or the stream broke
+    return True
 
 #rearrangeKeys: causal context is not necessary for rearranging keys.
 #rearrangeKeys should only be called during a view-change, where causal context
 #   is free to be cleared, according to https://cse138-fall20.slack.com/archives/C01FKJLRZKN/p1606622040051200?thread_ts=1606621491.049500&cid=C01FKJLRZKN
-@app.route('/kvs/rearrangeKeys', methods=['PUT'])
+#keys are grouped by the shard they belong to, and streamed to every node of that shard with /kvs/bulk-ingest
+#keys that leave this shard are only deleted once a node of their new shard confirms it has them
+#returns the number of keys that had to move but nobody confirmed, which we keep
 def rearrangeKeys():
-    if(request.method == 'PUT'):
-        localKvsDictCopy = localKvsDict.copy()
-        timeoutVal = 0.000001 #3 / (len(localKvsDictCopy) * replFactor) # 3 seconds divided by the possible number of requests to send
-        #loop through copy of localKvsDict
-        for key, value in localKvsDictCopy.items():
-            #get the shard the key:value is supposed to be on
-            correctShardID = keyShardDict.get(key)
-            #get all the addresses of that shard
-            addressList = shardAddressesDict.get(correctShardID)
-            #if not the local shard: send to correct places then delete
-            if (selfShardID != correctShardID):
-                for address in addressList:
-                    baseUrl = ('http://' + address + '/kvs/keys/' + key)
-                    try:
-                        localtime = keyTimeDict.get(key)
-                        if(localtime is None): #set time to 0
-                            r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'key' : key, 'value' : value, 'time' : 0}, timeout=timeoutVal)
-                            #timeout is set to effective 0 because we don't care about the response
-                        else:
-                            r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'key' : key, 'value' : value, 'time' : localtime}, timeout=timeoutVal)
-                    except:
-                        pass
-                try:
-                    del localKvsDict[key]
-                except:
-                    pass
-            #else, if it is the local shard, send to everyone else on this shard
+    unconfirmed = 0
+    migration = getMigration()
+    #copy of every value we hold, safe to loop over while requests keep writing
+    #{shard : [[key, value, time]]} of every key we hold, grouped by the shard it belongs to
+    shardRecordsDict = {}
+    #loop through copy of our values
+    for key, value, localtime in kvStore.valueItems():
+        #get the shard the key:value is supposed to be on
+        correctShardID = getKeyShard(key)
+        if(localtime is None): #set time to 0
+            localtime = 0
+        records = shardRecordsDict.get(correctShardID)
+        if(records is None):
+            records = []
+            shardRecordsDict.update({correctShardID : records})
+        records.append([key, value, localtime])
+        #if not the local shard, it will have to move
+        if (selfShardID != correctShardID):
+            rebalanceStats["keys-planned"] += 1
+            rebalanceStats["bytes-planned"] += valueSize(value)
+            if(migration is not None):
+                migration["keys-to-move"] += 1
+
+    for shard, records in shardRecordsDict.items():
+        #get all the addresses of that shard
+        addressList = shardAddressesDict.get(shard)
+        if(addressList is None):
+            continue #shard does not exist, nowhere to send it
+        #send to every node on the shard (besides us)
+        confirmed = False
+        for address in addressList:
+            if(address == selfAddress):
+                continue
+            if(sendBulk(address, records, "rebalance") == True):
+                confirmed = True
+        #if not the local shard, delete once the new shard has the keys
+        #if nobody confirmed, keep them so the data isn't lost
+        if(selfShardID != shard and confirmed == True):
+            #during an online migration the old copies stay until every node moved its keys,
+            #for reads that were routed here before the view changed (see dropMovedKeys())
+            if(migration is None):
+                for record in records:
+                    kvStore.drop(record[0])
             else:
-                for address in addressList:
-                    baseUrl = ('http://' + address + '/kvs/keys/' + key)
-                    try:
-                        localtime = keyTimeDict.get(key)
-                        if(localtime is None): #set time to 0
-                            r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'key' : key, 'value' : value, 'time' : 0}, timeout=timeoutVal)
-                            #timeout is set to effective 0 because we don't care about the response
-                        else:
-                            r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'key' : key, 'value' : value, 'time' : localtime}, timeout=timeoutVal)
-                    except:
-                        pass
-                #don't delete from local
+                migration["keys-sent"] += len(records)
+                for record in records:
+                    oldLayout["movedKeys"].append(record[0])
+        elif(selfShardID != shard):
+            unconfirmed += len(records)
+
+    return unconfirmed
+
+#hinted handoff
+#a replica write that doesn't get through is kept as a hint for that replica: {address : {key : [value, time]}}
+#a key only keeps its newest hint, and each replica at most hintLimit of them (the oldest go first,
+#anti-entropy still brings those over eventually)
+#once the failure detector sees the replica up again, its hints are replayed through /kvs/bulk-ingest (see replayHints())
+#with a DATA_DIR the hints are saved there too, so they survive a restart
+
+#queueHint()
+#keeps a write that couldn't be sent to address, for replaying later
+#(invalid writes are skipped, like the replica would)
+def queueHint(address, key, value, keyTime):
+    if(hintedHandoff != "on" or address == selfAddress):
+        return
+    if(checkBatchValue(key, value) is not None):
+        return #the replica would have turned it down anyway
+    global hintsDirty #global keyword so we know this isn't a local variable
+    with hintLock:
+        hints = hintQueues.get(address)
+        if(hints is None):
+            hints = collections.OrderedDict()
+            hintQueues.update({address : hints})
+        oldHint = hints.get(key)
+        if(oldHint is not None and oldHint[1] >= keyTime):
+            return #we already have this write or a newer one for them
+        hints.pop(key, None)
+        hints.update({key : [value, keyTime]})
+        hintStats["queued"] += 1
+        hintsDirty = True
+        while(len(hints) > hintLimit):
+            hints.popitem(last=False)
+            hintStats["dropped"] += 1
+
+#replayHints()
+#replays the hints of every replica the failure detector thinks is up, a replica at a time
+def replayHints():
+    for address in list(hintQueues.keys()):
+        if(len(hintQueues.get(address)) > 0 and isSuspected(address) == False and address not in replayingHints):
+            replayingHints.add(address)
+            fanOutExecutor.submit(replayHintsTo, address)
+    if(dataDir is not None and hintsDirty):
+        saveHints()
+
+#replayHintsTo()
+#sends address its hints, hintBatchSize at a time, and forgets every hint it confirmed
+#a hint whose key no longer belongs to address's shard (after a view change) is dropped instead
+def replayHintsTo(address):
+    global hintsDirty #global keyword so we know this isn't a local variable
+    try:
+        while(True):
+            records = []
+            with hintLock:
+                hints = hintQueues.get(address, {})
+                for key, hint in list(hints.items()):
+                    if(address not in shardAddressesDict.get(getKeyShard(key), [])):
+                        hints.pop(key)
+                        hintStats["dropped"] += 1
+                        continue
+                    records.append([key, hint[0], hint[1]])
+                    if(len(records) >= hintBatchSize):
+                        break
+            if(len(records) == 0 or sendBulk(address, records, "hint") == False):
+                return
+            with hintLock:
+                hints = hintQueues.get(address, {})
+                for key, value, keyTime in records:
+                    #a newer hint may have come in while we were sending
+                    if(hints.get(key) is not None and hints.get(key)[1] == keyTime):
+                        hints.pop(key)
+                        hintStats["replayed"] += 1
+                hintsDirty = True
+    finally:
+        replayingHints.discard(address)
+
+#saveHints()
+#writes every hint to DATA_DIR, replacing the last copy in one step
+def saveHints():
+    global hintsDirty #global keyword so we know this isn't a local variable
+    with hintLock:
+        hintsDirty = False
+        hintsDict = {}
+        for address, hints in hintQueues.items():
+            hintsDict.update({address : [[key, hint[0], hint[1]] for key, hint in hints.items()]})
+    path = os.path.join(dataDir, 'hints.json')
+    with open(path + '.tmp', 'w') as hintsFile:
+        json.dump(hintsDict, hintsFile)
+    os.replace(path + '.tmp', path)
+
+#loadHints()
+#reads the hints saved in DATA_DIR before a restart
+def loadHints():
+    path = os.path.join(dataDir, 'hints.json')
+    if(os.path.exists(path) == False):
+        return
+    try:
+        with open(path) as hintsFile:
+            hintsDict = json.load(hintsFile)
+    except:
+        return #torn file, anti-entropy still repairs what it had
+    for address, records in hintsDict.items():
+        for key, value, keyTime in records:
+            queueHint(address, key, value, keyTime)
+
+#getHintStats()
+#hinted handoff counters and the hints waiting for every replica, for /kvs/metrics
+def getHintStats():
+    statsDict = dict(hintStats)
+    pendingDict = {}
+    for address, hints in list(hintQueues.items()):
+        pendingDict.update({address : len(hints)})
+    statsDict.update({"pending" : pendingDict})
+    return statsDict
+
+#behavior for /kvs/bulk-ingest
+#expects a stream of newline-delimited json records: [key, value, time]
+#applies each record with last-writer-wins against our timestamps, so old copies never overwrite newer values
+@app.route('/kvs/bulk-ingest', methods=['PUT'])
+def bulkIngest():
+    if(request.method == 'PUT'):
+        reason = request.args.get('reason')
+        received = 0
+        applied = 0
+        #read the body as it arrives, instead of loading the whole batch
+        for line in request.stream:
+            line = line.strip()
+            if(len(line) == 0):
+                continue
+            key, value, theirTime = json.loads(line)
+            received += 1
+            isNewKey = (kvStore.getValue(key) is None)
+            #keeps ours if we have a newer time, or already have this exact version
+            if(kvStore.applyIfNewer(key, value, theirTime) == False):
+                continue
+            #a key that arrived here because of a view change counts towards the data moved
+            if(reason == "rebalance" and isNewKey):
+                rebalanceStats["keys-received"] += 1
+                rebalanceStats["bytes-received"] += valueSize(value)
+                migration = getMigration()
+                if(migration is not None):
+                    migration["keys-received"] += 1
+            if(reason == "migration" and isNewKey):
+                migrationStats["keys-received"] += 1
+            if(reason == "hint"):
+                hintStats["received"] += 1
+            applied += 1
 
-        return "OK", 200
+        return jsonify(
+            message="Bulk ingest successful",
+            received=received,
+            applied=applied
+        ), 200
+
+#behavior for /kvs/rebalance-stats
+#reports how much data this node planned to send and actually received during the last view change
+@app.route('/kvs/rebalance-stats', methods=['GET'])
+def getRebalanceStats():
+    if(request.method == 'GET'):
+        jsonDict = {"message": "Rebalance stats retrieved successfully",
+                    "shard-id": selfShardID}
+        jsonDict.update(rebalanceStats)
+        return jsonDict, 200
 
 #behavior for /kvs/view-change
+#installs a new view on every node with two phases, under a new view epoch:
+#prepare: every node gets the view and the new key directory, and the nodes of the new view must all accept it
+#commit: every node installs it and moves its keys, and answers once they moved
+#so no node acts on the new view before every node of it has it, and we answer as soon as the data is in place
 @app.route('/kvs/view-change', methods = ['PUT'])
 def putViewChange():
 
     if(request.method == 'PUT'):
         #get the new replFactor from the PUT request
-        global replFactor
-        replFactor = request.get_json().get('repl-factor')
+        newReplFactor = request.get_json().get('repl-factor')
         #get the new view from the PUT request
         viewString = request.get_json().get('view')
         #break up the view into an array of addresses
         viewArray = str(viewString).split(',')
-        #copy the nodeAddressDict for sending requests to deactivated nodes
-        oldNodeAddressDict = nodeAddressDict.copy()
-        #clear the current nodeAddressDict
-        nodeAddressDict.clear()
-        #clear the current shardAddresses dict, too, since nodes can be assigned new shards
-        shardAddressesDict.clear()
+        #copy the shard layout, to ask the old shards how much data they moved
+        oldShardAddressesDict = {}
+        for shard, addresses in shardAddressesDict.items():
+            oldShardAddressesDict.update({shard : list(addresses)})
 
         #get the set of everybody to send messages to
         addressSet = set()
-        for node, address in oldNodeAddressDict.items():
+        for node, address in nodeAddressDict.items():
             addressSet.add(address)
         
         for address in viewArray:
@@ -1056,148 +3376,275 @@ def putViewChange():
 
         longerTimeout = 1
 
-        #broadcast the new view to everyone
-        for address in allAddressList:
-            #build URL, send updateView PUT
-            baseUrl = ('http://' + address + '/kvs/updateView')
-            #send the put request with the viewString
-            if(address == allAddressList[-1]):
-                try:
-                    r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'view' : viewString, 'repl-factor' : replFactor}, timeout=longerTimeout)
-                except:
-                    pass
-            else:
-                try:
-                    r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'view' : viewString, 'repl-factor' : replFactor}, timeout=0.000001)
-                    #should effective 0 timeout, because we don't know who is up or down and don't care about responses
-                except:
-                    pass
-        #give everyone time to update their view
-        #time.sleep(0.5)
-        #update the nodeAddressDict with the current list of addresses
-        i = 1
-        for address in viewArray:
-            nodeAddressDict.update({"node" + str(i) : address})
-            i += 1
-        #if we're the last one updated, that probably helps guard against sending stuff to unupdated nodes
-
-        #copy the current keyShardDict
-        #might want to send a request to pull all keys in case we're missing some
-        tempKeyShardDict = keyShardDict.copy()
-        #clear the keyShardDict to be updated with new {key : value} pairs
-        keyShardDict.clear()
-
-        nodeList = []
-        #get list of addresses to put on shards
-        for node, address in nodeAddressDict.items():
-            nodeList.append(node)
-
         #decide number of shards to distribute keys to
-        numShards = len(nodeAddressDict) // replFactor
-        shardCounter = 1
+        numShards = len(viewArray) // newReplFactor
         shardList = []
         for i in range(numShards):
-            #emptyTempList = []
-            shardID = "shard" + str(shardCounter)
-            shardAddressesDict[shardID] = []
-            #shardAddressesDict.update({shardID, emptyTempList})
-            shardList.append(shardID)
-            shardCounter += 1
-
-        #assign replFactor nodes to each shard
-        nodeCount = 0
-        shardCounter = 1
-        for node, address in nodeAddressDict.items():
-            if nodeCount == replFactor:
-                nodeCount = 0
-                shardCounter += 1
-            shardID = "shard" + str(shardCounter)
-            tempList = shardAddressesDict.get(shardID)
-            tempList.append(address)
-            shardAddressesDict.update({shardID : tempList})
-            nodeCount += 1
-
-
-        #round-robin redistribute keys to the local keyShardDict
-        a = 0
-        for key, shard in tempKeyShardDict.items():
-            #with 5 shards will mod 5 e.g. 4 mod 5 = 4, 5 mod 5 = 5, so we will never out-of-bounds error
-            keyShardDict.update({ key : shardList[ a % (len(shardList))] })
-            a += 1
-
-        #send the new keyShardDict to everyone
-        for address in allAddressList:
-            #build URL, send updateKeyShard PUT
-            baseUrl = ('http://' + address + '/kvs/updateKeyShard')
-            #send the keyShard dictionary to everyone
-            if(address == allAddressList[-1]):
-                try:
-                    r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'keyShardDict' : keyShardDict}, timeout=longerTimeout)
-                except:
-                    pass
-            else:
-                try:
-                    r = requests.put(baseUrl, headers={"Content-Type": "application/json"}, json={'keyShardDict' : keyShardDict}, timeout=0.000001)
-                    #timeout set to effective 0 because we try to send, but we don't care about the response
-                except:
-                    pass
-        #give everyone time to process updateKeyShard
-        #time.sleep(0.5)
-        #send a rearrangeKeys() type of broadcast
-        #tell everyone to send their keys to the correct place
-        #then delete them from local
-        for address in allAddressList:
-            #build URL, send rearrangeKeys PUT
-            baseUrl = ('http://' + address + '/kvs/rearrangeKeys')
-            if(address == allAddressList[-1]):
-                try:
-                     r = requests.put(baseUrl, timeout=0.000001)
-                except:
-                    pass
-            else:
-                #send the PUT request, doesn't need additional data
-                try:
-                    r = requests.put(baseUrl, timeout=0.000001)
-                    #timeout set to effective 0 because we try to send, but don't care about the response
-                except:
-                    pass
+            shardList.append("shard" + str(i + 1))
+
+        #redistribute keys to a new keyShardDict, only moving keys whose shard has to change
+        #(hash mode has no key directory, the ring already decides every key's shard)
+        keyShardDict = None
+        if(placementMode == "directory"):
+            keyShardDict = planRebalance(kvStore.shardDict(), shardList)
+        #range mode moves whole partitions the same way, and sends the new routing table
+        routingRanges = None
+        if(placementMode == "range"):
+            routingRanges = makeRoutingRanges(planRebalance(getPartitions(routingTable), shardList))
+
+        #newer than any view we have seen, so it can't be mistaken for an older one
+        #(an aborted epoch is never reused either)
+        global highestEpochSeen #global keyword so we know this isn't a local variable
+        epoch = max(viewEpoch, highestEpochSeen) + 1
+        highestEpochSeen = epoch
+
+        #prepare: send the new view to everyone at once, and wait for every node that is up to take it
+        prepareDict = {'epoch' : epoch, 'coordinator' : selfAddress, 'view' : viewString, 'repl-factor' : newReplFactor, 'keyShardDict' : keyShardDict, 'directory-time' : hlcNow(), 'routing-table' : routingRanges}
+        answers = fanOutPut(allAddressList, '/kvs/view-prepare', prepareDict, longerTimeout, len(allAddressList))
+        preparedAddresses = []
+        conflict = False
+        for address, r in answers:
+            if(r.status_code == 200):
+                preparedAddresses.append(address)
+            elif(r.status_code == 409):
+                conflict = True
+                noteViewEpoch(r.json().get('epoch'), None)
+        #nodes leaving the view may be down, but every node of the new view has to have it
+        missing = []
+        for address in viewArray:
+            if(address not in preparedAddresses):
+                missing.append(address)
+        if(conflict or len(missing) > 0):
+            fanOutPut(preparedAddresses, '/kvs/view-abort', {'epoch' : epoch, 'coordinator' : selfAddress}, longerTimeout, len(preparedAddresses))
+            if(conflict):
+                jsonDict = {"error" : "Another view change is in progress",
+                            "message" : "Error in PUT"}
+                return jsonDict, 409
+            jsonDict = {"error" : "Unable to satisfy request",
+                        "message" : "Error in PUT",
+                        "unreachable" : missing}
+            return jsonDict, 503
 
+        #commit: everyone installs the view and moves their keys, we wait until they are done
+        answers = fanOutPut(preparedAddresses, '/kvs/view-commit', {'epoch' : epoch, 'coordinator' : selfAddress}, viewCommitTimeout, len(preparedAddresses))
+        committed = 0
+        unconfirmed = 0
+        for address, r in answers:
+            #a node that answers anything else didn't install the view
+            if(r.status_code != 200):
+                continue
+            committed += 1
+            try:
+                unconfirmed += r.json().get('keys-unconfirmed')
+            except:
+                pass
+        #reported in the response, a view change that isn't fully done leaves the old layout in place for reads
+        commitDict = {"nodes" : len(preparedAddresses), "committed" : committed, "keys-unconfirmed" : unconfirmed}
+        if(committed == len(preparedAddresses) and unconfirmed == 0):
+            #every key is on its new shard, nobody has to look at the old layout anymore
+            fanOutPut(preparedAddresses, '/kvs/migration-done', {'epoch' : epoch}, longerTimeout, len(preparedAddresses))
 
         #all dicts should be up-to-date, all nodes should have the correct {key : value} pairs
-        #get the address and keyCount of every node, then return to client
-        #give everyone time process rearrangeKeys
-        time.sleep(2)
         #create and reply with {message="View change successful", shards=[{shard-id, key-count, replicas}]}
-        shardList.clear()
         #list of dictionaries to be returned in json
         dictList = []
+        #ask every shard at once
+        futureShardDict = {}
+        for shard in shardAddressesDict.keys():
+            futureShardDict.update({shard : batchExecutor.submit(getShardKeyCount, shard)})
         for shard, addresses in shardAddressesDict.items():
             keyCount = None
+            try:
+                keyCount = futureShardDict.get(shard).result()
+            except:
+                pass
             retDict = {}
-            addressList = []
             retDict.update({'shard-id' : shard})
             retDict.update({'replicas' : addresses})
-            for address in addresses:
-                addressList.append(address)
-                if keyCount is not None:
-                    pass
-                else:
-                    baseUrl = ('http://' + address + '/kvs/key-count')
-                    timeoutVal = 4 / len(shardAddressesDict)
-                    try:
-                        r = requests.get(baseUrl, timeout=timeoutVal) #timeout is generous because we care about the response
-                        keyCount = r.json().get('key-count')
-                    except:
-                        pass
             retDict.update({'key-count' : keyCount})
             dictList.append(retDict)
 
+        #report how much data the view change planned to move, and how much it actually moved
+        rebalanceDict = collectRebalanceStats(oldShardAddressesDict)
+
         return jsonify(
             message="View change successful",
-            shards=dictList
+            shards=dictList,
+            rebalance=rebalanceDict,
+            commit=commitDict,
+            epoch=epoch
         ), 200
 
 
+#getContextStats()
+#causal context sizes and garbage collection, for /kvs/metrics
+def getContextStats():
+    averageLength = 0
+    if(contextStats["responses"] > 0):
+        averageLength = contextStats["total-entries"] / contextStats["responses"]
+    return {
+        "average-length" : averageLength,
+        "gc-dropped" : contextStats["gc-dropped"],
+        "capped" : contextStats["capped"],
+        "latest-pruned" : contextStats["latest-pruned"],
+        "stable" : getStableSeqs()
+    }
+
+#getKeyCountTable()
+#the cached key-counts and their age in seconds, for /kvs/metrics
+def getKeyCountTable():
+    tableDict = {}
+    for shard, entry in list(keyCountTable.items()):
+        tableDict.update({shard : {"key-count" : entry[0], "age" : time.time() - entry[1]}})
+    return tableDict
+
+#behavior for /kvs/shard-status
+#expects {address, shard, stable, key-count, load}, sent by every node every gossip round
+#stable: the sequence number up to which address's change log is acknowledged by all its shard's replicas (None if not yet)
+#key-count: the shard's key-count, kept in keyCountTable
+#load: the node's {bytes, ops-per-sec, p99}, kept in loadReports
+@app.route('/kvs/shard-status', methods = ['PUT'])
+def receiveShardStatus():
+    address = request.get_json().get('address')
+    stable = request.get_json().get('stable')
+    stableReports.update({address : stable})
+    shard = request.get_json().get('shard')
+    keyCount = request.get_json().get('key-count')
+    if(shard is not None and keyCount is not None):
+        keyCountTable.update({shard : [keyCount, time.time()]})
+    loadReports.update({address : [request.get_json().get('load'), time.time()]})
+    return jsonify(
+        message="OK"
+    ), 200
+
+
+#startTimer()
+#notes when a request started, to measure the latency of local ops
+@app.before_request
+def startTimer():
+    g.startTime = time.time()
+
+#checkViewEpoch()
+#looks at the view epoch a peer sent its request with (clients send none), see peerRequest()
+#a peer on a newer view makes us catch up, a peer on an older view gets a 409 instead of us acting on its view,
+#except on the routes that work across views (view changes and heartbeats)
+#the 409 carries our epoch, so the peer catches up too
+@app.before_request
+def checkViewEpoch():
+    epochString = request.headers.get('X-View-Epoch')
+    if(epochString is None):
+        return None
+    noteViewEpoch(epochString, request.headers.get('X-Node-Address'))
+    try:
+        epoch = int(epochString)
+    except:
+        return None
+    if(epoch < viewEpoch and request.endpoint not in anyEpochRoutes):
+        viewStats["stale-rejected"] += 1
+        jsonDict = {"error" : "Stale view epoch",
+                    "message" : "Error in " + request.method,
+                    "epoch" : viewEpoch}
+        return jsonDict, 409
+    return None
+
+#addViewEpoch()
+#tells whoever sent the request which view epoch we are on, see peerRequest()
+@app.after_request
+def addViewEpoch(response):
+    response.headers["X-View-Epoch"] = str(viewEpoch)
+    return response
+
+#recordLoad()
+#counts a local op (see kvs()) towards our load, and its key towards hot-key migration
+@app.after_request
+def recordLoad(response):
+    key = g.get('localKey')
+    if(key is not None):
+        opLatencies.append(time.time() - g.startTime)
+        loadCounters["ops"] += 1
+        if(hotKeyMigration == "on"):
+            keyHits[key] += 1
+    return response
+
+#behavior for /kvs/ping
+#heartbeat of the failure detector, see sendHeartbeat()
+@app.route('/kvs/ping', methods=['GET'])
+def ping():
+    if(request.method == 'GET'):
+        jsonDict = {"message": "pong",
+                    "address": selfAddress,
+                    "epoch": viewEpoch}
+        return jsonDict, 200
+
+#behavior for /kvs/health
+#reports the failure detector's health table
+@app.route('/kvs/health', methods=['GET'])
+def getHealth():
+    if(request.method == 'GET'):
+        jsonDict = {"message": "Health retrieved successfully",
+                    "address": selfAddress,
+                    "peers": getHealthTable()}
+        return jsonDict, 200
+
+#behavior for /kvs/metrics
+#reports this node's internal counters
+@app.route('/kvs/metrics', methods=['GET'])
+def getMetrics():
+    if(request.method == 'GET'):
+        jsonDict = {"message": "Metrics retrieved successfully",
+                    "pool": getPoolStats(),
+                    "gossip": gossipStats,
+                    "clock": hlcUnpack((hlcClock << hlcNodeBits) | hlcNodeID),
+                    "context": getContextStats(),
+                    "pull": pullStats,
+                    "key-counts": getKeyCountTable(),
+                    "migrations": list(migrationHistory),
+                    "hints": getHintStats(),
+                    "view": {"epoch": viewEpoch, "highest-seen": highestEpochSeen, "prepared": list(preparedViews.keys()), "catch-ups": viewStats["catch-ups"], "stale-rejected": viewStats["stale-rejected"]},
+                    "load": {"policy": placementPolicy, "local": localLoad, "shards": getShardLoads(), "migration": migrationStats}}
+        return jsonDict, 200
+
+
+#behavior for /kvs/merkle
+#expects {level, indexes}, answers with the hashes of those merkle tree nodes
+@app.route('/kvs/merkle', methods = ['PUT'])
+def getMerkleHashes():
+    level = request.get_json().get('level')
+    indexes = request.get_json().get('indexes')
+    levels = buildMerkleLevels()
+    hashes = []
+    for index in indexes:
+        hashes.append(levels[level][index])
+    return jsonify(hashes=hashes), 200
+
+
+#behavior for /kvs/merkle-sync
+#expects {leaves, entries}: the sender's {key : [time, value]} for the merkle leaves that differ
+#applies the ones that are newer, and answers with ours that are newer or that the sender doesn't have
+@app.route('/kvs/merkle-sync', methods = ['PUT'])
+def merkleSync():
+    leaves = request.get_json().get('leaves')
+    theirEntries = request.get_json().get('entries')
+    ourEntries = getMerkleEntries(leaves)
+    for key, keyInfoArray in theirEntries.items():
+        if(belongsHere(key)):
+            kvStore.applyIfNewer(key, keyInfoArray[1], keyInfoArray[0])
+    newerEntries = {}
+    for key, keyInfoArray in ourEntries.items():
+        theirKeyInfo = theirEntries.get(key)
+        if(theirKeyInfo is None or theirKeyInfo[0] < keyInfoArray[0]):
+            newerEntries.update({key : keyInfoArray})
+    return jsonify(entries=newerEntries), 200
+
+
+#behavior for /kvs/directory-digest
+#tells the sender if its keyShardDict matches ours, so it only sends the whole thing when they differ
+@app.route('/kvs/directory-digest', methods = ['PUT'])
+def checkDirectoryDigest():
+    theirDigest = request.get_json().get('digest')
+    return jsonify(match=(theirDigest == getDirectoryDigest(kvStore.shardItems()))), 200
+
+
 # check if other value has been updated later than local value for key
 @app.route('/kvs/gossipCheck', methods = ['PUT'])
 def gossipCheck():
@@ -1205,7 +3652,7 @@ def gossipCheck():
     timeSlot = 0
     valueSlot = 1
     gossipDict = None
-    otherKeyShardDict = otherKeyShardDict = request.get_json().get('keyShardDict')
+    otherKeyShardDict = request.get_json().get('keyShardDict')
     try:
         gossipDict = request.get_json().get('gossipDict')
     except:
@@ -1214,73 +3661,293 @@ def gossipCheck():
     if(gossipDict is not None):
         #check keys from our replicas first
         for key, keyInfoArray in gossipDict.items():
-            ourTime = keyTimeDict.get(key)
             theirTime = keyInfoArray[timeSlot]
             theirValue = keyInfoArray[valueSlot]
-            
-            #if we have no time (base causal context after reset)
-            if(ourTime is None):
-                #update to gossip values
-                #print("GOSSIP (no time): updated key: %s value: %s"%(str(key), str(theirValue)), file=sys.stderr)
-                localKvsDict.update({key : theirValue})
-                keyTimeDict.update({key : theirTime})
-            else:
-                #if we do have a time, and it's less than the context time
-                if(ourTime < theirTime):
-                    #update our time to their time, our value to their value
-                    #print("GOSSIP (updated time): updated key: %s value: %s"%(str(key), str(theirValue)), file=sys.stderr)
-                    keyTimeDict.update({key : theirTime})
-                    localKvsDict.update({key : theirValue})
-                else:
-                    #we have a time, and it matches or is greater than the context time
-                    pass #do nothing
-                
-    #update keyShardDict
-    for key, shard in otherKeyShardDict.items():
-        if key in keyShardDict:
-            pass
-        else:
-            keyShardDict.update({key : shard})
+            #update our time to their time, our value to their value, if theirs is newer
+            if(belongsHere(key)):
+                kvStore.applyIfNewer(key, theirValue, theirTime)
+        #a replica's change log up to seq is here now, see getVersionVector()
+        senderAddress = request.get_json().get('address')
+        seq = request.get_json().get('seq')
+        if(senderAddress is not None and isinstance(seq, int)):
+            noteReceivedSeq(senderAddress, seq)
+
+    #update keyShardDict, <key: [shard, shardTime]> (hash mode sends none, since there is no key directory)
+    if(otherKeyShardDict is None):
+        otherKeyShardDict = {}
+    for key, entry in otherKeyShardDict.items():
+        #learn keys we don't know about yet, and moves newer than what we have
+        if(isinstance(entry, list)):
+            moveKeyShard(key, entry[0], entry[1])
 
     return "OK", 200
 
 
+#updateLocalLoad()
+#measures our load since the last gossip round: stored bytes, local ops/sec and p99 latency of local ops
+def updateLocalLoad():
+    global localLoad, lastLoadOps, lastLoadTime #global keyword so we know these aren't local variables
+    now = time.time()
+    ops = loadCounters["ops"]
+    opsPerSec = 0
+    if(now > lastLoadTime):
+        opsPerSec = (ops - lastLoadOps) / (now - lastLoadTime)
+    lastLoadOps = ops
+    lastLoadTime = now
+    samples = sorted(opLatencies)
+    p99 = 0
+    if(len(samples) > 0):
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    localLoad = {"bytes" : kvStore.countBytes(), "ops-per-sec" : opsPerSec, "p99" : p99}
+
 def gossip():
-    gossipDict = {}
-    #send all the <key: [timestamp, value]> at once
-    for key, value in localKvsDict.items():
-        timeValueArray = []
-        if(keyTimeDict.get(key) is not None):
-            ourTime = keyTimeDict.get(key)
-            timeValueArray = [ourTime, value]
-            gossipDict.update({key : timeValueArray})
-        else:
-            ourTime = 0 #easier to handle than (None) time
-            timeValueArray = [ourTime, value]
-            gossipDict.update({key : timeValueArray})
-    #dict of <key: [timestamp, value]> should be built for all keys, with our valid timestamps or 0 indicating no timestamp
+    global gossipRound #global keyword so we know this isn't a local variable
     addresses = shardAddressesDict.get(selfShardID)
-    if(addresses is not None):
+    if(addresses is None):
+        addresses = []
+
+    if(antiEntropyMode == "merkle"):
+        #send every replica the keys written since its cursor
+        #every antiEntropyRounds rounds, compare merkle trees instead, to catch anything the change log missed
+        gossipRound += 1
+        fullSync = (gossipRound % antiEntropyRounds == 0)
+        for address in addresses:
+            if(address == selfAddress):
+                continue
+            try:
+                syncReplica(address, fullSync)
+            except:
+                pass #replica is down, try again next round
+    else:
+        gossipDict = {}
+        #every change in our log up to sentSeq is in what we send
+        with changeLogLock:
+            sentSeq = changeSeq
+        #send all the <key: [timestamp, value]> at once
+        for key, value, ourTime in kvStore.valueItems():
+            timeValueArray = []
+            if(ourTime is not None):
+                timeValueArray = [ourTime, value]
+                gossipDict.update({key : timeValueArray})
+            else:
+                ourTime = 0 #easier to handle than (None) time
+                timeValueArray = [ourTime, value]
+                gossipDict.update({key : timeValueArray})
+        #dict of <key: [timestamp, value]> should be built for all keys, with our valid timestamps or 0 indicating no timestamp
         for address in addresses:
             baseUrl = ('http://' + address + '/kvs/gossipCheck')
             try:
-                r = requests.put(baseUrl, json={'gossipDict' : gossipDict, 'keyShardDict' : keyShardDict}, timeout=0.000001)
+                r = peerPut(baseUrl, json={'gossipDict' : gossipDict, 'address' : selfAddress, 'seq' : sentSeq}, timeout=0.000001)
             except:
                 pass
 
+    #tell every other node how far our change log is acknowledged, so they can drop stable context entries,
+    #and how many keys our shard has, so they can place keys and answer shard info without asking us
+    #only merkle mode hears back from replicas, so the "full" mode never has anything stable
+    updateLocalLoad()
+    statusDict = {'address' : selfAddress, 'shard' : selfShardID, 'stable' : getLocalStable(), 'key-count' : getLocalKeyCount(), 'load' : localLoad}
+    for node, address in nodeAddressDict.items():
+        if(address != selfAddress):
+            fanOutExecutor.submit(peerPut, 'http://' + address + '/kvs/shard-status', json=statusDict)
+    #a latest time says nothing once we hold a version at least that new
+    if(causalContextMode == "keys"):
+        def isCaughtUp(key, latest):
+            ourTime = kvStore.getTime(key)
+            return (ourTime is not None and latest <= ourTime)
+        contextStats["latest-pruned"] += kvStore.pruneLatest(isCaughtUp)
+
+    #in hash and range mode every node computes key placement, so there is no keyShardDict to gossip
+    if(placementMode != "directory"):
+        return
+    #only send our keyShardDict to nodes whose directory doesn't match ours
+    keyShardItems = kvStore.shardItems()
+    digest = getDirectoryDigest(keyShardItems)
     for node, address in nodeAddressDict.items():
-        baseUrl = ('http://' + address + '/kvs/gossipCheck')
+        if(address == selfAddress):
+            continue
         try:
-            r = requests.put(baseUrl, json={'keyShardDict' : keyShardDict}, timeout=0.000001)
+            baseUrl = ('http://' + address + '/kvs/directory-digest')
+            r = peerPut(baseUrl, json={'digest' : digest})
+            if(r.json().get('match') == True):
+                continue
+            baseUrl = ('http://' + address + '/kvs/gossipCheck')
+            r = peerPut(baseUrl, json={'keyShardDict' : keyShardItems}, timeout=0.000001)
         except:
             pass
 
 
+#walListener()
+#KeyStore listener that queues every value change for the write-ahead log
+#value records are ["value", key, value, time], a value of None means the key was dropped
+def walListener(key, oldTime, hadValue, newTime, hasValue):
+    if(hasValue):
+        record = ["value", key, kvStore.getValue(key), newTime]
+    else:
+        record = ["value", key, None, newTime]
+    with walLock:
+        walBuffer.append(record)
+
+#walShardListener()
+#KeyStore shard listener that queues every key directory change for the write-ahead log,
+#so a restart doesn't bring back the shards we had at the last snapshot
+#shard records are ["shard", key, shard, shardTime], a shard of None means the key left the directory
+def walShardListener(key, shard, shardTime):
+    with walLock:
+        walBuffer.append(["shard", key, shard, shardTime])
+
+#applyWalRecord()
+#replays one snapshot or log record into kvStore
+def applyWalRecord(record):
+    kind, key, first, second = record
+    if(kind == "shard"):
+        kvStore.setShard(key, first, second)
+    elif(first is None):
+        kvStore.drop(key)
+    else:
+        kvStore.applyIfNewer(key, first, second)
+
+#getWalPath()
+#path of a write-ahead log segment
+def getWalPath(segment):
+    return os.path.join(dataDir, 'wal-' + str(segment) + '.log')
+
+#writeWalBuffer()
+#writes the queued records to the current log segment, with one fsync for the whole batch
+#should be called with walFileLock held
+def writeWalBuffer():
+    global walBuffer #global keyword so we rebind instead of copying
+    #swap the buffer out, so writers only wait for the swap and not for the disk
+    with walLock:
+        records = walBuffer
+        walBuffer = []
+    if(len(records) == 0):
+        return
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record) + "\n")
+    walFile.write("".join(lines))
+    walFile.flush()
+    os.fsync(walFile.fileno())
+
+#flushWal()
+#makes the queued records durable, runs every walSyncInterval seconds
+def flushWal():
+    with walFileLock:
+        writeWalBuffer()
+
+#takeSnapshot()
+#writes every record we have to a new snapshot, then deletes the log segments it covers
+#the log moves to a new segment first, so writes during the snapshot are never lost
+def takeSnapshot():
+    global walFile, walSegment #global keyword so we know these aren't local variables
+    with walFileLock:
+        writeWalBuffer()
+        oldSegment = walSegment
+        walFile.close()
+        walSegment += 1
+        walFile = open(getWalPath(walSegment), 'a')
+
+    #write to a temporary file and rename it, so a crash never leaves half a snapshot
+    tempPath = os.path.join(dataDir, 'snapshot.tmp')
+    with open(tempPath, 'w') as snapshotFile:
+        #same records as the log
+        for key, value, keyTime in kvStore.valueItems():
+            snapshotFile.write(json.dumps(["value", key, value, keyTime]) + "\n")
+        for key, [shard, shardTime] in kvStore.shardItems().items():
+            snapshotFile.write(json.dumps(["shard", key, shard, shardTime]) + "\n")
+        snapshotFile.flush()
+        os.fsync(snapshotFile.fileno())
+    os.replace(tempPath, os.path.join(dataDir, 'snapshot.json'))
+
+    #everything up to oldSegment is in the snapshot now
+    for name in os.listdir(dataDir):
+        if(name.startswith('wal-') and name.endswith('.log') and int(name[4:-4]) <= oldSegment):
+            os.remove(os.path.join(dataDir, name))
+
+#restoreFromDisk()
+#loads the last snapshot, then replays the log segments written after it
+#a torn last line (crash in the middle of a write) ends the replay of its segment
+#returns the number of the last log segment found, or 0 if there are none
+def restoreFromDisk():
+    snapshotPath = os.path.join(dataDir, 'snapshot.json')
+    if(os.path.exists(snapshotPath)):
+        with open(snapshotPath) as snapshotFile:
+            for line in snapshotFile:
+                applyWalRecord(json.loads(line))
+
+    segments = []
+    for name in os.listdir(dataDir):
+        if(name.startswith('wal-') and name.endswith('.log')):
+            segments.append(int(name[4:-4]))
+    segments.sort()
+    for segment in segments:
+        with open(getWalPath(segment)) as segmentFile:
+            for line in segmentFile:
+                try:
+                    record = json.loads(line)
+                except:
+                    break #torn write, nothing after it made it to disk
+                applyWalRecord(record)
+    if(len(segments) == 0):
+        return 0
+    return segments[-1]
+
+
 scheduler = BackgroundScheduler()
 scheduler.add_job(func=gossip, trigger="interval", seconds=3)
-scheduler.start()
 
-atexit.register(lambda: scheduler.shutdown())
+#startBackgroundJobs()
+#starts gossip and the other scheduled jobs
+#must run in the process that serves requests, scheduler threads don't survive gunicorn's fork
+def startBackgroundJobs():
+    scheduler.start()
+    atexit.register(lambda: scheduler.shutdown())
+
+
+#ProductionServer
+#runs app on gunicorn instead of the Flask development server
+#always one worker process with serverThreads threads: kvStore, the clocks and gossip live in this process,
+#so separate worker processes would each have their own copy of the node's state
+class ProductionServer(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+#workerExited()
+#gunicorn child_exit hook, runs in the master every time the worker process ends
+#all of the node's state lives in the worker, a new one forked from the master would start with an empty store
+#and the startup view, so if the worker dies while we are still serving we stop the whole node instead
+#(whatever restarts the node brings it back through restoreFromDisk() and gossip)
+#the master closes its listeners before it stops the worker on a normal shutdown
+def workerExited(server, worker):
+    if(len(server.LISTENERS) > 0):
+        server.halt(reason="worker %d exited"%(worker.pid), exit_status=1)
+
+#runProductionServer()
+#serves requests with gunicorn until the node is stopped
+#async mode uses the gevent worker instead of threads
+def runProductionServer():
+    options = {
+        "bind" : "0.0.0.0:13800",
+        "workers" : 1,
+        "worker_class" : "gthread",
+        "threads" : serverThreads,
+        "keepalive" : 5, #peers reuse their connections to us, see getPeerSession()
+        #the worker is forked from this process, start the jobs in it
+        "post_fork" : lambda server, worker: startBackgroundJobs(),
+        "child_exit" : workerExited
+    }
+    if(serverMode == "async"):
+        options.update({"worker_class" : "gevent", "worker_connections" : serverConnections})
+    ProductionServer(app, options).run()
 
 
 #main driver
@@ -1296,15 +3963,357 @@ if __name__ == '__main__':
     if os.getenv('REPL_FACTOR') is not None:
         replFactor = int(os.getenv('REPL_FACTOR'))
 
-    #dictionary that holds {key : shard} to identify which shard a key belongs to
-    keyShardDict = {}
-
-    #need a local dictionary to hold this shard's key/value pairs
-    localKvsDict = {}
+    #"production": gunicorn with one worker process and serverThreads threads
+    #"async": gunicorn with one gevent worker, every request and peer call is a greenlet instead of a thread,
+    #so waiting on other nodes doesn't hold a thread and serverConnections requests can be in flight
+    #"dev": the Flask development server, with the debugger and reloader
+    serverMode = "production"
+    if os.getenv('SERVER_MODE') is not None:
+        serverMode = os.getenv('SERVER_MODE')
+
+    #threads serving requests in production mode
+    serverThreads = 64
+    if os.getenv('SERVER_THREADS') is not None:
+        serverThreads = int(os.getenv('SERVER_THREADS'))
+
+    #requests served at once in async mode
+    serverConnections = 1000
+    if os.getenv('SERVER_CONNECTIONS') is not None:
+        serverConnections = int(os.getenv('SERVER_CONNECTIONS'))
+
+    #seconds an inter-node request gets to answer, when the call site doesn't set its own timeout
+    peerTimeout = 2
+    if os.getenv('PEER_TIMEOUT') is not None:
+        peerTimeout = float(os.getenv('PEER_TIMEOUT'))
+
+    #seconds a request waiting on other nodes can spend, split between the nodes it tries
+    peerTimeoutBudget = 4
+    if os.getenv('PEER_TIMEOUT_BUDGET') is not None:
+        peerTimeoutBudget = float(os.getenv('PEER_TIMEOUT_BUDGET'))
+
+    #keep-alive connections kept open to each peer
+    peerPoolSize = 10
+    if os.getenv('PEER_POOL_SIZE') is not None:
+        peerPoolSize = int(os.getenv('PEER_POOL_SIZE'))
+
+    #number of replicas that must acknowledge a PUT before we answer the client
+    #the other replicas still get the write, in the background
+    writeQuorum = 1
+    if os.getenv('WRITE_QUORUM') is not None:
+        writeQuorum = int(os.getenv('WRITE_QUORUM'))
+
+    #threads used to send requests to several nodes at once, see fanOutPut()
+    #(greenlets in async mode, which are cheap enough to have one per request in flight)
+    fanOutThreads = 32
+    if(serverMode == "async"):
+        fanOutThreads = serverConnections
+    if os.getenv('FAN_OUT_THREADS') is not None:
+        fanOutThreads = int(os.getenv('FAN_OUT_THREADS'))
+    fanOutExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=fanOutThreads)
+    #threads that run the per-shard sub-batches of /kvs/batch, which wait on fanOutExecutor themselves
+    batchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=fanOutThreads)
+
+    #number of replicas a forwarded GET reads from, the answer with the highest timestamp wins
+    readQuorum = 1
+    if os.getenv('READ_QUORUM') is not None:
+        readQuorum = int(os.getenv('READ_QUORUM'))
+
+    #seconds to wait on a replica before also asking the next one, or "p95" to use recent read latencies
+    hedgeDelay = "p95"
+    if os.getenv('HEDGE_DELAY') is not None:
+        hedgeDelay = os.getenv('HEDGE_DELAY')
+
+    #latencies (seconds) of recent forwarded reads, used for the "p95" hedge delay
+    readLatencies = collections.deque(maxlen=200)
+
+    #"on": heartbeat every node, skip the ones that look down and order replicas by health (see orderReplicas())
+    failureDetector = "on"
+    if os.getenv('FAILURE_DETECTOR') is not None:
+        failureDetector = os.getenv('FAILURE_DETECTOR')
+    #seconds between heartbeats, and how long to wait for one
+    heartbeatInterval = 1
+    if os.getenv('HEARTBEAT_INTERVAL') is not None:
+        heartbeatInterval = float(os.getenv('HEARTBEAT_INTERVAL'))
+    heartbeatTimeout = 1
+    if os.getenv('HEARTBEAT_TIMEOUT') is not None:
+        heartbeatTimeout = float(os.getenv('HEARTBEAT_TIMEOUT'))
+    #phi over which a peer is suspected, 8 means we'd be wrong about one time in 10^8
+    phiThreshold = 8
+    if os.getenv('PHI_THRESHOLD') is not None:
+        phiThreshold = float(os.getenv('PHI_THRESHOLD'))
+    #failed requests in a row that open a peer's breaker, and heartbeats in a row that close it again
+    breakerFailures = 3
+    if os.getenv('BREAKER_FAILURES') is not None:
+        breakerFailures = int(os.getenv('BREAKER_FAILURES'))
+    breakerProbes = 2
+    if os.getenv('BREAKER_PROBES') is not None:
+        breakerProbes = int(os.getenv('BREAKER_PROBES'))
+    #{address : health entry}, see getPeerHealth()
+    peerHealth = {}
+    healthLock = threading.Lock()
+
+    #"on": keep the writes a replica missed, and replay them when it is back (see queueHint())
+    hintedHandoff = "on"
+    if os.getenv('HINTED_HANDOFF') is not None:
+        hintedHandoff = os.getenv('HINTED_HANDOFF')
+    #most hints kept for one replica
+    hintLimit = 10000
+    if os.getenv('HINT_LIMIT') is not None:
+        hintLimit = int(os.getenv('HINT_LIMIT'))
+    #hints per /kvs/bulk-ingest request when replaying
+    hintBatchSize = 500
+    if os.getenv('HINT_BATCH_SIZE') is not None:
+        hintBatchSize = int(os.getenv('HINT_BATCH_SIZE'))
+    #{address : OrderedDict {key : [value, time]}}, oldest hint first
+    hintQueues = {}
+    hintLock = threading.Lock()
+    hintsDirty = False
+    #replicas whose hints are being replayed right now
+    replayingHints = set()
+    hintStats = {"queued": 0, "replayed": 0, "dropped": 0, "received": 0}
+
+    #{address : requests.Session} shared by every thread, see getPeerSession()
+    peerSessions = {}
+    peerSessionsLock = threading.Lock()
+
+    #how keys are placed on shards
+    #"directory": new keys go to the emptiest shard, and every node keeps a {key : shard} directory
+    #"hash": keys are placed on a consistent-hash ring, so every node computes a key's shard locally
+    #"range": keys are placed by a routing table of hash ranges, see getKeyShard()
+    placementMode = "directory"
+    if os.getenv('PLACEMENT_MODE') is not None:
+        placementMode = os.getenv('PLACEMENT_MODE')
+
+    #number of points each shard gets on the consistent-hash ring
+    #more points spread keys more evenly between shards
+    virtualNodes = 64
+    if os.getenv('VIRTUAL_NODES') is not None:
+        virtualNodes = int(os.getenv('VIRTUAL_NODES'))
+
+    #consistent-hash ring, ([sorted points], [shard for each point]), built by buildHashRing()
+    hashRing = ([], [])
+
+    #number of partitions of the hash space in range mode, a view change moves whole partitions
+    numPartitions = 256
+    if os.getenv('PARTITIONS') is not None:
+        numPartitions = int(os.getenv('PARTITIONS'))
+    #routing table of range mode, ([sorted range starts], [shard of each range])
+    routingTable = ([], [])
+
+    #number of lock stripes in the storage engine, more stripes let more threads write at once
+    storeStripes = 64
+    if os.getenv('STORE_STRIPES') is not None:
+        storeStripes = int(os.getenv('STORE_STRIPES'))
+
+    #storage engine, holds every key's record:
+    #   the value and timestamp we store for this shard's keys
+    #   {key : shard} to identify which shard a key belongs to (only used in directory mode)
+    #   the latest timestamp we've seen for each key, used to verify whether to return a value or a NACK during a GET
+    kvStore = KeyStore(storeStripes)
+
+    #number of records per /kvs/bulk-ingest request when moving keys between shards
+    bulkBatchSize = 500
+    if os.getenv('BULK_BATCH_SIZE') is not None:
+        bulkBatchSize = int(os.getenv('BULK_BATCH_SIZE'))
+
+    #seconds to wait for a node to confirm a /kvs/bulk-ingest batch
+    bulkTimeout = 5
+    if os.getenv('BULK_TIMEOUT') is not None:
+        bulkTimeout = float(os.getenv('BULK_TIMEOUT'))
+
+    #what the causal context given to clients holds
+    #"vector": how far the client has seen the change log of every node, and the newest time it has seen
+    #"keys": the causal context has a timestamp for every key
+    causalContextMode = "vector"
+    if os.getenv('CAUSAL_CONTEXT_MODE') is not None:
+        causalContextMode = os.getenv('CAUSAL_CONTEXT_MODE')
+
+    #hybrid logical clock, used for every write timestamp
+    hlcClock = 0
+    hlcLock = threading.Lock()
+    #tiebreak between nodes that write in the same ms with the same counter
+    hlcNodeID = hashKey(selfAddress) % (1 << hlcNodeBits)
+    #ms a timestamp from another node can be ahead of our wall clock before we ignore it
+    hlcMaxDrift = 60000
+    if os.getenv('HLC_MAX_DRIFT') is not None:
+        hlcMaxDrift = int(os.getenv('HLC_MAX_DRIFT'))
+
+    #entries a causal context can have, the oldest are dropped past it (0 for no limit)
+    #entries every replica already has are always dropped
+    causalContextMax = 0
+    if os.getenv('CAUSAL_CONTEXT_MAX') is not None:
+        causalContextMax = int(os.getenv('CAUSAL_CONTEXT_MAX'))
+    contextStats = {"responses": 0, "total-entries": 0, "gc-dropped": 0, "capped": 0, "latest-pruned": 0}
+
+    #how far every node's change log is acknowledged by its shard's replicas, from /kvs/shard-status, {address : sequence number}
+    stableReports = {}
+    #key-counts the other shards reported, or we asked for, {shard : [key-count, time received]}
+    keyCountTable = {}
+    #seconds a cached key-count is used before the shard is asked again
+    keyCountMaxAge = 10
+    if os.getenv('KEY_COUNT_MAX_AGE') is not None:
+        keyCountMaxAge = float(os.getenv('KEY_COUNT_MAX_AGE'))
+
+    #how a new key's shard is chosen (directory mode)
+    #"keys": the shard with the fewest keys, "bytes": the fewest stored bytes,
+    #"load": the lowest stored bytes, ops/sec and p99 latency put together (see scoreShards())
+    placementPolicy = "keys"
+    if os.getenv('PLACEMENT_POLICY') is not None:
+        placementPolicy = os.getenv('PLACEMENT_POLICY')
+
+    #our load, measured every gossip round, and what the other nodes reported, {address : [load, time received]}
+    localLoad = None
+    loadReports = {}
+    loadCounters = {"ops": 0}
+    lastLoadOps = 0
+    lastLoadTime = time.time()
+    opLatencies = collections.deque(maxlen=1000)
+
+    #"on": move the hottest keys off our shard when it is overloaded (directory mode), see migrateHotKeys()
+    hotKeyMigration = "off"
+    if os.getenv('HOT_KEY_MIGRATION') is not None:
+        hotKeyMigration = os.getenv('HOT_KEY_MIGRATION')
+    #seconds between migrations
+    hotKeyInterval = 30
+    if os.getenv('HOT_KEY_INTERVAL') is not None:
+        hotKeyInterval = float(os.getenv('HOT_KEY_INTERVAL'))
+    #a shard is overloaded when it serves more than hotKeyRatio times the average shard's ops/sec
+    hotKeyRatio = 1.5
+    if os.getenv('HOT_KEY_RATIO') is not None:
+        hotKeyRatio = float(os.getenv('HOT_KEY_RATIO'))
+    #keys moved per migration
+    hotKeyBatch = 10
+    if os.getenv('HOT_KEY_BATCH') is not None:
+        hotKeyBatch = int(os.getenv('HOT_KEY_BATCH'))
+    #hits per key since the last migration
+    keyHits = collections.Counter()
+    migrationStats = {"keys-moved": 0, "bytes-moved": 0, "keys-received": 0}
+
+    #replica pulls running right now, {key : [done event, result]}, so stale readers of a key share one pull
+    inflightPulls = {}
+    inflightLock = threading.Lock()
+    pullStats = {"pulls": 0, "coalesced": 0}
+
+    #{address : sequence number} up to which we have every change in each replica's change log (vector mode)
+    receivedSeqs = {}
+    vectorLock = threading.Lock()
+
+    #how replicas keep their values in sync in the background
+    #"merkle": compare merkle trees and only send the keys that differ
+    #"full": send every key to every replica, every round
+    antiEntropyMode = "merkle"
+    if os.getenv('ANTI_ENTROPY') is not None:
+        antiEntropyMode = os.getenv('ANTI_ENTROPY')
+
+    #the merkle tree has 2^merkleDepth leaves, each covering a range of the hash space
+    merkleDepth = 10
+    if os.getenv('MERKLE_DEPTH') is not None:
+        merkleDepth = int(os.getenv('MERKLE_DEPTH'))
+
+    #levels of the merkle tree walked down per request
+    merkleStep = 2
+    if os.getenv('MERKLE_STEP') is not None:
+        merkleStep = int(os.getenv('MERKLE_STEP'))
+
+    #merkle leaf hashes, and the keys in each leaf, kept up to date by merkleListener()
+    merkleLeaves = [0] * (2 ** merkleDepth)
+    merkleLeafKeys = []
+    for i in range(2 ** merkleDepth):
+        merkleLeafKeys.append(set())
+
+    #every antiEntropyRounds gossip rounds, replicas compare merkle trees instead of only sending recent writes
+    antiEntropyRounds = 10
+    if os.getenv('ANTI_ENTROPY_ROUNDS') is not None:
+        antiEntropyRounds = int(os.getenv('ANTI_ENTROPY_ROUNDS'))
+    gossipRound = 0
+
+    #{key : sequence number} of the latest local write or gossip apply of each key, oldest first
+    #changeSeq is the last sequence number given out, changeLogFloor the newest one evicted from the log
+    changeLogSize = 10000
+    if os.getenv('CHANGE_LOG_SIZE') is not None:
+        changeLogSize = int(os.getenv('CHANGE_LOG_SIZE'))
+    #sequence numbers start at the wall clock in microseconds, so they keep going up across restarts,
+    #and a cursor or context entry from before a restart can't look newer than what we have now
+    changeLog = collections.OrderedDict()
+    changeSeq = time.time_ns() // 1000
+    changeLogFloor = changeSeq
+
+    #{address : sequence number} of the last change each replica acknowledged, it has every change up to it
+    peerCursors = {}
+
+    #keys sent by gossip, reported by /kvs/metrics
+    gossipStats = {"keys-incremental" : 0, "keys-anti-entropy" : 0, "full-syncs" : 0}
+
+    #held while changing the merkle tree / the change log
+    merkleLock = threading.Lock()
+    changeLogLock = threading.Lock()
+
+    #keep the merkle tree and change log up to date with every write to kvStore
+    kvStore.addListener(merkleListener)
+    kvStore.addListener(changeLogListener)
+    kvStore.addListener(hlcListener)
+    kvStore.addListener(migrationListener)
+
+    #directory to keep the write-ahead log and snapshots in, so a restarted node keeps its data
+    #persistence is off if this isn't set
+    dataDir = os.getenv('DATA_DIR')
+
+    #seconds between fsyncs of the write-ahead log, writes in between are batched into one fsync
+    walSyncInterval = 0.05
+    if os.getenv('WAL_SYNC_INTERVAL') is not None:
+        walSyncInterval = float(os.getenv('WAL_SYNC_INTERVAL'))
+
+    #seconds between snapshots, each snapshot lets us delete the log written before it
+    snapshotInterval = 60
+    if os.getenv('SNAPSHOT_INTERVAL') is not None:
+        snapshotInterval = float(os.getenv('SNAPSHOT_INTERVAL'))
+
+    #records waiting to be written to the log, and the open log segment
+    walBuffer = []
+    walLock = threading.Lock()
+    walFileLock = threading.Lock()
+    walFile = None
+    walSegment = 0
+
+    #data movement of the last view change, reported by /kvs/rebalance-stats
+    #planned: keys this node had to send to other shards, received: keys that arrived here from other shards
+    rebalanceStats = {"keys-planned" : 0, "bytes-planned" : 0, "keys-received" : 0, "bytes-received" : 0}
 
     #dictionary that holds {node : address} to list all nodes and addresses we have
     nodeAddressDict = {}
 
+    #every view change gets the next epoch, nodes only ever move to a newer one (see installView())
+    #the starting view is epoch 0
+    viewEpoch = 0
+    highestEpochSeen = 0
+    #when the key directory of our view was decided, directory moves after it are newer (directory mode)
+    viewDirectoryTime = None
+    viewLock = threading.Lock()
+    #views sent to us by /kvs/view-prepare, waiting for /kvs/view-commit, {epoch : prepare json}
+    preparedViews = {}
+    catchUpLock = threading.Lock()
+    viewStats = {"catch-ups": 0, "stale-rejected": 0}
+    #routes that answer peers on any view epoch, see checkViewEpoch()
+    anyEpochRoutes = ["getView", "prepareView", "commitView", "abortView", "finishMigration", "ping"]
+    #"on": while keys move to their new shards after a view change, reads fall back to a key's old shard
+    #and writes that land on the old shard are forwarded to the new one (see startMigration())
+    onlineMigration = "on"
+    if os.getenv('ONLINE_MIGRATION') is not None:
+        onlineMigration = os.getenv('ONLINE_MIGRATION')
+    #seconds a migration lasts at most, if the view change never says it is done
+    migrationGrace = 30
+    if os.getenv('MIGRATION_GRACE') is not None:
+        migrationGrace = float(os.getenv('MIGRATION_GRACE'))
+    #the layout before the current migration, and the progress of the last few migrations
+    oldLayout = None
+    migrationHistory = collections.deque(maxlen=10)
+    #[key, shard] of writes to keys that moved away, waiting to be forwarded (see migrationListener())
+    movedWrites = collections.deque()
+    #seconds the view change waits for every node to install the view and move its keys
+    viewCommitTimeout = 30
+    if os.getenv('VIEW_COMMIT_TIMEOUT') is not None:
+        viewCommitTimeout = float(os.getenv('VIEW_COMMIT_TIMEOUT'))
+
     #dictionary that holds {shard : [addresses]} to identify the addresses that belong to a shard
     shardAddressesDict = {}
 
@@ -1329,21 +4338,24 @@ if __name__ == '__main__':
 
     #allocate nodes to shards in shardAddressesDict
     decideNodeToShard()
+    #place the shards on the consistent-hash ring
+    buildHashRing()
+    #give every shard its partitions
+    routingTable = makeRoutingTable(makeRoutingRanges(getInitialPartitions()))
 
     #value to decide which shard the local node is in respect to the view
     selfShardID = "default" #default value of "default" to indicate error
 
-    #causal context object should be <key: [timestamp, shard]>
-    #<key : timestamp> held locally for checking for outdated timestamp
+    #causal context object should be <key: [timestamp, shard, origin, sequence number]> ("keys" mode)
+    #or <address: sequence number> plus <clockName: timestamp> ("vector" mode)
+    #timestamps are held locally in kvStore for checking for outdated timestamp
     #timestamp is overwritten when value is overwritten
-    keyTimeDict = {}
+    #origin and sequence number say where the version is in a node's change log, see makeKeyInfo()
     timestampSlot = 0
     shardSlot = 1
-
-    #{key : latestTime}
-    #keeps track of the most recent context (time) we've seen for each key
-    #used to verify whether to return a value or a NACK during a GET
-    latestTimeDict = {}
+    originSlot = 2
+    seqSlot = 3
+    clockName = "clock"
 
     #decide which shardID belongs to local node
     for shard, addresses in shardAddressesDict.items():
@@ -1351,5 +4363,36 @@ if __name__ == '__main__':
             if(selfAddress == address):
                 selfShardID = shard
 
-
-    app.run(host="0.0.0.0", port=13800, debug=True)
+    if(dataDir is not None):
+        os.makedirs(dataDir, exist_ok=True)
+        #load what we had before a restart, gossip only needs to bring us the changes since
+        walSegment = restoreFromDisk() + 1
+        loadHints()
+        walFile = open(getWalPath(walSegment), 'a')
+        #log every write from now on
+        kvStore.addListener(walListener)
+        kvStore.addShardListener(walShardListener)
+        scheduler.add_job(func=flushWal, trigger="interval", seconds=walSyncInterval)
+        scheduler.add_job(func=takeSnapshot, trigger="interval", seconds=snapshotInterval)
+        atexit.register(flushWal)
+
+    if(onlineMigration == "on"):
+        scheduler.add_job(func=finishMigrations, trigger="interval", seconds=1)
+
+    if(hotKeyMigration == "on"):
+        scheduler.add_job(func=migrateHotKeys, trigger="interval", seconds=hotKeyInterval)
+
+    if(failureDetector == "on"):
+        scheduler.add_job(func=heartbeat, trigger="interval", seconds=heartbeatInterval)
+
+    if(hintedHandoff == "on"):
+        scheduler.add_job(func=replayHints, trigger="interval", seconds=heartbeatInterval)
+        if(dataDir is not None):
+            atexit.register(saveHints)
+
+    if(serverMode == "dev"):
+        startBackgroundJobs()
+        #no reloader, it would run this module twice and the parent's snapshots would delete the child's log
+        app.run(host="0.0.0.0", port=13800, debug=True, use_reloader=False)
+    else:
+        runProductionServer()
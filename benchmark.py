@@ -0,0 +1,72 @@
+#imports
+import sys, time, threading, requests
+
+#benchmark.py
+#measures the throughput of a running node: PUTs, then GETs of the same keys, from many client threads
+#usage: python benchmark.py <address> [requests per phase] [client threads]
+#run it once against a node started with SERVER_MODE=dev and once with SERVER_MODE=production to compare
+
+
+#runPhase()
+#sends numRequests requests from numThreads threads, each thread with its own keep-alive session
+#returns [seconds taken, sorted latencies, number of failed requests]
+def runPhase(address, method, numRequests, numThreads):
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    #worker() sends every numThreads-th request, starting at offset
+    def worker(offset):
+        session = requests.Session()
+        for i in range(offset, numRequests, numThreads):
+            baseUrl = ('http://' + address + '/kvs/keys/bench' + str(i))
+            start = time.time()
+            try:
+                if(method == 'PUT'):
+                    r = session.put(baseUrl, json={'value' : 'value' + str(i)}, timeout=10)
+                else:
+                    r = session.get(baseUrl, timeout=10)
+                ok = (r.status_code in (200, 201))
+            except:
+                ok = False
+            with lock:
+                latencies.append(time.time() - start)
+                if(ok == False):
+                    failures[0] += 1
+
+    threads = []
+    start = time.time()
+    for offset in range(numThreads):
+        thread = threading.Thread(target=worker, args=(offset,))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return [time.time() - start, sorted(latencies), failures[0]]
+
+#printPhase()
+#prints the throughput and latency percentiles of a phase
+def printPhase(method, numRequests, result):
+    seconds, latencies, failures = result
+    p50 = latencies[int(len(latencies) * 0.50)] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    print("%s: %d requests in %.2fs, %.0f req/s, p50 %.1fms, p99 %.1fms, %d failed"
+          %(method, numRequests, seconds, numRequests / seconds, p50, p99, failures))
+
+
+if __name__ == '__main__':
+    if(len(sys.argv) < 2):
+        print("usage: python benchmark.py <address> [requests per phase] [client threads]")
+        sys.exit(1)
+    address = sys.argv[1]
+
+    numRequests = 2000
+    if(len(sys.argv) > 2):
+        numRequests = int(sys.argv[2])
+
+    numThreads = 16
+    if(len(sys.argv) > 3):
+        numThreads = int(sys.argv[3])
+
+    for method in ['PUT', 'GET']:
+        printPhase(method, numRequests, runPhase(address, method, numRequests, numThreads))
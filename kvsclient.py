@@ -0,0 +1,199 @@
+#imports
+import requests, hashlib, bisect
+
+#kvsclient.py
+#client library that sends requests straight to a replica of the shard that owns the key,
+#instead of to any node, which would forward them (an extra hop for every request that lands on the wrong shard)
+#the view (shards, replicas, placement) is fetched from /kvs/shards and /kvs/shards/<id> and cached,
+#and refreshed when a node answers 421 "Wrong shard" with a different view-version
+#
+#usage:
+#   client = KvsClient(["10.10.0.2:13800", "10.10.0.3:13800"])
+#   client.put("key", "value")
+#   client.get("key")  #returns the response json, with the value in "value"
+#the client keeps its own causal context, and sends it with every request
+
+
+#hashKey()
+#same hash as the nodes use for the consistent-hash ring and the routing table, so we compute the same owner
+def hashKey(keyString):
+    return int(hashlib.md5(str(keyString).encode('utf-8')).hexdigest()[:16], 16)
+
+
+#KvsClient
+#routes requests by key, with a cached view of the cluster
+#addresses: nodes to ask for the view, any node of the cluster works
+class KvsClient:
+    def __init__(self, addresses, timeout=5):
+        self.addresses = list(addresses)
+        self.timeout = timeout
+        self.session = requests.Session() #keep-alive connections to every node
+        self.causalContext = None
+        self.viewVersion = None
+        self.placement = None
+        self.shardAddressesDict = {}
+        self.addressShardDict = {}
+        self.keyShardDict = {} #shards we learned for keys (directory placement)
+        self.hashRing = ([], [])
+        self.routingTable = ([], []) #([range starts], [shards]) (range placement)
+        self.stats = {"direct": 0, "redirected": 0, "view-refreshes": 0}
+        self.refreshView()
+
+    #refreshView()
+    #fetches the shards, their replicas and the placement from the first node that answers
+    def refreshView(self):
+        for address in self.getKnownAddresses():
+            try:
+                r = self.session.get('http://' + address + '/kvs/shards', timeout=self.timeout)
+                shardsJson = r.json()
+                shardAddressesDict = {}
+                for shard in shardsJson.get('shards'):
+                    r = self.session.get('http://' + address + '/kvs/shards/' + shard, timeout=self.timeout)
+                    shardAddressesDict.update({shard : r.json().get('replicas')})
+            except (requests.RequestException, ValueError):
+                continue #node is down, ask the next one
+            self.shardAddressesDict = shardAddressesDict
+            self.addressShardDict = {}
+            for shard, replicas in shardAddressesDict.items():
+                for replica in replicas:
+                    self.addressShardDict.update({replica : shard})
+            self.placement = shardsJson.get('placement')
+            self.viewVersion = shardsJson.get('view-version')
+            self.keyShardDict = {}
+            self.buildHashRing(shardsJson.get('virtual-nodes'))
+            ranges = shardsJson.get('routing-table') or []
+            self.routingTable = ([start for start, shard in ranges], [shard for start, shard in ranges])
+            self.stats["view-refreshes"] += 1
+            return True
+        return False
+
+    #getKnownAddresses()
+    #every node we know of, the ones we were given first
+    def getKnownAddresses(self):
+        addresses = list(self.addresses)
+        for replicas in self.shardAddressesDict.values():
+            for replica in replicas:
+                if(replica not in addresses):
+                    addresses.append(replica)
+        return addresses
+
+    #buildHashRing()
+    #builds the same consistent-hash ring as the nodes (hash placement only)
+    def buildHashRing(self, virtualNodes):
+        ringList = []
+        if(self.placement == "hash" and virtualNodes is not None):
+            for shard in self.shardAddressesDict:
+                for i in range(virtualNodes):
+                    ringList.append((hashKey(shard + "#" + str(i)), shard))
+        ringList.sort()
+        self.hashRing = ([point for point, shard in ringList], [shard for point, shard in ringList])
+
+    #getKeyShard()
+    #the shard that owns key, or None if we don't know it (any node will forward the request)
+    def getKeyShard(self, key):
+        if(self.placement == "hash"):
+            points, shards = self.hashRing
+            if(len(points) == 0):
+                return None
+            index = bisect.bisect_right(points, hashKey(key))
+            if(index == len(points)):
+                index = 0 #wrap around the ring
+            return shards[index]
+        if(self.placement == "range"):
+            starts, shards = self.routingTable
+            index = bisect.bisect_right(starts, hashKey(key)) - 1
+            if(index < 0):
+                return None
+            return shards[index]
+        return self.keyShardDict.get(key)
+
+    #getTargets()
+    #addresses to try for key, the owning shard's replicas first
+    def getTargets(self, key):
+        shard = self.getKeyShard(key)
+        targets = []
+        if(shard is not None):
+            targets = list(self.shardAddressesDict.get(shard, []))
+        for address in self.getKnownAddresses():
+            if(address not in targets):
+                targets.append(address)
+        return targets
+
+    #request()
+    #sends a request for key to the owning shard, following "Wrong shard" redirects (refreshing the view once if it changed)
+    #returns the response json, with the status code in "status-code"
+    def request(self, method, key, jsonDict):
+        triedRefresh = False
+        redirects = 0
+        targets = self.getTargets(key)
+        while(len(targets) > 0):
+            address = targets.pop(0)
+            jsonDict.update({"causal-context" : self.causalContext})
+            headers = {"X-View-Version" : str(self.viewVersion)}
+            try:
+                r = self.session.request(method, 'http://' + address + '/kvs/keys/' + key, json=jsonDict, headers=headers, timeout=self.timeout)
+                answer = r.json()
+            except (requests.RequestException, ValueError):
+                continue #node is down, or didn't answer with json (a crash, a proxy), try the next one
+            if(not isinstance(answer, dict)):
+                continue #not one of our answers either
+            if(r.status_code == 421):
+                #the node knows where the key is, go there
+                self.stats["redirected"] += 1
+                if(answer.get("view-version") != self.viewVersion and triedRefresh == False):
+                    triedRefresh = True
+                    self.refreshView()
+                self.keyShardDict.update({key : answer.get("shard-id")})
+                #nodes that disagree on the view could send us around in circles
+                redirects += 1
+                if(redirects <= 3):
+                    targets = list(answer.get("replicas") or []) + targets
+                continue
+            self.stats["direct"] += 1
+            #learn the key's shard from whoever handled it (directory placement)
+            owner = answer.get("address", address)
+            if(self.addressShardDict.get(owner) is not None):
+                self.keyShardDict.update({key : self.addressShardDict.get(owner)})
+            if(answer.get("causal-context") is not None):
+                self.causalContext = answer.get("causal-context")
+            answer.update({"status-code" : r.status_code})
+            return answer
+        #nobody answered, the view may be out of date
+        self.refreshView()
+        return {"error" : "Unable to satisfy request", "status-code" : 503}
+
+    #get()
+    #reads key, returns the response json ("value", "doesExist", "status-code")
+    def get(self, key):
+        return self.request('GET', key, {})
+
+    #put()
+    #writes key, returns the response json ("message", "replaced", "status-code")
+    def put(self, key, value):
+        return self.request('PUT', key, {"value" : value})
+
+    #getMany()
+    #reads many keys with one /kvs/batch request, returns {key : {"status", "value" or "error"}}
+    def getMany(self, keys):
+        return self.batch('GET', list(keys))
+
+    #putMany()
+    #writes {key : value} with one /kvs/batch request, returns {key : {"status"}}
+    def putMany(self, keyValueDict):
+        return self.batch('PUT', dict(keyValueDict))
+
+    #batch()
+    #sends a /kvs/batch request to the first node that answers, it splits the keys by shard itself
+    def batch(self, method, keys):
+        for address in self.getKnownAddresses():
+            try:
+                r = self.session.request(method, 'http://' + address + '/kvs/batch', json={"keys" : keys, "causal-context" : self.causalContext}, timeout=self.timeout)
+                answer = r.json()
+            except (requests.RequestException, ValueError):
+                continue #node is down, or didn't answer with json, try the next one
+            if(not isinstance(answer, dict)):
+                continue
+            if(answer.get("causal-context") is not None):
+                self.causalContext = answer.get("causal-context")
+            return answer.get("results")
+        return None
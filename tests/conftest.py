@@ -0,0 +1,6 @@
+import os
+import sys
+
+#the node and the client are single modules at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.argv = sys.argv[:1]
@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+
+import assignment4
+
+NOW_MS = 1700000000000
+
+
+#the clock globals are set up in assignment4's main block, give every test a fresh clock at a fixed wall time
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    monkeypatch.setattr(assignment4, "hlcClock", 0, raising=False)
+    monkeypatch.setattr(assignment4, "hlcLock", threading.Lock(), raising=False)
+    monkeypatch.setattr(assignment4, "hlcNodeID", 5, raising=False)
+    monkeypatch.setattr(assignment4, "hlcMaxDrift", 60000, raising=False)
+    monkeypatch.setattr(assignment4.time, "time_ns", lambda: NOW_MS * 1000000)
+
+#makeTime()
+#packs a timestamp the way hlcNow() does
+def makeTime(physical, logical, node):
+    return (((physical << assignment4.hlcLogicalBits) | logical) << assignment4.hlcNodeBits) | node
+
+def test_unpack_round_trip():
+    assert assignment4.hlcUnpack(makeTime(NOW_MS, 17, 1023)) == [NOW_MS, 17, 1023]
+
+def test_now_uses_wall_clock_and_node_id():
+    assert assignment4.hlcUnpack(assignment4.hlcNow()) == [NOW_MS, 0, 5]
+
+def test_now_counts_up_when_wall_clock_stands_still():
+    first = assignment4.hlcNow()
+    second = assignment4.hlcNow()
+    assert second > first
+    assert assignment4.hlcUnpack(second) == [NOW_MS, 1, 5]
+
+def test_full_logical_counter_carries_into_physical():
+    maxLogical = (1 << assignment4.hlcLogicalBits) - 1
+    assignment4.hlcClock = (NOW_MS << assignment4.hlcLogicalBits) | maxLogical
+    assert assignment4.hlcUnpack(assignment4.hlcNow()) == [NOW_MS + 1, 0, 5]
+
+def test_update_orders_next_write_after_theirs():
+    theirTime = makeTime(NOW_MS + 1000, 3, 9)
+    assignment4.hlcUpdate(theirTime)
+    ourTime = assignment4.hlcNow()
+    assert ourTime > theirTime
+    assert assignment4.hlcUnpack(ourTime) == [NOW_MS + 1000, 4, 5]
+
+def test_update_never_moves_clock_back():
+    assignment4.hlcNow()
+    before = assignment4.hlcClock
+    assignment4.hlcUpdate(makeTime(NOW_MS - 1000, 0, 9))
+    assert assignment4.hlcClock == before
+
+def test_update_rejects_time_past_max_drift():
+    assignment4.hlcUpdate(makeTime(NOW_MS + 60001, 0, 9))
+    assert assignment4.hlcClock == 0
+    assignment4.hlcUpdate(makeTime(NOW_MS + 60000, 0, 9))
+    assert assignment4.hlcClock == (NOW_MS + 60000) << assignment4.hlcLogicalBits
+
+def test_update_ignores_non_timestamps():
+    assignment4.hlcUpdate("123")
+    assignment4.hlcUpdate(None)
+    assert assignment4.hlcClock == 0
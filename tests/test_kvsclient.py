@@ -0,0 +1,161 @@
+import collections
+import time
+
+import pytest
+import requests
+
+import assignment4
+import kvsclient
+
+
+#FakeResponse
+#what a FakeSession answers, body None stands for an answer that isn't json
+class FakeResponse:
+    def __init__(self, statusCode, body):
+        self.status_code = statusCode
+        self.body = body
+
+    def json(self):
+        if(self.body is None):
+            raise ValueError("not json")
+        return self.body
+
+
+#FakeSession
+#stands in for requests.Session, handler(method, address, path, json, headers) gives every answer
+class FakeSession:
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []
+
+    def get(self, url, timeout=None):
+        return self.request('GET', url, timeout=timeout)
+
+    def request(self, method, url, json=None, headers=None, timeout=None):
+        address, path = url[len('http://'):].split('/', 1)
+        self.calls.append((method, address, '/' + path, headers))
+        return self.handler(method, address, '/' + path, json, headers or {})
+
+#makeClient()
+#a KvsClient whose requests all go to handler
+def makeClient(monkeypatch, addresses, handler):
+    session = FakeSession(handler)
+    monkeypatch.setattr(kvsclient.requests, "Session", lambda: session)
+    return kvsclient.KvsClient(addresses)
+
+#viewAnswer()
+#answers the view endpoints for {shard : [replicas]} with directory placement
+def viewAnswer(path, shardAddressesDict, viewVersion):
+    if(path == '/kvs/shards'):
+        return FakeResponse(200, {"shards" : list(shardAddressesDict), "placement" : "directory", "view-version" : viewVersion})
+    shard = path[len('/kvs/shards/'):]
+    return FakeResponse(200, {"shard-id" : shard, "replicas" : shardAddressesDict.get(shard)})
+
+def test_follows_redirect_and_refreshes_view(monkeypatch):
+    oldView = {"shard1" : ["a:1"], "shard2" : ["b:1"]}
+    newView = {"shard1" : ["a:1"], "shard2" : ["b:1"], "shard3" : ["c:1"]}
+    state = {"view" : oldView, "version" : "v1"}
+
+    def handler(method, address, path, jsonDict, headers):
+        if(path.startswith('/kvs/shards')):
+            return viewAnswer(path, state.get("view"), state.get("version"))
+        if(address == "c:1"):
+            return FakeResponse(200, {"message" : "Retrieved successfully", "value" : 7, "causal-context" : {"c:1" : 3}})
+        #the view changed under the client, every old node knows the key is on shard3 now
+        state.update({"view" : newView, "version" : "v2"})
+        return FakeResponse(421, {"error" : "Wrong shard", "shard-id" : "shard3", "replicas" : ["c:1"], "view-version" : "v2"})
+
+    client = makeClient(monkeypatch, ["a:1"], handler)
+    answer = client.get("x")
+    assert answer.get("status-code") == 200
+    assert answer.get("value") == 7
+    assert client.viewVersion == "v2"
+    assert client.shardAddressesDict == newView
+    assert client.keyShardDict == {"x" : "shard3"}
+    assert client.causalContext == {"c:1" : 3}
+    assert client.stats == {"direct" : 1, "redirected" : 1, "view-refreshes" : 2}
+    #the request to the new owner carries the new view version
+    lastCall = client.session.calls[-1]
+    assert lastCall[1] == "c:1"
+    assert lastCall[3].get("X-View-Version") == "v2"
+    #the next request goes straight to the owner
+    client.get("x")
+    assert client.session.calls[-1][1] == "c:1"
+    assert client.stats.get("redirected") == 1
+
+def test_skips_nodes_that_are_down_or_not_json(monkeypatch):
+    view = {"shard1" : ["a:1", "b:1", "c:1"]}
+
+    def handler(method, address, path, jsonDict, headers):
+        if(path.startswith('/kvs/shards')):
+            return viewAnswer(path, view, "v1")
+        if(address == "a:1"):
+            raise requests.ConnectionError("down")
+        if(address == "b:1"):
+            return FakeResponse(502, None)
+        return FakeResponse(201, {"message" : "Added successfully", "replaced" : False})
+
+    client = makeClient(monkeypatch, ["a:1", "b:1", "c:1"], handler)
+    answer = client.put("x", 1)
+    assert answer.get("status-code") == 201
+    assert client.keyShardDict == {"x" : "shard1"}
+
+
+#node()
+#sets up assignment4's view globals (normally set in its main block) for placementMode, with three shards of two replicas
+@pytest.fixture
+def node(monkeypatch):
+    def setUp(placementMode):
+        shardAddressesDict = {}
+        nodeAddressDict = {}
+        for i in range(6):
+            address = "10.0.0.%d:13800"%(i + 2)
+            nodeAddressDict.update({"node" + str(i + 1) : address})
+            shardAddressesDict.setdefault("shard" + str(i // 2 + 1), []).append(address)
+        monkeypatch.setattr(assignment4, "placementMode", placementMode, raising=False)
+        monkeypatch.setattr(assignment4, "virtualNodes", 64, raising=False)
+        monkeypatch.setattr(assignment4, "numPartitions", 256, raising=False)
+        monkeypatch.setattr(assignment4, "replFactor", 2, raising=False)
+        monkeypatch.setattr(assignment4, "nodeAddressDict", nodeAddressDict, raising=False)
+        monkeypatch.setattr(assignment4, "shardAddressesDict", shardAddressesDict, raising=False)
+        monkeypatch.setattr(assignment4, "selfShardID", "shard1", raising=False)
+        monkeypatch.setattr(assignment4, "viewEpoch", 0, raising=False)
+        monkeypatch.setattr(assignment4, "hotKeyMigration", "off", raising=False)
+        monkeypatch.setattr(assignment4, "movedWrites", collections.deque(), raising=False)
+        #fresh key-counts, so /kvs/shards/<id> doesn't ask other nodes
+        keyCountTable = {}
+        for shard in shardAddressesDict:
+            keyCountTable.update({shard : [0, time.time()]})
+        monkeypatch.setattr(assignment4, "keyCountTable", keyCountTable, raising=False)
+        monkeypatch.setattr(assignment4, "keyCountMaxAge", 60, raising=False)
+        monkeypatch.setattr(assignment4, "getLocalKeyCount", lambda: 0)
+        monkeypatch.setattr(assignment4, "hashRing", ([], []), raising=False)
+        assignment4.buildHashRing()
+        #partitions spread over the shards out of order, so the routing table has many ranges
+        shardList = list(shardAddressesDict)
+        partitionShardDict = {}
+        for partition in range(256):
+            partitionShardDict.update({partition : shardList[(partition * 7 // 5) % len(shardList)]})
+        routingTable = assignment4.makeRoutingTable(assignment4.makeRoutingRanges(partitionShardDict))
+        monkeypatch.setattr(assignment4, "routingTable", routingTable, raising=False)
+    return setUp
+
+#nodeHandler()
+#answers the client's view requests from assignment4's own routes
+def nodeHandler(method, address, path, jsonDict, headers):
+    r = assignment4.app.test_client().open(path, method=method, json=jsonDict, headers=headers)
+    return FakeResponse(r.status_code, r.get_json())
+
+@pytest.mark.parametrize("placementMode", ["hash", "range"])
+def test_client_places_keys_like_the_node(monkeypatch, node, placementMode):
+    node(placementMode)
+    client = makeClient(monkeypatch, ["10.0.0.2:13800"], nodeHandler)
+    assert client.placement == placementMode
+    assert client.shardAddressesDict == assignment4.shardAddressesDict
+    assert client.viewVersion == assignment4.getViewVersion()
+    shards = set()
+    for i in range(2000):
+        key = "key%d"%(i)
+        shards.add(assignment4.getKeyShard(key))
+        assert client.getKeyShard(key) == assignment4.getKeyShard(key)
+    assert shards == {"shard1", "shard2", "shard3"}
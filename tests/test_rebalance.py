@@ -0,0 +1,49 @@
+import assignment4
+
+
+#shardCounts()
+#number of keys placed on each shard
+def shardCounts(keyShardDict, shardList):
+    counts = {}
+    for shard in shardList:
+        counts.update({shard : 0})
+    for shard in keyShardDict.values():
+        counts.update({shard : counts.get(shard) + 1})
+    return counts
+
+def test_no_shards():
+    assert assignment4.planRebalance({"a" : "1"}, []) == {}
+
+def test_balanced_layout_does_not_move():
+    oldKeyShardDict = {"a" : "1", "b" : "2", "c" : "1", "d" : "2"}
+    assert assignment4.planRebalance(oldKeyShardDict, ["1", "2"]) == oldKeyShardDict
+
+def test_added_shard_takes_only_overflow():
+    oldKeyShardDict = {}
+    for i in range(6):
+        oldKeyShardDict.update({"key%d"%(i) : str(i % 2 + 1)})
+    newKeyShardDict = assignment4.planRebalance(oldKeyShardDict, ["1", "2", "3"])
+    assert shardCounts(newKeyShardDict, ["1", "2", "3"]) == {"1" : 2, "2" : 2, "3" : 2}
+    moved = [key for key in oldKeyShardDict if oldKeyShardDict.get(key) != newKeyShardDict.get(key)]
+    #each old shard gives up one key, nothing else moves
+    assert len(moved) == 2
+    assert all(newKeyShardDict.get(key) == "3" for key in moved)
+
+def test_removed_shard_keys_spread_out():
+    oldKeyShardDict = {"a" : "1", "b" : "2", "c" : "3", "d" : "3", "e" : "1", "f" : "2"}
+    newKeyShardDict = assignment4.planRebalance(oldKeyShardDict, ["1", "2"])
+    assert shardCounts(newKeyShardDict, ["1", "2"]) == {"1" : 3, "2" : 3}
+    #keys that were on a surviving shard stay put
+    for key in ["a", "b", "e", "f"]:
+        assert newKeyShardDict.get(key) == oldKeyShardDict.get(key)
+
+def test_moves_go_to_emptiest_shard_in_order():
+    #all keys start on shard 1, shard order breaks ties
+    oldKeyShardDict = {"a" : "1", "b" : "1", "c" : "1", "d" : "1", "e" : "1"}
+    newKeyShardDict = assignment4.planRebalance(oldKeyShardDict, ["1", "2", "3"])
+    assert newKeyShardDict == {"a" : "1", "b" : "1", "c" : "2", "d" : "3", "e" : "2"}
+
+def test_unbalanced_within_fair_share():
+    #fair share is a ceiling, a shard under it is never refilled from one at it
+    oldKeyShardDict = {"a" : "1", "b" : "1", "c" : "2"}
+    assert assignment4.planRebalance(oldKeyShardDict, ["1", "2"]) == oldKeyShardDict